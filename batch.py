@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parallel batch conversion engine
+Runs many Markdown conversions on a process pool and reports results in input order.
+Used by: md2pdf.py (multi-file mode) and md2pdf_gui.py
+"""
+
+import os
+import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import profiling
+import logsetup
+import supervisor
+
+logger = logging.getLogger(__name__)
+
+# Result of one conversion job; `index` is the position in the submitted job list.
+# `trace` holds the worker's stage records when the parent process is tracing.
+JobResult = namedtuple('JobResult', ['index', 'input_file', 'output_file', 'success', 'error', 'trace'],
+                       defaults=(None,))
+
+
+def default_workers():
+    """Default pool size: one worker per CPU core"""
+    return os.cpu_count() or 1
+
+
+def output_collisions(jobs):
+    """Outputs that more than one input would write: {output_file: [input_file, ...]}
+
+    Outputs are compared without their extension, since the HTML fallback
+    and extra formats are written next to the PDF. The same input listed
+    twice is not a collision.
+    """
+    owners = {}
+    for input_file, output_file in jobs:
+        stem = os.path.normcase(os.path.splitext(os.path.abspath(output_file))[0])
+        inputs = owners.setdefault(stem, {})
+        inputs.setdefault(os.path.normcase(os.path.abspath(input_file)), (input_file, output_file))
+    return {next(iter(inputs.values()))[1]: [input_file for input_file, _ in inputs.values()]
+            for inputs in owners.values() if len(inputs) > 1}
+
+
+def _run_job(convert, index, input_file, output_file, args, trace=False):
+    """Run a single job, turning exceptions into a failed result"""
+    if supervisor.cancelled():
+        return JobResult(index, input_file, output_file, False, 'cancelled')
+    tracer = profiling.start_tracing() if trace else None
+    try:
+        with logsetup.job_context(f"{index + 1}-{os.path.basename(input_file)}"):
+            success = bool(convert(input_file, output_file, *args))
+        result = JobResult(index, input_file, output_file, success, None)
+    except Exception as e:
+        result = JobResult(index, input_file, output_file, False, str(e))
+    if tracer is not None:
+        profiling.stop_tracing()
+        result = result._replace(trace=tracer.records)
+    return result
+
+
+def _init_worker(cancel, log_config):
+    supervisor.set_cancel_event(cancel)
+    logsetup.init_worker(log_config)
+
+
+def run_batch(jobs, convert, args=(), workers=None, on_result=None, cancel=None):
+    """Convert (input_file, output_file) pairs concurrently.
+
+    `convert` must be a module-level function so it can be sent to worker
+    processes; it is called as convert(input_file, output_file, *args).
+    `on_result(result, done, total)` is called for every job in input order,
+    as soon as that job and all jobs before it have finished.
+    `cancel` is an optional multiprocessing.Event; setting it stops running
+    pandoc/LaTeX processes (see supervisor) and fails the remaining jobs.
+    Returns the list of JobResult in input order.
+    """
+    jobs = list(jobs)
+    total = len(jobs)
+    if workers is None:
+        workers = default_workers()
+    workers = max(1, min(workers, total or 1))
+
+    results = []
+    tracer = profiling.current_tracer()
+
+    def emit(result):
+        results.append(result)
+        if tracer is not None and result.trace:
+            # Stages recorded in worker processes
+            tracer.merge(result.trace)
+        if not result.success:
+            logger.error(f"✗ {result.input_file}: {result.error or 'conversion failed'}")
+        if on_result is not None:
+            on_result(result, len(results), total)
+
+    # A single worker (or a single job) gains nothing from a pool
+    if workers == 1:
+        supervisor.set_cancel_event(cancel)
+        for index, (input_file, output_file) in enumerate(jobs):
+            emit(_run_job(convert, index, input_file, output_file, args))
+        return results
+
+    logger.info(f"Converting {total} files with {workers} workers...")
+    finished = {}
+    next_index = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(cancel, logsetup.worker_config())) as executor:
+        futures = {
+            executor.submit(_run_job, convert, index, input_file, output_file, args,
+                            tracer is not None): index
+            for index, (input_file, output_file) in enumerate(jobs)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                finished[index] = future.result()
+            except Exception as e:
+                # The worker process itself died (e.g. BrokenProcessPool)
+                input_file, output_file = jobs[index]
+                finished[index] = JobResult(index, input_file, output_file, False, str(e))
+            # Release results in order so progress is reported sequentially
+            while next_index in finished:
+                emit(finished.pop(next_index))
+                next_index += 1
+
+    return results
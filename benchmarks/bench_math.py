@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark: single-pass math scanner vs. the original preprocess_math regexes
+
+Usage:
+    python benchmarks/bench_math.py            # 1, 4 and 16 MB inputs
+    python benchmarks/bench_math.py --sizes 8 --repeat 5
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mathscan import scan_math
+
+
+def legacy_preprocess_math(text):
+    """The two-pass regex implementation that scan_math replaced"""
+    text = re.sub(r'\$\$(.*?)\$\$', r'<div class="math">\1</div>', text, flags=re.DOTALL)
+    text = re.sub(r'\$(.*?)\$', r'<span class="math inline">\1</span>', text)
+    return text
+
+
+PARAGRAPHS = [
+    "The integral $\\int_0^1 x^2 dx = \\frac{1}{3}$ converges and $f(z) = e^{iz}$ is entire.\n\n",
+    "$$\n\\oint_C f(z) dz = 2\\pi i \\sum \\operatorname{Res}(f, z_k)\n$$\n\n",
+    "Revenue grew from $5 to $12 per unit, while costs stayed near $3.\n\n",
+    "Use `price = $total` in code, and escape a literal \\$ sign.\n\n",
+    "```python\nfor row in rows:\n    print(f\"${row.amount}\")\n```\n\n",
+    "复分析例题：计算 $\\frac{\\cos x}{x^2 + 1}$ 的积分，结果为 $\\frac{\\pi}{e}$。\n\n",
+]
+
+# Unbalanced dollars that make the lazy patterns rescan to the end of the line
+UNBALANCED = "Totals: $1 $2 $3 $4 $5 $6 $7 $8 $9 $10 " * 20 + "\n\n"
+
+
+def make_corpus(size_bytes, seed=0, unbalanced_ratio=0.1):
+    """Build a Markdown document of roughly `size_bytes` with many dollar signs"""
+    rng = random.Random(seed)
+    parts = []
+    total = 0
+    while total < size_bytes:
+        if rng.random() < unbalanced_ratio:
+            chunk = UNBALANCED
+        else:
+            chunk = rng.choice(PARAGRAPHS)
+        parts.append(chunk)
+        total += len(chunk.encode('utf-8'))
+    # A single stray $$ near the start forces the DOTALL pattern to scan far ahead
+    parts.insert(1, "Stray display delimiter $$ without a partner.\n\n")
+    return ''.join(parts)
+
+
+def best_time(func, text, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 4, 16], help='Input sizes in MB')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement (best is reported)')
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'legacy regex':>14} {'scan_math':>14} {'speedup':>8}")
+    for size_mb in args.sizes:
+        text = make_corpus(int(size_mb * 1024 * 1024))
+        mb = len(text.encode('utf-8')) / (1024 * 1024)
+        legacy = best_time(legacy_preprocess_math, text, args.repeat)
+        scanner = best_time(scan_math, text, args.repeat)
+        print(f"{mb:6.1f}MB {mb / legacy:10.1f}MB/s {mb / scanner:10.1f}MB/s {legacy / scanner:7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
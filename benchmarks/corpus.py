@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic Markdown corpus for benchmarks
+
+Generates reproducible documents with configurable size, math density, tables,
+code blocks, CJK text and images (small PNGs written next to the documents).
+
+Usage:
+    python benchmarks/corpus.py out_dir --docs 20 --size-kb 64 --math 0.5 --cjk 0.3
+"""
+
+import os
+import zlib
+import random
+import struct
+import argparse
+from collections import namedtuple
+
+CorpusSpec = namedtuple('CorpusSpec', [
+    'docs',          # number of documents
+    'size_kb',       # approximate size of each document
+    'math',          # probability that a paragraph contains formulas
+    'display_math',  # probability of a display formula after a paragraph
+    'table_rows',    # rows per table (0 disables tables)
+    'table_cols',    # columns per table
+    'code',          # probability of a fenced code block after a paragraph
+    'cjk',           # share of paragraphs written in Chinese
+    'images',        # images per document
+    'seed',
+])
+
+DEFAULT_SPEC = CorpusSpec(docs=10, size_kb=32, math=0.4, display_math=0.15, table_rows=8,
+                          table_cols=4, code=0.1, cjk=0.3, images=2, seed=42)
+
+LATIN_WORDS = ('integral converges residue contour analytic function series bound '
+               'estimate regression matrix vector kernel sample variance model').split()
+CJK_TEXT = '本题利用复变函数留数定理将实轴上的无穷积分转化为复平面上的闭合回路积分通过求解极点留数验证大弧积分收敛性最终取实部得到结果'
+INLINE_FORMULAS = [
+    r'\int_{-\infty}^{\infty} \frac{\cos x}{x^2 + 1} dx',
+    r'f(z) = \frac{e^{iz}}{z^2 + 1}',
+    r'\operatorname{Res}(f, i) = \frac{e^{-1}}{2i}',
+    r'\sum_{k=1}^{n} k^2 = \frac{n(n+1)(2n+1)}{6}',
+    r'\hat{\beta} = (X^T X)^{-1} X^T y',
+]
+DISPLAY_FORMULAS = [
+    r'\oint_{C} f(z) dz = 2\pi i \cdot \operatorname{Res}(f, i) = \pi e^{-1}',
+    r'\left|\int_{C_R} f(z) dz\right| \leq \pi R \cdot \frac{1}{R^2 - 1} \to 0',
+    r'\mathbb{E}[X] = \int_{\Omega} X \, d\mathbb{P}',
+]
+CODE_BLOCKS = [
+    ('python', 'def residue(f, z0):\n    return limit((z - z0) * f(z), z, z0)\n'),
+    ('bash', 'pandoc input.md -o output.pdf --pdf-engine=pdflatex\n'),
+    ('c', 'for (int i = 0; i < n; i++) {\n    sum += a[i] * b[i];\n}\n'),
+]
+
+
+def make_png(width, height, seed):
+    """A small RGB gradient PNG, built without third-party libraries"""
+    rng = random.Random(seed)
+    base = [rng.randrange(256) for _ in range(3)]
+    rows = []
+    for y in range(height):
+        row = bytearray([0])  # filter type: None
+        for x in range(width):
+            row += bytes(((base[0] + x) % 256, (base[1] + y) % 256, (base[2] + x + y) % 256))
+        rows.append(bytes(row))
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(b''.join(rows))) + chunk(b'IEND', b''))
+
+
+def _paragraph(rng, spec):
+    if rng.random() < spec.cjk:
+        start = rng.randrange(len(CJK_TEXT) // 2)
+        text = CJK_TEXT[start:] + CJK_TEXT[:start]
+    else:
+        text = ' '.join(rng.choice(LATIN_WORDS) for _ in range(rng.randint(30, 70))).capitalize() + '.'
+    if rng.random() < spec.math:
+        for _ in range(rng.randint(1, 3)):
+            words = text.split(' ')
+            pos = rng.randrange(len(words))
+            words.insert(pos, f'${rng.choice(INLINE_FORMULAS)}$')
+            text = ' '.join(words)
+    return text + '\n\n'
+
+
+def _table(rng, spec):
+    header = '| ' + ' | '.join(f'Col {c + 1}' for c in range(spec.table_cols)) + ' |\n'
+    rule = '|' + '---|' * spec.table_cols + '\n'
+    rows = ''.join(
+        '| ' + ' | '.join(f'{rng.random() * 100:.2f}' for _ in range(spec.table_cols)) + ' |\n'
+        for _ in range(spec.table_rows)
+    )
+    return header + rule + rows + '\n'
+
+
+def make_document(index, spec, image_names=()):
+    """Build the Markdown text of one document"""
+    rng = random.Random(spec.seed * 100003 + index)
+    parts = [f'# Document {index + 1}\n\n']
+    size = 0
+    target = spec.size_kb * 1024
+    section = 0
+    images = list(image_names)
+    while size < target:
+        if size >= section * target / 4:
+            section += 1
+            parts.append(f'## Section {section}\n\n')
+        part = _paragraph(rng, spec)
+        if rng.random() < spec.display_math:
+            part += f'$$\n{rng.choice(DISPLAY_FORMULAS)}\n$$\n\n'
+        if rng.random() < spec.code:
+            lang, code = rng.choice(CODE_BLOCKS)
+            part += f'```{lang}\n{code}```\n\n'
+        if spec.table_rows and rng.random() < 0.05:
+            part += _table(rng, spec)
+        if images and rng.random() < 0.1:
+            part += f'![figure]({images.pop()})\n\n'
+        parts.append(part)
+        size += len(part.encode('utf-8'))
+    for name in images:
+        parts.append(f'![figure]({name})\n\n')
+    return ''.join(parts)
+
+
+def generate(out_dir, spec=DEFAULT_SPEC):
+    """Write the corpus to out_dir and return the list of Markdown paths"""
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for index in range(spec.docs):
+        image_names = []
+        for i in range(spec.images):
+            name = f'doc{index:04d}-img{i}.png'
+            with open(os.path.join(out_dir, name), 'wb') as f:
+                f.write(make_png(320, 200, spec.seed + index * 31 + i))
+            image_names.append(name)
+        path = os.path.join(out_dir, f'doc{index:04d}.md')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(make_document(index, spec, image_names))
+        paths.append(path)
+    return paths
+
+
+def add_arguments(parser):
+    """Corpus options shared with the benchmark runner"""
+    d = DEFAULT_SPEC
+    parser.add_argument('--docs', type=int, default=d.docs, help=f'Number of documents (default: {d.docs})')
+    parser.add_argument('--size-kb', type=int, default=d.size_kb, help=f'Size of each document in KB (default: {d.size_kb})')
+    parser.add_argument('--math', type=float, default=d.math, help=f'Share of paragraphs with inline math (default: {d.math})')
+    parser.add_argument('--display-math', type=float, default=d.display_math, help=f'Display formula probability (default: {d.display_math})')
+    parser.add_argument('--table-rows', type=int, default=d.table_rows, help=f'Rows per table, 0 disables tables (default: {d.table_rows})')
+    parser.add_argument('--table-cols', type=int, default=d.table_cols, help=f'Columns per table (default: {d.table_cols})')
+    parser.add_argument('--code', type=float, default=d.code, help=f'Code block probability (default: {d.code})')
+    parser.add_argument('--cjk', type=float, default=d.cjk, help=f'Share of Chinese paragraphs (default: {d.cjk})')
+    parser.add_argument('--images', type=int, default=d.images, help=f'Images per document (default: {d.images})')
+    parser.add_argument('--seed', type=int, default=d.seed, help=f'Random seed (default: {d.seed})')
+
+
+def spec_from_args(args):
+    return CorpusSpec(args.docs, args.size_kb, args.math, args.display_math, args.table_rows,
+                      args.table_cols, args.code, args.cjk, args.images, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('out_dir', help='Directory to write the corpus into')
+    add_arguments(parser)
+    args = parser.parse_args()
+    paths = generate(args.out_dir, spec_from_args(args))
+    print(f"Wrote {len(paths)} documents to {args.out_dir}")
+
+
+if __name__ == '__main__':
+    main()
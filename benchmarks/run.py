@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark harness for both conversion engines
+
+Generates a synthetic corpus, converts it with each engine and records per-stage
+wall time, CPU time (own and subprocess) and peak RSS to JSON. Every engine runs
+in a fresh interpreter so peak RSS is not shared between engines. Engines whose
+tools are not installed are reported as skipped; engines that crash or fail to
+convert a document are reported as errors, and `compare` flags an engine that
+worked in the baseline but errors now as a regression.
+
+Engines:
+    markdown    read, math preprocessing and Markdown only (needs: markdown)
+    weasyprint  converter.py pipeline incl. layout and PDF writing (needs: weasyprint)
+    pandoc      md2pdf.convert_md_to_pdf, i.e. pandoc + pdflatex (needs: pandoc, pdflatex);
+                stages are the ones md2pdf records through profiling.stage
+
+Usage:
+    python benchmarks/run.py run -o results.json --docs 20 --size-kb 64
+    python benchmarks/run.py compare baseline.json results.json --threshold 0.10
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import corpus
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ENGINES = ['markdown', 'weasyprint', 'pandoc']
+
+
+class SkipEngine(Exception):
+    """Raised when an engine's tools are not installed"""
+
+
+def _rss_mb(who):
+    """Peak RSS in MB for RUSAGE_SELF / RUSAGE_CHILDREN (None without `resource`)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _children_cpu():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class StageRecorder:
+    """Accumulates wall/CPU time per stage over all documents"""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        child = _children_cpu()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'child_cpu': 0.0})
+            entry['wall'] += time.perf_counter() - wall
+            entry['cpu'] += time.process_time() - cpu
+            entry['child_cpu'] += _children_cpu() - child
+
+    def add(self, name, wall, cpu, child_cpu):
+        """Account a stage measured elsewhere (e.g. a profiling record)"""
+        entry = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'child_cpu': 0.0})
+        entry['wall'] += wall
+        entry['cpu'] += cpu
+        entry['child_cpu'] += child_cpu
+
+
+def _front_end(recorder, path):
+    """Stages shared by the markdown and weasyprint engines; returns body HTML"""
+    import markdown
+    from mathscan import scan_math, restore_math
+    from mathrender import render_math
+
+    with recorder.stage('read'):
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    with recorder.stage('preprocess_math'):
+        text, formulas = scan_math(text)
+    with recorder.stage('markdown'):
+        html = markdown.markdown(text, extensions=['tables', 'fenced_code'])
+    with recorder.stage('restore_math'):
+        html = restore_math(html, formulas, render=render_math)
+    return html
+
+
+def bench_markdown(recorder, paths, out_dir):
+    try:
+        import markdown  # noqa: F401
+    except ImportError:
+        raise SkipEngine('markdown is not installed')
+    for path in paths:
+        _front_end(recorder, path)
+
+
+def bench_weasyprint(recorder, paths, out_dir):
+    try:
+        import converter
+        from weasyprint import HTML
+    except (ImportError, OSError) as e:
+        # OSError: WeasyPrint installed but Pango/GObject libraries are missing
+        raise SkipEngine(f'weasyprint unavailable: {e}')
+    for path in paths:
+        body = _front_end(recorder, path)
+        with recorder.stage('html_assembly'):
+            style = f"<style>\n{converter.DEFAULT_CSS}</style>"
+            page = converter.HTML_TEMPLATE.format(style=style, html=body)
+        with recorder.stage('layout'):
+            document = HTML(string=page, base_url=os.path.dirname(path)).render()
+        with recorder.stage('write_pdf'):
+            document.write_pdf(os.path.join(out_dir, os.path.basename(path) + '.pdf'))
+
+
+def bench_pandoc(recorder, paths, out_dir):
+    missing = [tool for tool in ('pandoc', 'pdflatex') if shutil.which(tool) is None]
+    if missing:
+        raise SkipEngine(f"not installed: {', '.join(missing)}")
+    import md2pdf
+    import profiling
+    main_thread = threading.get_ident()
+    for path in paths:
+        pdf_file = os.path.join(out_dir, os.path.basename(path) + '.pdf')
+        # md2pdf's own stages (pandoc_parse, highlight, pandoc_pdf, ...)
+        profiling.start_tracing(trace_memory=False)
+        try:
+            success = md2pdf.convert_md_to_pdf(path, pdf_file, use_cache=False)
+        finally:
+            tracer = profiling.stop_tracing()
+        # An HTML fallback counts as success for md2pdf, not for the benchmark
+        if not success or not os.path.exists(pdf_file):
+            raise RuntimeError(f'pandoc failed to convert {os.path.basename(path)}')
+        for record in tracer.records:
+            # Stages directly under 'convert'; formats are emitted in worker threads
+            top = 1 if record['tid'] == main_thread else 0
+            if record['depth'] == top and record['name'] != 'convert':
+                recorder.add(record['name'], record['wall'], record['cpu'], record['child_cpu'])
+
+
+BENCHMARKS = {
+    'markdown': bench_markdown,
+    'weasyprint': bench_weasyprint,
+    'pandoc': bench_pandoc,
+}
+
+
+def run_engine(engine, corpus_dir):
+    """Run one engine in this process and return its result dict"""
+    paths = sorted(os.path.join(corpus_dir, name) for name in os.listdir(corpus_dir) if name.endswith('.md'))
+    recorder = StageRecorder()
+    with tempfile.TemporaryDirectory(prefix='md2pdf-bench-out-') as out_dir:
+        # Cold caches: formula and output caches start empty for every engine
+        os.environ['MD2PDF_CACHE_DIR'] = os.path.join(out_dir, 'cache')
+        start = time.perf_counter()
+        try:
+            BENCHMARKS[engine](recorder, paths, out_dir)
+        except SkipEngine as e:
+            return {'skipped': str(e)}
+        wall = time.perf_counter() - start
+
+    totals = {key: sum(stage[key] for stage in recorder.stages.values()) for key in ('cpu', 'child_cpu')}
+    return {
+        'documents': len(paths),
+        'stages': recorder.stages,
+        'total': {'wall': wall, **totals},
+        'peak_rss_mb': _rss_mb(resource.RUSAGE_SELF) if resource else None,
+        'children_peak_rss_mb': _rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+    }
+
+
+def _run_isolated(engine, corpus_dir):
+    """Run an engine in a fresh interpreter so its peak RSS is measured alone"""
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '_engine', engine, corpus_dir],
+        capture_output=True, text=True, encoding='utf-8'
+    )
+    if proc.returncode != 0:
+        last = proc.stderr.strip().splitlines()[-1:]
+        return {'error': f'benchmark crashed: {last[0] if last else f"exit status {proc.returncode}"}'}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def _best(runs):
+    """Best run by total wall time; skipped and failed results pass through"""
+    done = [r for r in runs if 'skipped' not in r and 'error' not in r]
+    if not done:
+        return runs[0]
+    return min(done, key=lambda r: r['total']['wall'])
+
+
+def cmd_run(args):
+    spec = corpus.spec_from_args(args)
+    engines = args.engines.split(',') if args.engines else ENGINES
+    unknown = set(engines) - set(ENGINES)
+    if unknown:
+        sys.exit(f"Unknown engine(s): {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory(prefix='md2pdf-bench-corpus-') as corpus_dir:
+        corpus.generate(corpus_dir, spec)
+        results = {}
+        for engine in engines:
+            print(f"Running {engine}...", file=sys.stderr)
+            results[engine] = _best([_run_isolated(engine, corpus_dir) for _ in range(args.repeat)])
+            if 'skipped' in results[engine]:
+                print(f"  skipped: {results[engine]['skipped']}", file=sys.stderr)
+            elif 'error' in results[engine]:
+                print(f"  error: {results[engine]['error']}", file=sys.stderr)
+            else:
+                total = results[engine]['total']
+                print(f"  wall {total['wall']:.3f}s  cpu {total['cpu']:.3f}s  "
+                      f"subprocess cpu {total['child_cpu']:.3f}s", file=sys.stderr)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': args.repeat,
+        },
+        'corpus': spec._asdict(),
+        'engines': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+
+def compare(baseline, current, threshold, min_delta):
+    """Return a list of (engine, metric, base, cur) regressions
+
+    An engine that ran in the baseline but errors now is reported with
+    metric 'error' and the error message as cur.
+    """
+    regressions = []
+    for engine, cur in current['engines'].items():
+        base = baseline['engines'].get(engine)
+        if not base or 'skipped' in base or 'error' in base or 'skipped' in cur:
+            continue
+        if 'error' in cur:
+            regressions.append((engine, 'error', None, cur['error']))
+            continue
+        metrics = [(f"total.{k}", base['total'][k], cur['total'][k]) for k in ('wall', 'cpu', 'child_cpu')]
+        for stage, values in cur['stages'].items():
+            if stage in base['stages']:
+                metrics.append((f"{stage}.wall", base['stages'][stage]['wall'], values['wall']))
+        for name, b, c in metrics:
+            if c > b * (1 + threshold) and c - b > min_delta:
+                regressions.append((engine, name, b, c))
+        b, c = base.get('peak_rss_mb'), cur.get('peak_rss_mb')
+        if b and c and c > b * (1 + threshold):
+            regressions.append((engine, 'peak_rss_mb', b, c))
+    return regressions
+
+
+def cmd_compare(args):
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.current, 'r', encoding='utf-8') as f:
+        current = json.load(f)
+    if baseline.get('corpus') != current.get('corpus'):
+        print("⚠ Corpus parameters differ; results may not be comparable", file=sys.stderr)
+
+    regressions = compare(baseline, current, args.threshold, args.min_delta)
+    if not regressions:
+        print(f"No regressions above {args.threshold:.0%}")
+        return 0
+    print(f"{'engine':<12} {'metric':<28} {'baseline':>10} {'current':>10} {'change':>8}")
+    for engine, name, b, c in regressions:
+        if name == 'error':
+            print(f"{engine:<12} {'error':<28} {'ok':>10} {'failed':>10}  {c}")
+            continue
+        print(f"{engine:<12} {name:<28} {b:10.3f} {c:10.3f} {c / b - 1:+7.0%}")
+    return 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run', help='Generate a corpus and benchmark the engines')
+    run_parser.add_argument('-o', '--output', default='bench_results.json', help='JSON output file')
+    run_parser.add_argument('--engines', help=f"Comma-separated subset of: {','.join(ENGINES)}")
+    run_parser.add_argument('--repeat', type=int, default=1, help='Runs per engine; the fastest is kept')
+    corpus.add_arguments(run_parser)
+
+    compare_parser = sub.add_parser('compare', help='Flag regressions against a stored baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.10, help='Allowed slowdown (default: 0.10)')
+    compare_parser.add_argument('--min-delta', type=float, default=0.01,
+                                help='Ignore differences below this many seconds (default: 0.01)')
+
+    engine_parser = sub.add_parser('_engine')  # internal: one isolated engine run
+    engine_parser.add_argument('engine', choices=ENGINES)
+    engine_parser.add_argument('corpus_dir')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        cmd_run(args)
+    elif args.command == 'compare':
+        sys.exit(cmd_compare(args))
+    else:
+        print(json.dumps(run_engine(args.engine, args.corpus_dir)))
+
+
+if __name__ == '__main__':
+    main()
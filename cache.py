@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-addressed output cache
+Stores finished PDF/HTML outputs keyed by a hash of everything that affects them
+(input bytes, resolved command line or template, tool versions) and restores them
+by hardlink or copy when the same conversion is requested again.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import collections
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+# Default size limit of the cache (override with MD2PDF_CACHE_SIZE, in MB)
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+META_FILE = 'meta.json'
+# Running estimate of the size of all entries, so a store does not have to walk the cache
+USAGE_FILE = 'usage.json'
+# Eviction frees space down to this fraction of the limit, so it does not run on every store
+EVICT_TARGET = 0.9
+
+
+def default_cache_dir():
+    """Per-user cache directory (override with MD2PDF_CACHE_DIR)"""
+    if os.environ.get('MD2PDF_CACHE_DIR'):
+        return os.environ['MD2PDF_CACHE_DIR']
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'md2pdf')
+
+
+def tool_fingerprint(name):
+    """Identify an installed tool by its resolved path, size and mtime.
+
+    This changes whenever the binary is upgraded, without spawning it.
+    """
+    path = shutil.which(name)
+    if path is None:
+        return f"{name}:missing"
+    try:
+        st = os.stat(path)
+    except OSError:
+        return f"{name}:{path}"
+    return f"{name}:{path}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def make_key(*parts):
+    """Hash key parts (str or bytes) into a cache key"""
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        # Length prefix keeps ('ab', 'c') and ('a', 'bc') apart
+        h.update(str(len(part)).encode('ascii') + b':')
+        h.update(part)
+    return h.hexdigest()
+
+
+def file_digest(path):
+    """SHA-256 of a file's content, read in blocks"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def is_within(path, root):
+    """True if path lies inside the directory root (after resolving symlinks)"""
+    path = os.path.normcase(os.path.realpath(path))
+    root = os.path.normcase(os.path.realpath(root))
+    try:
+        return os.path.commonpath([path, root]) == root
+    except ValueError:
+        # Different drives on Windows
+        return False
+
+
+def release_output(path):
+    """Unlink an output that is hardlinked into the cache before it is rewritten.
+
+    Tools write outputs in place, which would otherwise corrupt the cached copy.
+    """
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+def prune_files(root, max_bytes):
+    """Delete the least recently used files under root until they fit in max_bytes.
+
+    For flat file caches (font subsets, images) whose users touch a file on every hit.
+    """
+    entries = []
+    for parent, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(parent, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def _env_size(name, default):
+    """Size in bytes from an environment variable given in MB"""
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(float(value) * 1024 * 1024)
+    except ValueError:
+        logger.warning(f"⚠ Ignoring invalid {name}={value!r}")
+        return default
+
+
+class FileLock:
+    """Exclusive lock on a file, held across processes (fcntl/msvcrt).
+
+    Not reentrant: a second FileLock on the same path blocks even in the same
+    thread. A lock file that is deleted while waiting (e.g. its directory was
+    pruned) is recreated and locked again.
+    """
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def _try_lock(self, f):
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def acquire(self, blocking=True):
+        """Take the lock; with blocking=False return False instead of waiting"""
+        while True:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            f = open(self.path, 'a+b')
+            while not self._try_lock(f):
+                if not blocking:
+                    f.close()
+                    return False
+                time.sleep(self.POLL_INTERVAL)
+            try:
+                current = os.stat(self.path).st_ino == os.fstat(f.fileno()).st_ino
+            except OSError:
+                current = False
+            # st_ino is 0 where it is not supported; the check then always passes
+            if current:
+                self._file = f
+                return True
+            f.close()
+
+    def release(self):
+        f, self._file = self._file, None
+        if f is not None:
+            if fcntl is None:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            f.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class LRUDict:
+    """Thread-safe mapping that keeps only the max_entries most recently used items"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class OutputCache:
+    """On-disk cache of conversion outputs with size-based LRU eviction"""
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or default_cache_dir()
+        if max_bytes is None:
+            max_bytes = _env_size('MD2PDF_CACHE_SIZE', DEFAULT_MAX_BYTES)
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(self.root, 'objects')
+        self.usage_path = os.path.join(self.objects_dir, USAGE_FILE)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.objects_dir, key[:2], key)
+
+    def fetch(self, key, outputs):
+        """Restore cached outputs for `key`.
+
+        `outputs` maps a role name ('pdf', 'html', ...) to the destination path.
+        Returns the stored metadata dict on a hit, None on a miss.
+        """
+        entry = self._entry_dir(key)
+        meta_path = os.path.join(entry, META_FILE)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        files = meta.get('files', {})
+        if any(role not in files for role in outputs):
+            return None
+
+        try:
+            for role, dest in outputs.items():
+                src = os.path.join(entry, role)
+                # Outputs restored by hardlink share the inode; make sure nobody rewrote it
+                st = os.stat(src)
+                if st.st_size != files[role]['size']:
+                    raise ValueError(f"cached {role} was modified")
+                dest_dir = os.path.dirname(os.path.abspath(dest))
+                os.makedirs(dest_dir, exist_ok=True)
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                try:
+                    os.link(src, dest)
+                except OSError:
+                    shutil.copyfile(src, dest)
+            # Mark as recently used for LRU eviction
+            os.utime(meta_path)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Cache entry {key[:12]} unusable: {e}")
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+
+        logger.info(f"✓ Cache hit ({key[:12]})")
+        return meta
+
+    def store(self, key, outputs, meta=None):
+        """Copy finished outputs into the cache under `key`"""
+        entry = self._entry_dir(key)
+        if os.path.exists(os.path.join(entry, META_FILE)):
+            return
+
+        meta = dict(meta or {})
+        meta['files'] = {}
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            # Build the entry in a temp dir and rename it into place atomically,
+            # so concurrent batch workers never see a half-written entry
+            tmp = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(entry))
+            try:
+                for role, src in outputs.items():
+                    dest = os.path.join(tmp, role)
+                    shutil.copyfile(src, dest)
+                    meta['files'][role] = {'size': os.path.getsize(dest)}
+                with open(os.path.join(tmp, META_FILE), 'w', encoding='utf-8') as f:
+                    json.dump(meta, f)
+                size = sum(e.stat().st_size for e in os.scandir(tmp))
+                os.rename(tmp, entry)
+            except OSError:
+                shutil.rmtree(tmp, ignore_errors=True)
+                # Another process stored the same key first
+                if not os.path.exists(entry):
+                    raise
+                return
+        except OSError as e:
+            logger.warning(f"⚠ Could not write cache entry: {e}")
+            return
+
+        logger.debug(f"Stored cache entry {key[:12]}")
+        # The cache is only walked when the estimate says it is full
+        usage = self._read_usage()
+        if usage is None or usage + size > self.max_bytes:
+            self.evict()
+        else:
+            self._write_usage(usage + size)
+
+    def _read_usage(self):
+        try:
+            with open(self.usage_path, 'r', encoding='utf-8') as f:
+                return int(json.load(f)['bytes'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_usage(self, total):
+        # Concurrent stores may lose an update; the next full walk corrects the estimate
+        tmp = f"{self.usage_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'bytes': total}, f)
+            os.replace(tmp, self.usage_path)
+        except OSError as e:
+            logger.debug(f"Could not record cache usage: {e}")
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes.
+
+        Frees space down to EVICT_TARGET of the limit and records the
+        resulting size, so the next stores skip the walk.
+        """
+        entries = []
+        total = 0
+        try:
+            prefixes = os.listdir(self.objects_dir)
+        except OSError:
+            return
+        for prefix in prefixes:
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            try:
+                names = os.listdir(prefix_dir)
+            except OSError:
+                continue
+            for name in names:
+                if name.startswith('.tmp-'):
+                    continue
+                entry = os.path.join(prefix_dir, name)
+                try:
+                    used = os.stat(os.path.join(entry, META_FILE)).st_mtime
+                    size = sum(e.stat().st_size for e in os.scandir(entry))
+                except OSError:
+                    continue
+                entries.append((used, size, entry))
+                total += size
+
+        if total > self.max_bytes:
+            entries.sort()
+            target = self.max_bytes * EVICT_TARGET
+            for used, size, entry in entries:
+                if total <= target:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+                logger.debug(f"Evicted cache entry {os.path.basename(entry)[:12]}")
+        self._write_usage(total)
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+大文档分块并行渲染
+
+在顶级标题处把Markdown拆成若干块，每块在独立的工作进程中用WeasyPrint排版，
+最后用pypdf按顺序合并成一个PDF（书签合并）。
+每个进程只排版自己那一块，总耗时和单进程峰值内存都会下降。
+
+限制：每块从新的一页开始。各块单独排版，所以以下情况改为整篇渲染：
+- 页内链接（#锚点）或引用式链接的定义跨块
+- 样式表用 counter(page) / counter(pages) 输出页码（各块的页码会从1重新开始）
+"""
+
+import os
+import re
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import fonts
+import profiling
+from batch import default_workers
+
+logger = logging.getLogger(__name__)
+
+_HEADING_RE = re.compile(r'(#{1,6})[ \t]')
+_FENCE_RE = re.compile(r'[ \t]*(`{3,}|~{3,})')
+# 锚点（HTML元素的 id/name 属性）和指向锚点的链接
+ANCHOR_RE = re.compile(r'<[^>]*?\b(?:id|name)\s*=\s*["\']([^"\']+)["\']', re.I)
+LOCAL_LINK_RE = re.compile(
+    r'(\]\(\s*<?|\bhref\s*=\s*["\']|^[ ]{0,3}\[[^\]]+\]:\s*<?)#([^\s)"\'>]+)',
+    re.M | re.I
+)
+# 引用式链接的定义和方括号中的文字（可能是引用名）
+_REFERENCE_DEF_RE = re.compile(r'^[ ]{0,3}\[([^\]]+)\]:', re.M)
+_BRACKET_RE = re.compile(r'\[([^\[\]]+)\]')
+_PAGE_COUNTER_RE = re.compile(r'counter\(\s*pages?\s*\)')
+
+
+def split_sections(md_text):
+    """在顶级标题处拆分Markdown，返回各节文本列表
+
+    顶级标题指文档中出现的最高一级ATX标题（没有 # 时可能是 ##），
+    围栏代码块里的 # 不算标题。
+    """
+    lines = md_text.splitlines(keepends=True)
+    headings = []  # (行号, 级别)
+    fence = None
+    for i, line in enumerate(lines):
+        match = _FENCE_RE.match(line)
+        if fence is None:
+            if match:
+                fence = match.group(1)
+                continue
+            heading = _HEADING_RE.match(line)
+            if heading:
+                headings.append((i, len(heading.group(1))))
+        elif match and match.group(1)[0] == fence[0] and len(match.group(1)) >= len(fence) \
+                and not line.strip().strip(fence[0]):
+            fence = None
+
+    if not headings:
+        return [md_text]
+
+    top = min(level for _, level in headings)
+    starts = [i for i, level in headings if level == top]
+    if starts[0] != 0:
+        starts.insert(0, 0)
+    starts.append(len(lines))
+    return [''.join(lines[a:b]) for a, b in zip(starts, starts[1:]) if a < b]
+
+
+def _label(text):
+    """引用名不区分大小写，连续空白视为一个空格"""
+    return ' '.join(text.split()).lower()
+
+
+def cross_chunk_reference(chunks):
+    """各块单独排版时会失效的跨块引用；返回说明文字，没有时返回None"""
+    labels = {}
+    anchors = {}
+    for index, chunk in enumerate(chunks):
+        for label in _REFERENCE_DEF_RE.findall(chunk):
+            labels.setdefault(_label(label), index)
+        for anchor in ANCHOR_RE.findall(chunk):
+            anchors.setdefault(anchor, index)
+
+    for index, chunk in enumerate(chunks):
+        if labels:
+            for text in _BRACKET_RE.findall(chunk):
+                owner = labels.get(_label(text))
+                if owner is not None and owner != index:
+                    return f"引用式链接 [{text}] 的定义在另一块中"
+        if anchors:
+            for match in LOCAL_LINK_RE.finditer(chunk):
+                owner = anchors.get(match.group(2))
+                if owner is not None and owner != index:
+                    return f"链接 #{match.group(2)} 指向另一块中的锚点"
+    return None
+
+
+def group_sections(sections, count):
+    """按顺序把各节合并成约 count 块，每块的字符数尽量接近"""
+    if count >= len(sections):
+        return list(sections)
+    target = sum(len(s) for s in sections) / count
+    chunks = []
+    current = []
+    size = 0
+    for i, section in enumerate(sections):
+        current.append(section)
+        size += len(section)
+        remaining_sections = len(sections) - i - 1
+        remaining_chunks = count - len(chunks) - 1
+        if (size >= target and remaining_chunks > 0) or remaining_sections == remaining_chunks:
+            chunks.append(''.join(current))
+            current = []
+            size = 0
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
+
+def render_chunk(md_text, pdf_file, app_path, base_url, stylesheets=(), charset=None, shared_fonts=False,
+                 optimize_images=True):
+    """工作进程：把一块Markdown渲染为PDF，返回页数
+
+    同一工作进程处理的各块共享一个 ConverterSession。
+    shared_fonts: 各块使用同一个字体子集时，完整嵌入该子集（不再按块二次子集化），
+                  合并时相同的字体数据只保留一份
+    """
+    from converter import get_session
+
+    document = get_session(app_path, stylesheets, optimize_images).render(md_text, base_url, charset)
+    with profiling.stage('write_pdf'):
+        document.write_pdf(pdf_file, **(fonts.full_fonts_options() if shared_fonts else {}))
+    return len(document.pages)
+
+
+def _render_chunk_job(trace, *args):
+    """工作进程入口：返回 (页数, 阶段记录)，父进程未在跟踪时记录为None"""
+    tracer = profiling.start_tracing() if trace else None
+    try:
+        pages = render_chunk(*args)
+    finally:
+        if tracer is not None:
+            profiling.stop_tracing()
+    return pages, tracer.records if tracer is not None else None
+
+
+def render_chunks(executor, chunks, *iterables):
+    """在进程池中对每块执行 render_chunk，返回各块的页数
+
+    父进程正在跟踪时，工作进程的阶段记录合并到父进程的记录中（与批量转换相同）。
+    """
+    tracer = profiling.current_tracer()
+    results = list(executor.map(_render_chunk_job, [tracer is not None] * len(chunks), chunks, *iterables))
+    if tracer is not None:
+        for _, records in results:
+            tracer.merge(records)
+    return [pages for pages, _ in results]
+
+
+def merge_pdfs(pdf_files, output_file, dedupe=False):
+    """按顺序合并PDF，保留每个文件的书签
+
+    dedupe: 合并相同的对象（各块嵌入的相同字体只保留一份）
+    """
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    for pdf_file in pdf_files:
+        writer.append(pdf_file, import_outline=True)
+    if dedupe and hasattr(writer, 'compress_identical_objects'):
+        writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+    with open(output_file, 'wb') as f:
+        writer.write(f)
+    writer.close()
+
+    if dedupe:
+        before = sum(os.path.getsize(pdf_file) for pdf_file in pdf_files)
+        after = os.path.getsize(output_file)
+        logger.info(f"合并去重: {before / 1048576:.1f} MB → {after / 1048576:.1f} MB"
+                    f"（节省 {(before - after) / 1048576:.1f} MB）")
+
+
+def convert_chunked(md_text, pdf_file, app_path, workers=None, base_url=None, stylesheets=(), optimize_images=True):
+    """分块并行渲染md_text并合并为pdf_file，返回总页数"""
+    if workers is None:
+        workers = default_workers()
+
+    sections = split_sections(md_text)
+    # 块数略多于进程数，让先完成的进程继续领取任务，减少等待
+    chunks = group_sections(sections, max(1, workers * 2))
+    logger.info(f"分块渲染: {len(sections)} 节 → {len(chunks)} 块, {workers} 个进程")
+
+    try:
+        import pypdf  # noqa: F401
+    except ImportError:
+        logger.warning("⚠ 未安装pypdf，无法合并分块结果，改为整篇渲染（pip install pypdf）")
+        chunks = [md_text]
+
+    from converter import get_session
+    session = get_session(app_path, stylesheets, optimize_images)
+    if len(chunks) > 1:
+        reason = cross_chunk_reference(chunks)
+        if reason is None and any(_PAGE_COUNTER_RE.search(text) for _, text in session.sources):
+            reason = "样式表使用了页码计数器，分块后页码会从1重新开始"
+        if reason is not None:
+            logger.warning(f"⚠ {reason}，改为整篇渲染")
+            chunks = [md_text]
+
+    if len(chunks) == 1:
+        return render_chunk(chunks[0], pdf_file, app_path, base_url, stylesheets,
+                            optimize_images=optimize_images)
+
+    # 按整篇文档的字符生成一次字体子集，所有块共用
+    charset = ''.join(set(md_text))
+    shared_fonts = session.font_subset(charset) is not None
+
+    with tempfile.TemporaryDirectory(prefix='md2pdf-chunks-') as tmp:
+        chunk_files = [os.path.join(tmp, f'chunk-{i:04d}.pdf') for i in range(len(chunks))]
+        with profiling.stage('render_chunks', chunks=len(chunks)):
+            with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+                page_counts = render_chunks(
+                    executor,
+                    chunks,
+                    chunk_files,
+                    [app_path] * len(chunks),
+                    [base_url] * len(chunks),
+                    [stylesheets] * len(chunks),
+                    [charset] * len(chunks),
+                    [shared_fonts] * len(chunks),
+                    [optimize_images] * len(chunks),
+                )
+        with profiling.stage('merge_pdf'):
+            merge_pdfs(chunk_files, pdf_file, dedupe=shared_fonts)
+
+    return sum(page_counts)
@@ -6,93 +6,452 @@ Created on Thu Jan 15 19:33:29 2026
 """
 
 import markdown
-import re
 import os
-from weasyprint import HTML, CSS
+import logging
+import threading
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+import weasyprint
+from weasyprint import HTML, CSS, default_url_fetcher
+try:
+    from weasyprint.text.fonts import FontConfiguration
+except ImportError:  # WeasyPrint < 53
+    from weasyprint.fonts import FontConfiguration
 
-def preprocess_math(text):
-    """预处理LaTeX数学公式，转换为MathJax兼容格式"""
-    # 处理块级公式 $$...$$
-    text = re.sub(r'\$\$(.*?)\$\$', r'<div class="math">\1</div>', text, flags=re.DOTALL)
-    # 处理行内公式 $...$
-    text = re.sub(r'\$(.*?)\$', r'<span class="math inline">\1</span>', text)
-    return text
-
-def md_to_html(md_text, mathjax_path):
-    """将Markdown转换为HTML，支持数学公式"""
-    # 预处理数学公式
-    md_text = preprocess_math(md_text)
-    
-    # 转换Markdown
-    html = markdown.markdown(md_text, extensions=['tables', 'fenced_code'])
-    
-    # 构建完整的HTML
-    full_html = f"""
+from cache import OutputCache, make_key, file_digest, release_output, is_within
+from mathscan import scan_math, restore_math
+from mathrender import get_renderer, render_math
+from highlight import get_highlighter, highlight_html
+import profiling
+import fonts
+import images
+from treebuild import references_key
+
+logger = logging.getLogger(__name__)
+
+# Markdown扩展列表
+MD_EXTENSIONS = ['tables', 'fenced_code']
+
+# 超过该大小（字节）且没有引用式链接定义的文件默认使用流式转换
+STREAMING_THRESHOLD = 32 * 1024 * 1024
+
+# 字体子集变化时才重新编译样式；@font-face 规则无法从 FontConfiguration 中删除，
+# 编译这么多次后换用新的 FontConfiguration，避免规则越积越多
+FONT_CONFIG_MAX_COMPILES = 16
+
+# HTML生成逻辑的版本号，修改生成逻辑时递增，使旧的缓存结果失效
+RENDER_VERSION = '7'
+
+# 默认样式表
+DEFAULT_CSS = """body { font-family: Arial, sans-serif; line-height: 1.6; margin: 40px; }
+h1, h2, h3, h4, h5, h6 {
+    margin-top: 24px;
+    margin-bottom: 16px;
+    page-break-after: avoid;
+}
+.math {
+    text-align: center;
+    margin: 1em 0;
+    font-size: 1.2em;
+}
+.math.inline {
+    display: inline;
+    text-align: left;
+}
+.math-svg {
+    max-width: 100%;
+}
+img {
+    max-width: 100%;
+}
+code {
+    background-color: #f4f4f4;
+    padding: 2px 4px;
+    border-radius: 3px;
+}
+pre {
+    background-color: #f4f4f4;
+    padding: 10px;
+    border-radius: 5px;
+    overflow-x: auto;
+}
+table {
+    border-collapse: collapse;
+    width: 100%;
+    margin: 1em 0;
+}
+th, td {
+    border: 1px solid #ddd;
+    padding: 8px;
+    text-align: left;
+}
+th { background-color: #f2f2f2; }
+"""
+
+# 完整HTML页面模板（{style} 处填入样式，{html} 处填入正文）
+HTML_TEMPLATE = """
     <!DOCTYPE html>
     <html>
     <head>
         <meta charset="utf-8">
-        <style>
-            body {{ font-family: Arial, sans-serif; line-height: 1.6; margin: 40px; }}
-            h1, h2, h3, h4, h5, h6 {{ 
-                margin-top: 24px; 
-                margin-bottom: 16px;
-                page-break-after: avoid;
-            }}
-            .math {{ 
-                text-align: center; 
-                margin: 1em 0;
-                font-size: 1.2em;
-            }}
-            .math.inline {{ 
-                display: inline; 
-                text-align: left;
-            }}
-            code {{ 
-                background-color: #f4f4f4; 
-                padding: 2px 4px; 
-                border-radius: 3px;
-            }}
-            pre {{ 
-                background-color: #f4f4f4; 
-                padding: 10px; 
-                border-radius: 5px;
-                overflow-x: auto;
-            }}
-            table {{ 
-                border-collapse: collapse; 
-                width: 100%; 
-                margin: 1em 0;
-            }}
-            th, td {{ 
-                border: 1px solid #ddd; 
-                padding: 8px; 
-                text-align: left;
-            }}
-            th {{ background-color: #f2f2f2; }}
-        </style>
+        {style}
     </head>
     <body>
         {html}
     </body>
     </html>
     """
+
+def preprocess_math(text):
+    """预处理LaTeX数学公式，转换为MathJax兼容格式"""
+    # 单遍扫描识别 $$...$$ 和 $...$，跳过代码块和行内代码
+    text, formulas = scan_math(text)
+    return restore_math(text, formulas)
+
+def md_to_html(md_text, mathjax_path, md=None, inline_css=True):
+    """将Markdown转换为HTML，支持数学公式
+
+    md: 可复用的 markdown.Markdown 实例（常驻服务使用），为None时每次新建
+    inline_css: 是否把默认样式内嵌到HTML；已单独预编译CSS时传False
+    """
+    # 预处理数学公式：先替换为占位符，避免Markdown改写公式中的 _ 和 *
+    with profiling.stage('preprocess_math'):
+        md_text, formulas = scan_math(md_text)
+    
+    # 转换Markdown
+    with profiling.stage('markdown'):
+        if md is None:
+            html = markdown.markdown(md_text, extensions=MD_EXTENSIONS)
+        else:
+            md.reset()
+            html = md.convert(md_text)
+    
+    # 还原数学公式（离线渲染为SVG，相同公式只渲染一次）
+    with profiling.stage('render_math', formulas=len(formulas)):
+        html = restore_math(html, formulas, render=render_math)
+    
+    # 代码块语法高亮（按代码内容缓存，相同代码块只着色一次）
+    with profiling.stage('highlight'):
+        html = highlight_html(html)
+    
+    # 构建完整的HTML
+    with profiling.stage('html_assembly'):
+        style = f"<style>\n{DEFAULT_CSS}{get_highlighter().css()}</style>" if inline_css else ""
+        full_html = HTML_TEMPLATE.format(style=style, html=html)
     return full_html
 
-def convert_md_to_pdf(md_file, pdf_file, app_path):
-    """主转换函数"""
-    try:
-        # 读取Markdown文件
-        with open(md_file, 'r', encoding='utf-8') as f:
-            md_content = f.read()
-        
-        # 转换为HTML
-        html_content = md_to_html(md_content, app_path)
+class ConverterSession:
+    """可复用的转换会话
+
+    Markdown处理器、编译好的CSS（默认样式、styles.css和用户样式表）以及
+    字体配置只构建一次，之后的每篇文档都复用它们。批量转换时在同一进程中
+    使用一个会话，比每篇文档都重新初始化快得多。
+    styles.css 或用户样式表的修改时间、大小变化后，样式在下一次使用时重新编译。
+    """
+    
+    def __init__(self, app_path=None, stylesheets=(), subset_fonts=True, optimize_images=True, allow_file=None):
+        self.app_path = app_path
+        # allow_file(path) -> bool 限制文档能读取的本地文件（常驻服务使用），为None时不限制
+        self.allow_file = allow_file
+        self.md = markdown.Markdown(extensions=MD_EXTENSIONS)
+        self.font_config = FontConfiguration()
+        # 中文字体子集化：样式表请求的中文字体替换为子集。会话只保留一个子集，
+        # 遇到子集中没有的字符时扩充它，之后的文档复用同一组 @font-face 和样式表
+        self.fonts = fonts.get_manager() if subset_fonts else None
+        if self.fonts is not None:
+            # 在后台建立系统字体索引，第一篇文档不必等待扫描字体目录
+            self.fonts.preload()
+        self._font_compiles = 0
         
-        # 转换为PDF
-        HTML(string=html_content).write_pdf(pdf_file)
+        # 样式表按顺序叠加：默认样式 < 代码高亮 < styles.css < 用户样式表
+        self._style_files = [os.path.join(app_path or os.path.dirname(os.path.abspath(__file__)), 'styles.css')]
+        self._style_files += list(stylesheets)
+        self._load_styles(self._style_signature())
         
+        # 缩小并重新压缩文档中的图片（结果按内容缓存）
+        self.images = images.get_optimizer() if optimize_images else None
+
+        # Markdown实例和WeasyPrint的字体状态都不是线程安全的
+        self.lock = threading.RLock()
+
+    def _style_signature(self):
+        """各样式文件的 (修改时间, 大小)，不存在的文件为None"""
+        signature = []
+        for path in self._style_files:
+            try:
+                st = os.stat(path)
+            except OSError:
+                signature.append(None)
+            else:
+                signature.append((st.st_mtime_ns, st.st_size))
+        return signature
+
+    def _load_styles(self, signature):
+        sources = [('<default>', DEFAULT_CSS), ('<highlight>', get_highlighter().css())]
+        default_sheet, user_sheets = self._style_files[0], self._style_files[1:]
+        for path in ([default_sheet] if os.path.exists(default_sheet) else []) + user_sheets:
+            with open(path, 'r', encoding='utf-8') as f:
+                sources.append((path, f.read()))
+        stylesheets = self._compile(sources)
+        self.sources = sources
+        self.stylesheets = stylesheets
+        # 样式内容参与输出缓存的键
+        self.style_key = make_key(*(text for _, text in sources))
+        self.font_families = fonts.css_families(text for _, text in sources)
+        self._font_chars = set()
+        self._subset = None
+        self._subset_stylesheets = None
+        self._signature = signature
+
+    def reload_styles(self):
+        """样式文件修改过时重新读取和编译，返回是否重新加载"""
+        with self.lock:
+            signature = self._style_signature()
+            if signature == self._signature:
+                return False
+            self._load_styles(signature)
+            return True
+
+    def _compile(self, sources):
+        sheets = []
+        for name, text in sources:
+            base_url = None if name.startswith('<') else os.path.dirname(os.path.abspath(name))
+            sheets.append(CSS(string=text, base_url=base_url, font_config=self.font_config))
+        return sheets
+    
+    def font_subset(self, charset):
+        """覆盖charset的中文字体子集（fonts.FontSubset），不需要时返回None
+
+        返回会话当前的子集；charset中有子集之外的字符时，子集扩充为两者的并集。
+        """
+        if self.fonts is None or not fonts.has_cjk(charset):
+            return None
+        with self.lock:
+            chars = set(charset)
+            if self._subset is not None and chars <= self._font_chars:
+                return self._subset
+            try:
+                subset = self.fonts.font_faces(''.join(self._font_chars | chars), self.font_families)
+            except Exception as e:
+                # 子集化失败时使用系统字体，不影响转换
+                logger.warning(f"⚠ 字体子集化失败，使用完整字体: {e}")
+                return None
+            if subset is not None:
+                self._font_chars |= chars
+                self._subset = subset
+            return subset
+    
+    def stylesheets_for(self, charset):
+        """排版用到这些字符的文档时使用的样式表"""
+        self.reload_styles()
+        subset = self.font_subset(charset)
+        if subset is None:
+            return self.stylesheets
+        with self.lock:
+            if self._subset_stylesheets is None or self._subset_stylesheets[0] != subset.alias:
+                if self._font_compiles >= FONT_CONFIG_MAX_COMPILES:
+                    self.font_config = FontConfiguration()
+                    self.stylesheets = self._compile(self.sources)
+                    self._font_compiles = 0
+                sources = [('<fonts>', fonts.font_face_css(subset))]
+                sources += [(name, fonts.with_alias(text, subset.requested, subset.alias))
+                            for name, text in self.sources]
+                self._subset_stylesheets = (subset.alias, self._compile(sources))
+                self._font_compiles += 1
+            return self._subset_stylesheets[1]
+    
+    def md_to_html(self, md_text):
+        """Markdown文本转为HTML页面（样式不内嵌，由 render 统一应用）"""
+        return md_to_html(md_text, self.app_path, md=self.md, inline_css=False)
+
+    def optimize_images(self, html_content, base_url=None):
+        """HTML中的图片换成缩小、压缩后的版本
+
+        base_url 可以是目录路径或 file: 地址；其他地址的图片不在本地，不做处理。
+        """
+        if self.images is None:
+            return html_content
+        if base_url:
+            parsed = urlparse(base_url)
+            if parsed.scheme == 'file':
+                base_url = url2pathname(parsed.path)
+            elif len(parsed.scheme) > 1:
+                return html_content
+        return self.images.rewrite_html(html_content, base_url or os.getcwd(), allow=self.allow_file)
+
+    def _fetch(self, url, *args, **kwargs):
+        """WeasyPrint读取资源；限制了本地文件时拒绝范围之外的文件（优化后的图片除外）"""
+        parsed = urlparse(url)
+        if parsed.scheme == 'file':
+            path = url2pathname(parsed.path)
+            in_cache = self.images is not None and is_within(path, self.images.root)
+            if not in_cache and not self.allow_file(path):
+                raise PermissionError(f"不允许读取的文件: {path}")
+        return default_url_fetcher(url, *args, **kwargs)
+    
+    def render(self, md_text, base_url=None, charset=None):
+        """排版Markdown文本，返回WeasyPrint文档
+
+        charset: 生成字体子集用的字符，默认为md_text中的字符；
+                 分块渲染时传入整篇文档的字符，使各块共用同一个子集
+        """
+        with self.lock:
+            html_content = self.optimize_images(self.md_to_html(md_text), base_url)
+            url_fetcher = default_url_fetcher if self.allow_file is None else self._fetch
+            return self.render_html(HTML(string=html_content, base_url=base_url, url_fetcher=url_fetcher),
+                                    md_text if charset is None else charset)
+
+    def render_html(self, html, charset=''):
+        """用会话的样式表和字体配置排版一个 weasyprint.HTML"""
+        stylesheets = self.stylesheets_for(charset)
+        with profiling.stage('layout'):
+            return html.render(stylesheets=stylesheets, font_config=self.font_config)
+
+    def write_pdf(self, md_text, target=None, base_url=None):
+        """转换Markdown文本；target为None时返回PDF字节"""
+        with self.lock:
+            document = self.render(md_text, base_url)
+            with profiling.stage('write_pdf'):
+                return document.write_pdf(target)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(app_path=None, stylesheets=(), optimize_images=True):
+    """当前进程中按 (app_path, 样式表, 是否优化图片) 共享的会话"""
+    key = (app_path, tuple(os.path.abspath(p) for p in stylesheets), optimize_images)
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = ConverterSession(app_path, stylesheets, optimize_images=optimize_images)
+        session = _sessions[key]
+    session.reload_styles()
+    return session
+
+def warm_up(app_path=None):
+    """预先加载排版引擎、字体和公式渲染后端（GUI启动后在后台线程中调用）"""
+    get_renderer()
+    # 排版一个小文档：加载Pango、fontconfig缓存和中文字体
+    get_session(app_path).render('预热 warm-up $x^2$')
+
+def use_streaming(md_file, streaming=None, chunked=False):
+    """是否流式转换md_file
+
+    流式转换逐块处理，引用式链接的定义无法跨块生效；含有引用定义的文档总是整篇转换。
+    """
+    if chunked or streaming is False:
+        return False
+    if streaming is None and os.path.getsize(md_file) <= STREAMING_THRESHOLD:
+        return False
+    from streaming import has_reference_definitions
+    with open(md_file, 'r', encoding='utf-8') as f:
+        if has_reference_definitions(f):
+            if streaming:
+                print("⚠ 文档含有引用式链接定义，流式转换会使其失效，改为整篇转换")
+            return False
+    return True
+
+def _convert(md_file, pdf_file, app_path, use_cache, chunked, workers, streaming, stylesheets,
+             split=None, pages=None, section=None, optimize_images=True):
+    """convert_md_to_pdf 的实现，出错时抛出异常"""
+    if split or pages or section:
+        # 分卷和预览输出多个文件或部分页面，不经过输出缓存
+        import volumes
+        base_url = os.path.dirname(os.path.abspath(md_file))
+        with profiling.stage('read'):
+            with open(md_file, 'r', encoding='utf-8') as f:
+                md_content = f.read()
+        if split:
+            volumes.convert_volumes(md_content, pdf_file, app_path, split, workers, base_url, stylesheets,
+                                    optimize_images)
+        else:
+            volumes.render_preview(md_content, pdf_file, app_path, pages, section, base_url, stylesheets,
+                                   optimize_images)
+        return
+    
+    streaming = use_streaming(md_file, streaming, chunked)
+    session = get_session(app_path, stylesheets, optimize_images)
+    base_url = os.path.dirname(os.path.abspath(md_file))
+    
+    # 输入、模板、样式和引擎版本都相同时，直接复用缓存的PDF
+    cache = OutputCache() if use_cache else None
+    if cache is not None:
+        cache_key = make_key(
+            'converter',
+            RENDER_VERSION,
+            get_renderer().backend,
+            get_highlighter().fingerprint(),
+            file_digest(md_file),
+            references_key(md_file),
+            HTML_TEMPLATE,
+            session.style_key,
+            ','.join(MD_EXTENSIONS),
+            'chunked' if chunked else 'streaming' if streaming else 'single',
+            'images' if optimize_images else 'original-images',
+            markdown.__version__,
+            weasyprint.__version__,
+        )
+        with profiling.stage('cache_lookup'):
+            hit = cache.fetch(cache_key, {'pdf': pdf_file}) is not None
+        if hit:
+            return
+    
+    # 不要写穿指向缓存的硬链接
+    release_output(pdf_file)
+    
+    if streaming:
+        # 流式转换：逐块生成HTML并写入临时缓冲区，不在内存中保留整篇文档
+        from streaming import spool_html
+        head, tail = HTML_TEMPLATE.format(style='', html='\0').split('\0')
+        with session.lock:
+            with profiling.stage('stream_html'):
+                spool = spool_html(md_file, session.md, head, tail, render=render_math,
+                                   transform=lambda html: session.optimize_images(highlight_html(html), base_url))
+            with spool:
+                document = session.render_html(HTML(file_obj=spool, encoding='utf-8', base_url=base_url),
+                                               fonts.file_charset(md_file))
+            with profiling.stage('write_pdf'):
+                document.write_pdf(pdf_file)
+    else:
+        # 读取Markdown文件
+        with profiling.stage('read'):
+            with open(md_file, 'r', encoding='utf-8') as f:
+                md_content = f.read()
+    
+        if chunked:
+            # 分块并行渲染并合并
+            from chunked import convert_chunked
+            convert_chunked(md_content, pdf_file, app_path, workers, base_url, stylesheets, optimize_images)
+        else:
+            # 转换为PDF：排版和写出分开计时
+            session.write_pdf(md_content, pdf_file, base_url)
+    
+    if cache is not None:
+        with profiling.stage('cache_store'):
+            cache.store(cache_key, {'pdf': pdf_file})
+
+def convert_md_to_pdf(md_file, pdf_file, app_path, use_cache=True, chunked=False, workers=None,
+                      streaming=None, stylesheets=(), split=None, pages=None, section=None, optimize_images=True):
+    """主转换函数
+
+    同一进程中的多次调用共享一个 ConverterSession（Markdown处理器、样式表、字体配置）。
+
+    chunked: 在顶级标题处分块，多进程并行排版后合并（适合上千页的大文档）
+    workers: 分块渲染的进程数，默认等于CPU核心数
+    streaming: 逐块读取和转换，内存占用与最大的块成正比；
+               为None时文件超过 STREAMING_THRESHOLD 自动开启（分块渲染时不使用）；
+               文档含有引用式链接定义时改为整篇转换
+    stylesheets: 额外的CSS文件路径，叠加在默认样式和 styles.css 之后
+    split: 分卷输出，如 'pages:500'、'size:50MB'、'headings'；写出 name-vol01.pdf 等文件
+           而不是pdf_file（见 volumes.py）
+    pages: 只排版并输出这个页码范围，如 '10-20'，用于快速预览
+    section: 只排版并输出标题包含该文字的顶级节
+    optimize_images: 缩小并重新压缩文档中的图片；为False时嵌入原图
+    """
+    try:
+        with profiling.stage('convert', input=md_file):
+            _convert(md_file, pdf_file, app_path, use_cache, chunked, workers, streaming, stylesheets,
+                     split, pages, section, optimize_images)
         return True
     except Exception as e:
         print(f"转换错误: {e}")
-        return False
\ No newline at end of file
+        return False
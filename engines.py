@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pluggable conversion engines
+Puts the two PDF pipelines behind one interface:
+
+    weasyprint  converter.py: Markdown -> HTML -> WeasyPrint, in process
+    pandoc      md2pdf.py: pandoc + LaTeX subprocesses
+
+`EngineSelector` inspects a document (size, formula density, tables, CJK
+text, raw LaTeX), drops the engines that are not installed or cannot handle
+it, and picks the one with the lowest estimated time. Estimates start from a
+simple per-engine cost model and are corrected by the timings of earlier
+conversions, which are kept in the cache directory. In race mode every
+capable engine is started in its own process and the first successful
+result is kept.
+
+    convert_document('a.md', 'a.pdf', engine='auto')
+    convert_document('a.md', 'a.pdf', engine='race')
+"""
+
+import os
+import re
+import abc
+import json
+import queue
+import time
+import shutil
+import signal
+import logging
+import tempfile
+import threading
+import multiprocessing
+from collections import namedtuple
+
+from cache import default_cache_dir
+from mathscan import scan_math
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FILE = 'engines.json'
+# Weight of the newest run in the timing correction
+HISTORY_ALPHA = 0.3
+# How often a race checks whether its engine processes are still alive
+RACE_POLL_SECONDS = 0.5
+# Faster runs were cache hits and say nothing about the engine
+MIN_RECORDED_SECONDS = 0.1
+
+# Engine choices accepted by convert_document besides the engine names
+AUTO = 'auto'
+RACE = 'race'
+
+DocumentFeatures = namedtuple('DocumentFeatures', [
+    'size',          # bytes
+    'formulas',      # inline + display formulas
+    'tables',
+    'code_blocks',
+    'images',
+    'cjk',           # contains CJK characters
+    'raw_latex',     # LaTeX environments or commands outside formulas
+])
+
+_CJK_RE = re.compile(r'[\u2e80-\u9fff\uf900-\ufaff\uff00-\uffef]')
+_TABLE_RULE_RE = re.compile(r'^\s*\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?\s*$', re.M)
+_FENCE_RE = re.compile(r'^\s*(```|~~~)', re.M)
+_IMAGE_RE = re.compile(r'!\[[^\]]*\]\(')
+_RAW_LATEX_RE = re.compile(r'\\(begin\{|usepackage|newcommand|renewcommand|input\{|include\{)')
+
+
+def analyze(md_file):
+    """Features of a Markdown document that decide which engine suits it"""
+    with open(md_file, 'r', encoding='utf-8') as f:
+        text = f.read()
+    # Formulas are replaced by placeholders, so raw LaTeX inside $...$ does not count
+    stripped, formulas = scan_math(text)
+    return DocumentFeatures(
+        size=len(text.encode('utf-8')),
+        formulas=len(formulas),
+        tables=len(_TABLE_RULE_RE.findall(text)),
+        code_blocks=len(_FENCE_RE.findall(text)) // 2,
+        images=len(_IMAGE_RE.findall(text)),
+        cjk=_CJK_RE.search(text) is not None,
+        raw_latex=_RAW_LATEX_RE.search(stripped) is not None,
+    )
+
+
+class Engine(abc.ABC):
+    """Interface of a conversion engine
+
+    Subclasses set `name` and implement the abstract methods below; by
+    default an engine accepts every document. `options` is a dict of
+    conversion settings; each engine uses the keys it knows.
+    """
+
+    name = None
+
+    @abc.abstractmethod
+    def unavailable(self):
+        """Reason the engine cannot run on this machine, or None"""
+
+    def unsupported(self, features, options):
+        """Reason the engine cannot convert this document, or None"""
+        return None
+
+    @abc.abstractmethod
+    def estimate(self, features):
+        """Prior estimate of the conversion time in seconds"""
+
+    @abc.abstractmethod
+    def convert(self, input_file, output_file, options):
+        """Convert; returns True on success"""
+
+
+class WeasyPrintEngine(Engine):
+    name = 'weasyprint'
+
+    def __init__(self):
+        # Importing WeasyPrint is slow and a failed import is retried every time
+        self._unavailable = ()
+
+    def unavailable(self):
+        if self._unavailable == ():
+            try:
+                import converter  # noqa: F401
+                self._unavailable = None
+            except (ImportError, OSError) as e:
+                # OSError: WeasyPrint installed but Pango/GObject libraries are missing
+                self._unavailable = f"WeasyPrint unavailable: {e}"
+        return self._unavailable
+
+    def unsupported(self, features, options):
+        if features.raw_latex:
+            return "raw LaTeX needs a LaTeX engine"
+        if any(fmt != 'pdf' for fmt in options.get('formats', ('pdf',))):
+            return "only writes PDF"
+        if options.get('incremental'):
+            return "incremental builds need the pandoc engine"
+        return None
+
+    def estimate(self, features):
+        # Layout dominates and grows with the text; every formula is rendered to SVG
+        return 0.5 + features.size / 1024 * 0.02 + features.formulas * 0.02 + features.tables * 0.02
+
+    def convert(self, input_file, output_file, options):
+        import converter
+        if options.get('debug'):
+            # The counterpart of pandoc -v: WeasyPrint's own layout and resource messages
+            logging.getLogger('weasyprint').setLevel(logging.DEBUG)
+        return converter.convert_md_to_pdf(
+            input_file, output_file, options.get('app_path'),
+            use_cache=options.get('use_cache', True),
+            chunked=options.get('chunked', False),
+            workers=options.get('workers'),
+            streaming=options.get('streaming'),
+            stylesheets=options.get('stylesheets', ()),
+            split=options.get('split'),
+            pages=options.get('pages'),
+            section=options.get('section'),
+            optimize_images=options.get('optimize_images', True)
+        )
+
+
+class PandocEngine(Engine):
+    name = 'pandoc'
+
+    def unavailable(self):
+        import toolchain
+        tools = toolchain.get_toolchain()
+        if not tools.has('pandoc'):
+            return "pandoc not found"
+        if not tools.pdf_engines:
+            return "no LaTeX engine found"
+        return None
+
+    def unsupported(self, features, options):
+        import toolchain
+        # md2pdf prefers pdflatex, which has no CJK fonts
+        if features.cjk and toolchain.get_toolchain().pdf_engine('pdflatex') == 'pdflatex':
+            return "pdflatex cannot typeset CJK text"
+        if any(options.get(key) for key in ('split', 'pages', 'section')):
+            return "volumes and page-range previews need the WeasyPrint engine"
+        if options.get('chunked') or options.get('streaming'):
+            return "chunked and streaming conversion need the WeasyPrint engine"
+        return None
+
+    def estimate(self, features):
+        # LaTeX start-up and font loading are a large fixed cost; formulas are nearly free
+        return 2.0 + features.size / 1024 * 0.01 + features.formulas * 0.002 + features.tables * 0.03
+
+    def convert(self, input_file, output_file, options):
+        import md2pdf
+        keys = ('debug', 'use_cache', 'formats', 'optimize_images', 'incremental')
+        return md2pdf.convert_md_to_pdf(input_file, output_file, **{k: options[k] for k in keys if k in options})
+
+
+ENGINES = {engine.name: engine for engine in (WeasyPrintEngine(), PandocEngine())}
+
+
+class TimingHistory:
+    """Per-engine correction factor: moving average of actual / estimated time"""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(default_cache_dir(), HISTORY_FILE)
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def factor(self, name):
+        return self._load().get(name, {}).get('factor', 1.0)
+
+    def record(self, name, estimate, elapsed):
+        if estimate <= 0 or elapsed < MIN_RECORDED_SECONDS:
+            return
+        with self._lock:
+            data = self._load()
+            entry = data.setdefault(name, {'factor': 1.0, 'runs': 0})
+            ratio = elapsed / estimate
+            # The first run replaces the prior; later runs are averaged in
+            entry['factor'] = ratio if entry['runs'] == 0 else \
+                (1 - HISTORY_ALPHA) * entry['factor'] + HISTORY_ALPHA * ratio
+            entry['runs'] += 1
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, indent=1)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logger.debug(f"Could not store engine timings: {e}")
+
+
+class EngineSelector:
+    """Chooses the engine for a document from capability and estimated cost"""
+
+    def __init__(self, engines=None, history=None):
+        self.engines = engines or ENGINES
+        self.history = history or TimingHistory()
+
+    def estimate(self, engine, features):
+        return engine.estimate(features) * self.history.factor(engine.name)
+
+    def candidates(self, features, options):
+        """Engines able to convert the document, fastest estimate first"""
+        ranked = []
+        for engine in self.engines.values():
+            reason = engine.unavailable() or engine.unsupported(features, options)
+            if reason:
+                logger.debug(f"Engine {engine.name} skipped: {reason}")
+                continue
+            ranked.append((self.estimate(engine, features), engine))
+        ranked.sort(key=lambda item: item[0])
+        return [engine for _, engine in ranked]
+
+    def run(self, engine, input_file, output_file, features, options):
+        """Convert with one engine and record its time"""
+        start = time.perf_counter()
+        success = engine.convert(input_file, output_file, options)
+        if success:
+            self.history.record(engine.name, engine.estimate(features), time.perf_counter() - start)
+        return success
+
+    def race(self, engines, input_file, output_file, features, options):
+        """Start every engine in its own process; keep the first successful PDF"""
+        if len(engines) == 1:
+            return self.run(engines[0], input_file, output_file, features, options)
+
+        results = multiprocessing.Queue()
+        with tempfile.TemporaryDirectory(prefix='md2pdf-race-') as tmp:
+            processes = {}
+            for engine in engines:
+                target = os.path.join(tmp, engine.name, os.path.basename(output_file))
+                process = multiprocessing.Process(target=_race_worker,
+                                                  args=(engine.name, input_file, target, options, results))
+                process.start()
+                processes[engine.name] = (process, target)
+
+            winner = None
+            pending = set(processes)
+            try:
+                while pending:
+                    try:
+                        name, success, elapsed = results.get(timeout=RACE_POLL_SECONDS)
+                    except queue.Empty:
+                        # A child killed before reporting (crash, OOM killer) is a failed engine
+                        for name in [name for name in pending if not processes[name][0].is_alive()]:
+                            # Its result may have been queued just before it exited
+                            if results.empty():
+                                logger.info(f"Engine {name} exited without a result "
+                                            f"(exit code {processes[name][0].exitcode})")
+                                pending.discard(name)
+                        continue
+                    pending.discard(name)
+                    if success:
+                        winner = name
+                        break
+                    logger.info(f"Engine {name} failed after {elapsed:.2f}s")
+            finally:
+                for name, (process, _) in processes.items():
+                    if name != winner and process.is_alive():
+                        _kill(process)
+                    process.join()
+
+            if winner is None:
+                return False
+            engine = self.engines[winner]
+            self.history.record(winner, engine.estimate(features), elapsed)
+            logger.info(f"✓ Engine {winner} won the race in {elapsed:.2f}s")
+            output_dir = os.path.dirname(os.path.abspath(output_file))
+            os.makedirs(output_dir, exist_ok=True)
+            shutil.move(processes[winner][1], output_file)
+            return True
+
+
+def _race_worker(name, input_file, output_file, options, results):
+    """Child process of a race: convert with one engine and report"""
+    if hasattr(os, 'setsid'):
+        # Own process group, so the losing engine's pandoc/LaTeX children are stopped too
+        os.setsid()
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    start = time.perf_counter()
+    try:
+        success = bool(ENGINES[name].convert(input_file, output_file, options))
+    except Exception as e:
+        logger.error(f"✗ Engine {name}: {str(e)}")
+        success = False
+    results.put((name, success and os.path.exists(output_file), time.perf_counter() - start))
+
+
+def _kill(process):
+    if hasattr(os, 'killpg'):
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            return
+        except OSError:
+            pass
+    process.terminate()
+
+
+_selector = None
+
+
+def get_selector():
+    """The EngineSelector of this process"""
+    global _selector
+    if _selector is None:
+        _selector = EngineSelector()
+    return _selector
+
+
+def convert_document(input_file, output_file, engine=AUTO, options=None):
+    """Convert with the named engine, the cheapest capable one ('auto'), or all of them ('race')
+
+    Module-level so that batch worker processes can run it.
+    """
+    options = dict(options or {})
+    selector = get_selector()
+    features = analyze(input_file)
+
+    if engine not in (AUTO, RACE):
+        chosen = selector.engines[engine]
+        reason = chosen.unavailable() or chosen.unsupported(features, options)
+        if reason:
+            logger.error(f"✗ Engine {engine}: {reason}")
+            return False
+        return selector.run(chosen, input_file, output_file, features, options)
+
+    candidates = selector.candidates(features, options)
+    if not candidates:
+        logger.error("✗ No installed engine can convert this document")
+        return False
+
+    if engine == RACE:
+        logger.info(f"Racing engines: {', '.join(e.name for e in candidates)}")
+        return selector.race(candidates, input_file, output_file, features, options)
+
+    # Fall back to the next cheapest engine when the chosen one fails
+    for chosen in candidates:
+        logger.info(f"Engine: {chosen.name} (estimated {selector.estimate(chosen, features):.1f}s)")
+        if selector.run(chosen, input_file, output_file, features, options):
+            return True
+    return False
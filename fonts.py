@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""
+字体管理：回退链解析、字体元数据缓存和中文字体子集化
+
+中文字体动辄十几到几十MB，WeasyPrint每次排版都要加载整个字体文件。这里：
+
+1. 扫描系统字体目录，解析每个字体的名称和是否覆盖中文，结果保存在缓存目录，
+   之后只对新增或修改过的字体文件重新解析；
+2. 在样式表的 font-family 列表中找到第一个中文字体，未安装时用已安装的中文字体代替
+   （每个进程只解析一次）；
+3. 按文档实际用到的字符生成该字体的子集（结果缓存），以 @font-face 的形式交给
+   WeasyPrint。排版时只加载几百KB的子集；分块渲染的各块使用同一个子集，合并时去重。
+   转换会话（converter.ConverterSession）只保留一个子集，新文档用到子集之外的字符时
+   才扩充它。
+
+字体索引在创建会话时于后台线程中建立（FontManager.preload）。
+"""
+
+import os
+import re
+import sys
+import json
+import logging
+import threading
+from pathlib import Path
+from collections import namedtuple
+
+from fontTools.ttLib import TTFont, TTCollection
+from fontTools import subset as ft_subset
+
+import profiling
+from cache import default_cache_dir, make_key, prune_files
+
+logger = logging.getLogger(__name__)
+
+FONT_SUFFIXES = {'.ttf', '.otf', '.ttc', '.otc'}
+
+# 常见中文字体（按优先级）；样式表请求的中文字体没有安装时，用第一个已安装的代替
+CJK_FAMILIES = [
+    'Microsoft YaHei', 'PingFang SC', 'Hiragino Sans GB', 'Noto Sans CJK SC', 'Noto Sans SC',
+    'Source Han Sans SC', 'Source Han Sans CN', 'WenQuanYi Micro Hei', 'WenQuanYi Zen Hei',
+    'SimHei', 'SimSun', 'Noto Serif CJK SC', 'Source Han Serif SC',
+]
+
+# 判断字体是否覆盖中文用的样本字符
+CJK_SAMPLE = '中文的一是'
+
+# 子集中总是保留的字符：ASCII、列表编号和项目符号、常见中文标点
+EXTRA_CHARS = ''.join(chr(c) for c in range(0x20, 0x7f)) + '•◦▪–—…“”‘’、。，；：？！（）《》【】·'
+
+# 索引或子集格式变化时递增
+INDEX_VERSION = '1'
+SUBSET_VERSION = '1'
+
+# 子集缓存的大小上限，超出后删除最久未使用的子集
+SUBSET_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# 一个文档使用的子集：alias 是 @font-face 中的字体名，requested 是样式表请求的中文字体名，
+# subsets 是 [(字重, 子集文件)]，另外记录原字体和子集的字节数
+FontSubset = namedtuple('FontSubset', ['alias', 'requested', 'subsets', 'original_bytes', 'subset_bytes'])
+
+_CJK_RE = re.compile(r'[\u2e80-\u9fff\uf900-\ufaff\uff00-\uffef]')
+_FONT_FAMILY_RE = re.compile(r'font-family\s*:\s*([^;}]+)', re.I)
+_GENERIC_FAMILIES = {'serif', 'sans-serif', 'monospace', 'cursive', 'fantasy', 'system-ui'}
+
+
+def has_cjk(text):
+    """文本是否包含中日韩字符"""
+    return _CJK_RE.search(text) is not None
+
+
+def font_dirs():
+    """当前平台的系统和用户字体目录"""
+    home = os.path.expanduser('~')
+    if sys.platform == 'win32':
+        windir = os.environ.get('WINDIR', r'C:\Windows')
+        local = os.environ.get('LOCALAPPDATA') or home
+        return [os.path.join(windir, 'Fonts'), os.path.join(local, 'Microsoft', 'Windows', 'Fonts')]
+    if sys.platform == 'darwin':
+        return ['/System/Library/Fonts', '/Library/Fonts', os.path.join(home, 'Library', 'Fonts')]
+    data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(home, '.local', 'share')
+    return ['/usr/share/fonts', '/usr/local/share/fonts', os.path.join(data_home, 'fonts'),
+            os.path.join(home, '.fonts')]
+
+
+def file_charset(path):
+    """文件中出现的所有字符（逐行读取，用于流式转换）"""
+    chars = set()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            chars.update(line)
+    return ''.join(chars)
+
+
+def css_families(css_texts):
+    """样式表中 font-family 声明里出现的字体名（按出现顺序去重，不含通用字体族）"""
+    families = []
+    for text in css_texts:
+        for match in _FONT_FAMILY_RE.finditer(text):
+            for name in match.group(1).split(','):
+                name = name.strip().strip('\'"').strip()
+                if name and name.lower() not in _GENERIC_FAMILIES and name not in families:
+                    families.append(name)
+    return families
+
+
+def _parse_font_file(path):
+    """解析一个字体文件中每个字体的名称、字重和中文覆盖情况"""
+    faces = []
+    collection = os.path.splitext(path)[1].lower() in ('.ttc', '.otc')
+    count = len(TTCollection(path, lazy=True).fonts) if collection else 1
+    for index in range(count):
+        font = TTFont(path, fontNumber=index if collection else -1, lazy=True)
+        try:
+            families = set()
+            for record in font['name'].names:
+                if record.nameID in (1, 16):
+                    try:
+                        families.add(record.toUnicode())
+                    except UnicodeDecodeError:
+                        pass
+            cmap = font.getBestCmap() or {}
+            os2 = font['OS/2'] if 'OS/2' in font else None
+            faces.append({
+                'path': path,
+                'index': index if collection else 0,
+                'families': sorted(families),
+                'weight': os2.usWeightClass if os2 is not None else 400,
+                'italic': bool(os2.fsSelection & 1) if os2 is not None else False,
+                'cjk': all(ord(c) in cmap for c in CJK_SAMPLE),
+            })
+        finally:
+            font.close()
+    return faces
+
+
+class FontIndex:
+    """系统字体的元数据索引
+
+    保存在缓存目录的 fonts/index.json，按文件大小和修改时间增量更新：
+    只有新增或修改过的字体文件需要解析。
+    """
+
+    def __init__(self, cache_dir=None, dirs=None):
+        self.path = os.path.join(cache_dir or default_cache_dir(), 'fonts', 'index.json')
+        self.dirs = font_dirs() if dirs is None else dirs
+        self.files = {}
+        self.parsed = 0
+        self._update()
+        self.faces = [face for entry in self.files.values() for face in entry['faces']]
+
+    def _update(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            if stored.get('version') != INDEX_VERSION:
+                stored = {}
+        except (OSError, ValueError):
+            stored = {}
+        old = stored.get('files', {})
+
+        for font_dir in self.dirs:
+            for root, dirs, files in os.walk(font_dir):
+                for name in files:
+                    if os.path.splitext(name)[1].lower() not in FONT_SUFFIXES:
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entry = old.get(path)
+                    if entry and entry['mtime_ns'] == st.st_mtime_ns and entry['size'] == st.st_size:
+                        self.files[path] = entry
+                        continue
+                    try:
+                        faces = _parse_font_file(path)
+                    except Exception as e:
+                        logger.debug(f"Skipping font {path}: {e}")
+                        faces = []
+                    self.parsed += 1
+                    self.files[path] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'faces': faces}
+
+        if self.parsed or set(old) != set(self.files):
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump({'version': INDEX_VERSION, 'files': self.files}, f, ensure_ascii=False)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logger.debug(f"Could not store font index: {e}")
+            logger.info(f"字体索引: 解析了 {self.parsed} 个字体文件，共 {len(self.files)} 个")
+
+    def find(self, family):
+        """名称匹配的所有字体（不区分大小写，中英文名都可以）"""
+        family = family.lower()
+        return [face for face in self.faces if any(name.lower() == family for name in face['families'])]
+
+    def file_size(self, path):
+        return self.files.get(path, {}).get('size', 0)
+
+    def resolve_cjk(self, families):
+        """在字体列表中找第一个中文字体。
+
+        返回 (请求的字体名, 实际使用的字体列表)；请求的中文字体未安装时，
+        实际使用的是第一个已安装的常见中文字体。没有找到时返回 None。
+        """
+        known = {name.lower() for name in CJK_FAMILIES}
+        for family in families:
+            faces = [face for face in self.find(family) if face['cjk']]
+            if faces:
+                return family, faces
+            if family.lower() in known:
+                for candidate in CJK_FAMILIES:
+                    faces = [face for face in self.find(candidate) if face['cjk']]
+                    if faces:
+                        return family, faces
+        return None
+
+
+def _regular_and_bold(faces):
+    """每种字重（常规400、粗体700）各取一个非斜体字体"""
+    chosen = {}
+    for face in sorted(faces, key=lambda f: (f['path'], f['index'])):
+        if face['italic']:
+            continue
+        weight = 700 if face['weight'] >= 600 else 400 if 350 <= face['weight'] < 600 else None
+        if weight is not None and weight not in chosen:
+            chosen[weight] = face
+    if not chosen:
+        chosen[400] = faces[0]
+    return chosen
+
+
+def subset_font(face, chars, subset_dir):
+    """生成字体子集（已缓存时直接复用），返回子集文件路径"""
+    st = os.stat(face['path'])
+    key = make_key(SUBSET_VERSION, face['path'], str(face['index']), str(st.st_size),
+                   str(st.st_mtime_ns), ''.join(sorted(chars)))
+    out = os.path.join(subset_dir, key[:2], key + '.ttf')
+    if os.path.exists(out):
+        # 标记为最近使用
+        os.utime(out)
+        return out
+
+    options = ft_subset.Options()
+    options.font_number = face['index']
+    options.layout_features = ['*']
+    options.name_IDs = ['*']
+    options.name_languages = ['*']
+    options.notdef_outline = True
+    options.hinting = False
+    options.glyph_names = False
+    font = ft_subset.load_font(face['path'], options, dontLoadGlyphNames=True)
+    try:
+        subsetter = ft_subset.Subsetter(options)
+        subsetter.populate(unicodes=[ord(c) for c in chars])
+        subsetter.subset(font)
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        tmp = f"{out}.{os.getpid()}.tmp"
+        ft_subset.save_font(font, tmp, options)
+        os.replace(tmp, out)
+    finally:
+        font.close()
+    prune_files(subset_dir, SUBSET_CACHE_MAX_BYTES)
+    return out
+
+
+class FontManager:
+    """为文档生成中文字体子集的 @font-face 样式"""
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.subset_dir = os.path.join(self.cache_dir, 'fonts', 'subsets')
+        self._index = None
+        self._resolved = {}
+        self._lock = threading.Lock()
+        self._preloading = False
+
+    @property
+    def index(self):
+        with self._lock:
+            if self._index is None:
+                with profiling.stage('font_index'):
+                    self._index = FontIndex(self.cache_dir)
+            return self._index
+
+    def preload(self):
+        """在后台线程中建立字体索引（只启动一次）；之后用到索引时等待它完成"""
+        with self._lock:
+            if self._index is not None or self._preloading:
+                return
+            self._preloading = True
+
+        def build():
+            try:
+                self.index
+            except Exception as e:
+                logger.debug(f"Font index preload failed: {e}")
+
+        threading.Thread(target=build, name='font-index', daemon=True).start()
+
+    def resolve(self, families):
+        """解析字体回退链中的中文字体（每个字体列表只解析一次）"""
+        key = tuple(families)
+        if key not in self._resolved:
+            self._resolved[key] = self.index.resolve_cjk(families)
+            if self._resolved[key] is not None:
+                requested, faces = self._resolved[key]
+                actual = faces[0]['families'][0] if faces[0]['families'] else faces[0]['path']
+                logger.info(f"中文字体: {requested} → {actual}")
+        return self._resolved[key]
+
+    def font_faces(self, charset, families):
+        """为字符集生成中文字体子集。
+
+        文本不含中文或没有可用的中文字体时返回 None。同一字符集总是得到同一个
+        alias 和同一组子集文件，分块渲染的各块因此嵌入完全相同的字体数据。
+        """
+        if not has_cjk(charset):
+            return None
+        resolved = self.resolve(families)
+        if resolved is None:
+            return None
+        requested, faces = resolved
+        chars = set(charset) | set(EXTRA_CHARS)
+
+        subsets = []
+        original_bytes = subset_bytes = 0
+        with profiling.stage('font_subset', chars=len(chars)):
+            for weight, face in sorted(_regular_and_bold(faces).items()):
+                path = subset_font(face, chars, self.subset_dir)
+                subsets.append((weight, path))
+                original_bytes += self.index.file_size(face['path'])
+                subset_bytes += os.path.getsize(path)
+        logger.info(f"字体子集: {len(chars)} 个字符，{original_bytes / 1048576:.1f} MB → "
+                    f"{subset_bytes / 1024:.0f} KB（节省 {(original_bytes - subset_bytes) / 1048576:.1f} MB）")
+        alias = 'md2pdf-cjk-' + make_key(*(path for _, path in subsets))[:12]
+        return FontSubset(alias, requested, subsets, original_bytes, subset_bytes)
+
+
+def font_face_css(subset):
+    """子集字体的 @font-face 规则"""
+    rules = []
+    for weight, path in subset.subsets:
+        rules.append(f'@font-face {{ font-family: "{subset.alias}"; font-weight: {weight}; '
+                     f'src: url("{Path(path).as_uri()}"); }}')
+    return '\n'.join(rules) + '\n'
+
+
+def with_alias(css_text, requested, alias):
+    """在样式表的 font-family 列表中，把子集字体放在请求的中文字体前面"""
+    pattern = re.compile(r'(["\']?)' + re.escape(requested) + r'\1', re.I)
+
+    def rewrite(match):
+        return pattern.sub(lambda m: f'"{alias}", {m.group(0)}', match.group(0), count=1)
+
+    return _FONT_FAMILY_RE.sub(rewrite, css_text)
+
+
+def full_fonts_options():
+    """WeasyPrint write_pdf 参数：嵌入完整字体（不再二次子集化）"""
+    import weasyprint
+    major = int(weasyprint.__version__.split('.')[0])
+    return {'full_fonts': True} if major >= 59 else {'optimize_size': ('images',)}
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    """当前进程共享的 FontManager"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = FontManager()
+        return _manager
+
+
+def _after_fork():
+    # fork时后台线程可能正持有锁；子进程中没有这个线程，需要新的锁并重新建立索引
+    global _manager_lock
+    _manager_lock = threading.Lock()
+    if _manager is not None:
+        _manager._lock = threading.Lock()
+        _manager._preloading = False
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
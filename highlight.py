@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+代码块语法高亮
+
+带语言标记的围栏代码块用Pygments着色：WeasyPrint转换改写 markdown 生成的
+<pre><code class="language-xxx">，Pandoc转换把JSON AST中的CodeBlock换成预先排好的
+LaTeX（fancyvrb的Verbatim环境），LaTeX编译时不再需要Pandoc的高亮宏。
+
+每个代码块只分词一次，结果按 (Pygments版本, 输出格式, 配色, 语言, 源码) 的哈希
+缓存在内存（LRU）和磁盘上，磁盘缓存超过上限时删除最久未用的文件；一篇文档中
+未命中缓存的代码块较多时在多个进程中并行着色。带行号（numberLines/startFrom）的
+代码块留给Pandoc处理。
+样式表只包含以 .highlight 开头的紧凑规则。
+
+未安装Pygments或语言无法识别时代码块保持原样。
+"""
+
+import os
+import re
+import html
+import json
+import logging
+import threading
+import multiprocessing
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import default_cache_dir, make_key, prune_files, LRUDict
+
+try:
+    import pygments
+    from pygments import highlight as _pygmentize
+    from pygments.lexers import get_lexer_by_name
+    from pygments.formatters import HtmlFormatter, LatexFormatter
+    from pygments.util import ClassNotFound
+except ImportError:
+    pygments = None
+
+logger = logging.getLogger(__name__)
+
+# 默认配色（与Pandoc的 --syntax-highlighting=default 相同）
+DEFAULT_STYLE = 'default'
+
+# 内存中保留的代码块数（常驻服务和图形界面会转换很多文档）
+MEMORY_ENTRIES = 4096
+# 磁盘缓存的大小上限；每写入 PRUNE_INTERVAL 个新代码块检查一次
+HIGHLIGHT_CACHE_MAX_BYTES = 128 * 1024 * 1024
+PRUNE_INTERVAL = 500
+
+# Pandoc的行号设置：Pygments的LaTeX输出不带行号，这样的代码块不替换
+_LINE_NUMBER_CLASSES = {'number', 'numberLines', 'number-lines'}
+_LINE_NUMBER_ATTRS = {'startFrom', 'start-from', 'numberLines'}
+
+# 未命中缓存的代码块达到这个数量时并行着色（进程启动的开销低于分词时间）
+PARALLEL_MIN_BLOCKS = 64
+# 每个工作进程一次处理的代码块数
+PARALLEL_BATCH = 16
+
+# markdown 的 fenced_code 扩展生成的代码块；代码已做HTML转义
+_CODE_BLOCK_RE = re.compile(
+    r'<pre([^>]*)><code class="language-([^"\s]+)">(.*?)</code></pre>', re.S)
+_CSS_COMMENT_RE = re.compile(r'\s*/\*.*?\*/')
+
+
+@lru_cache(maxsize=None)
+def _lexer_name(language):
+    """语言标记对应的Pygments词法分析器名称，无法识别时返回None"""
+    if pygments is None:
+        return None
+    try:
+        return get_lexer_by_name(language).aliases[0]
+    except (ClassNotFound, IndexError):
+        return None
+
+
+def _format(lexer_name, code, fmt, style):
+    lexer = get_lexer_by_name(lexer_name, stripnl=False, ensurenl=True)
+    if fmt == 'html':
+        # nowrap：外层的 <pre> 由调用方生成，不重复包裹 <div>
+        return _pygmentize(code, lexer, HtmlFormatter(style=style, nowrap=True))
+    return _pygmentize(code, lexer, LatexFormatter(style=style))
+
+
+def _format_batch(items, fmt, style):
+    """工作进程中着色一批 (词法分析器, 源码)"""
+    return [_format(lexer_name, code, fmt, style) for lexer_name, code in items]
+
+
+class Highlighter:
+    """带两级缓存（内存+磁盘）的代码着色器"""
+
+    def __init__(self, style=DEFAULT_STYLE, cache_dir=None, workers=None):
+        self.style = style
+        self.cache_dir = cache_dir or os.path.join(default_cache_dir(), 'highlight')
+        self.workers = workers or os.cpu_count() or 1
+        self._memory = LRUDict(MEMORY_ENTRIES)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # 距上次清理磁盘缓存后写入的代码块数；None表示本进程还没有清理过
+        self._saved = None
+
+    def fingerprint(self):
+        """参与输出缓存键的着色配置"""
+        if pygments is None:
+            return 'highlight=none'
+        return f'highlight=pygments-{pygments.__version__}/{self.style}'
+
+    def _key(self, fmt, lexer_name, code):
+        return make_key(pygments.__version__, fmt, self.style, lexer_name, code)
+
+    def _disk_path(self, key, fmt):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.{fmt}')
+
+    def highlight_many(self, blocks, fmt='html'):
+        """着色多个 (语言, 源码) 代码块，fmt为 'html' 或 'tex'
+
+        返回与blocks对应的列表，语言无法识别的代码块为None。
+        """
+        results = [None] * len(blocks)
+        missing = {}
+        hits = 0
+        for i, (language, code) in enumerate(blocks):
+            lexer_name = _lexer_name(language)
+            if lexer_name is None:
+                continue
+            key = self._key(fmt, lexer_name, code)
+            cached = self._memory.get(key)
+            if cached is None:
+                path = self._disk_path(key, fmt)
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        cached = f.read()
+                    # 标记为最近使用
+                    os.utime(path)
+                except OSError:
+                    pass
+                else:
+                    self._memory.put(key, cached)
+            if cached is not None:
+                hits += 1
+                results[i] = cached
+            else:
+                # 同一文档中重复的代码块只着色一次
+                missing.setdefault(key, (lexer_name, code, []))[2].append(i)
+        self._count(hits, len(missing))
+
+        if missing:
+            keys = list(missing)
+            outputs = self._format_all([missing[key][:2] for key in keys], fmt)
+            for key, output in zip(keys, outputs):
+                if output is None:
+                    # 着色失败不写入缓存，升级Pygments后会重新着色
+                    continue
+                self._save(self._disk_path(key, fmt), output)
+                self._memory.put(key, output)
+                for i in missing[key][2]:
+                    results[i] = output
+        return results
+
+    def _count(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def _format_all(self, items, fmt):
+        # 分块转换的工作进程中不再嵌套进程池
+        if (len(items) >= PARALLEL_MIN_BLOCKS and self.workers > 1
+                and multiprocessing.parent_process() is None):
+            batches = [items[i:i + PARALLEL_BATCH] for i in range(0, len(items), PARALLEL_BATCH)]
+            try:
+                with ProcessPoolExecutor(max_workers=min(self.workers, len(batches))) as executor:
+                    return [output for batch in executor.map(_format_batch, batches,
+                                                             [fmt] * len(batches), [self.style] * len(batches))
+                            for output in batch]
+            except Exception as e:
+                logger.debug(f"并行着色失败，改为逐个处理: {e}")
+
+        outputs = []
+        for lexer_name, code in items:
+            try:
+                outputs.append(_format(lexer_name, code, fmt, self.style))
+            except Exception as e:
+                # 着色失败的代码块保持原样，不影响整篇文档
+                logger.warning(f"⚠ 代码高亮失败，保留原样: {lexer_name} ({e})")
+                outputs.append(None)
+        return outputs
+
+    def _save(self, path, text):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.debug(f"无法写入高亮缓存: {e}")
+            return
+        with self._lock:
+            prune = self._saved is None or self._saved >= PRUNE_INTERVAL
+            self._saved = 0 if prune else self._saved + 1
+        if prune:
+            prune_files(self.cache_dir, HIGHLIGHT_CACHE_MAX_BYTES)
+
+    def css(self):
+        """WeasyPrint使用的样式规则（只保留 .highlight 下的规则）"""
+        if pygments is None:
+            return ''
+        rules = HtmlFormatter(style=self.style).get_style_defs('.highlight').splitlines()
+        return '\n'.join(_CSS_COMMENT_RE.sub('', rule) for rule in rules if rule.startswith('.highlight')) + '\n'
+
+    def latex_preamble(self):
+        """Pandoc LaTeX导言区需要的宏包和着色宏（-H 传入）"""
+        if pygments is None:
+            return ''
+        return ('\\usepackage{fancyvrb}\n\\usepackage{color}\n'
+                + LatexFormatter(style=self.style).get_style_defs() + '\n')
+
+    def highlight_html(self, html_text):
+        """把HTML中带语言标记的代码块换成着色后的版本"""
+        if pygments is None:
+            return html_text
+        matches = list(_CODE_BLOCK_RE.finditer(html_text))
+        if not matches:
+            return html_text
+        outputs = self.highlight_many([(html.unescape(match.group(2)), html.unescape(match.group(3)))
+                                       for match in matches])
+        parts = []
+        pos = 0
+        for match, output in zip(matches, outputs):
+            if output is None:
+                continue
+            attrs = match.group(1)
+            if 'class=' not in attrs:
+                attrs += ' class="highlight"'
+            parts.append(html_text[pos:match.start()])
+            parts.append(f'<pre{attrs}><code class="language-{match.group(2)}">{output}</code></pre>')
+            pos = match.end()
+        parts.append(html_text[pos:])
+        return ''.join(parts)
+
+    def rewrite_ast(self, ast_file, output_file):
+        """把Pandoc JSON AST中的代码块换成着色后的LaTeX，写入output_file；返回替换的代码块数"""
+        if pygments is None:
+            return 0
+        with open(ast_file, 'r', encoding='utf-8') as f:
+            ast = json.load(f)
+
+        targets = []
+
+        def walk(node):
+            if isinstance(node, dict):
+                if node.get('t') == 'CodeBlock':
+                    # CodeBlock: [[id, [class], [[key, value]]], code]
+                    _, classes, attrs = node['c'][0]
+                    if (_LINE_NUMBER_CLASSES.isdisjoint(classes)
+                            and _LINE_NUMBER_ATTRS.isdisjoint(key for key, _ in attrs)):
+                        # 第一个能识别的语言类名，例如 {.example .python} 中的 python
+                        language = next((name for name in classes if _lexer_name(name)), None)
+                        if language is not None:
+                            targets.append((node, language))
+                    return
+                for value in node.values():
+                    walk(value)
+            elif isinstance(node, list):
+                for value in node:
+                    walk(value)
+
+        walk(ast.get('blocks', []))
+        if not targets:
+            return 0
+        outputs = self.highlight_many([(language, node['c'][1]) for node, language in targets], 'tex')
+        replaced = 0
+        for (node, _), output in zip(targets, outputs):
+            if output is not None:
+                node['t'] = 'RawBlock'
+                node['c'] = ['latex', output.rstrip('\n')]
+                replaced += 1
+        if replaced:
+            with open(output_file, 'w', encoding='utf-8') as f:
+                json.dump(ast, f, ensure_ascii=False)
+        return replaced
+
+
+_default_highlighter = None
+
+
+def get_highlighter():
+    """进程内共享的着色器，批量转换时内存缓存跨文档复用"""
+    global _default_highlighter
+    if _default_highlighter is None:
+        _default_highlighter = Highlighter()
+    return _default_highlighter
+
+
+def highlight_html(html_text):
+    """md_to_html 使用的后处理"""
+    return get_highlighter().highlight_html(html_text)
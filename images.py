@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+图片优化
+
+文档引用的每张图片（本地文件，以及通过可替换的下载函数获取的远程URL）被并发地
+读取，宽度超过页面宽度 × 目标DPI 的缩小，然后重新压缩。结果按图片内容的哈希缓存，
+重复构建直接复用。WeasyPrint转换改写HTML中的 <img src>，Pandoc转换改写JSON AST
+中的图片路径；原图不会被修改。
+
+需要 Pillow（WeasyPrint的依赖）；未安装时图片原样使用。
+SVG、GIF等其他格式原样使用。
+"""
+
+import io
+import os
+import re
+import html
+import json
+import time
+import hashlib
+import logging
+import threading
+import urllib.request
+from pathlib import Path
+from urllib.parse import urlparse, unquote
+from urllib.request import url2pathname
+from concurrent.futures import ThreadPoolExecutor
+
+import profiling
+from cache import default_cache_dir, make_key, prune_files
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# 目标分辨率和页面正文宽度（英寸）：更宽的图片缩小到 TARGET_DPI × PAGE_WIDTH_INCHES 像素
+TARGET_DPI = 150
+PAGE_WIDTH_INCHES = 6.5
+JPEG_QUALITY = 85
+
+# 并发读取和处理的图片数
+MAX_WORKERS = 8
+
+FETCH_TIMEOUT = 30
+# 下载的远程图片在缓存中保留多久后重新下载（秒）
+REMOTE_MAX_AGE = 24 * 3600
+
+# 图片缓存的大小上限，超出后删除最久未使用的文件
+IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# 处理逻辑变化时递增，使旧的缓存结果失效
+IMAGE_VERSION = '1'
+
+_IMG_SRC_RE = re.compile(r'(<img\b[^>]*?\bsrc=")([^"]*)(")', re.I)
+
+
+def fetch_url(url, timeout=FETCH_TIMEOUT):
+    """默认的远程图片下载函数，返回图片字节"""
+    request = urllib.request.Request(url, headers={'User-Agent': 'md2pdf'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read()
+
+
+def is_remote(ref):
+    return urlparse(ref).scheme in ('http', 'https')
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ImageStats:
+    """一次优化的统计：图片数、缓存命中数、优化前后的字节数"""
+
+    def __init__(self):
+        self.images = 0
+        self.cached = 0
+        self.failed = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+        self._lock = threading.Lock()
+
+    def add(self, before, after, cached):
+        with self._lock:
+            self.images += 1
+            self.cached += 1 if cached else 0
+            self.bytes_before += before
+            self.bytes_after += after
+
+    def fail(self):
+        with self._lock:
+            self.failed += 1
+
+    def __str__(self):
+        return (f"{self.images} 张，{self.bytes_before / 1048576:.1f} MB → {self.bytes_after / 1048576:.1f} MB"
+                f"（缓存命中 {self.cached} 张" + (f"，失败 {self.failed} 张）" if self.failed else "）"))
+
+
+class ImageOptimizer:
+    """缩小并重新压缩文档中的图片，结果按内容缓存
+
+    fetcher: 下载远程图片的函数 fetcher(url) -> bytes，默认用urllib；
+             离线构建或测试时可以换成读取本地文件的函数
+    """
+
+    def __init__(self, cache_dir=None, fetcher=None, dpi=TARGET_DPI, page_width=PAGE_WIDTH_INCHES,
+                 quality=JPEG_QUALITY, workers=MAX_WORKERS):
+        self.root = os.path.join(cache_dir or default_cache_dir(), 'images')
+        self.fetcher = fetcher or fetch_url
+        self.dpi = dpi
+        self.max_width = int(dpi * page_width)
+        self.quality = quality
+        self.workers = workers
+
+    def _read(self, ref, base_dir, allow=None):
+        """读取图片字节；data: URI和空引用返回None
+
+        allow: 判断本地文件能否读取的函数 allow(path) -> bool，为None时不限制
+        """
+        if not ref or ref.startswith('data:'):
+            return None
+        if is_remote(ref):
+            path = os.path.join(self.root, 'remote', make_key(ref))
+            try:
+                if time.time() - os.path.getmtime(path) < REMOTE_MAX_AGE:
+                    with open(path, 'rb') as f:
+                        return f.read()
+            except OSError:
+                pass
+            data = self.fetcher(ref)
+            _write_atomic(path, data)
+            return data
+        parsed = urlparse(ref)
+        if parsed.scheme == 'file':
+            path = url2pathname(parsed.path)
+        elif parsed.scheme and len(parsed.scheme) > 1:
+            # 其他协议交给WeasyPrint/Pandoc处理
+            return None
+        else:
+            path = os.path.join(base_dir, unquote(ref))
+        if allow is not None and not allow(path):
+            raise PermissionError(f"不允许读取的文件: {path}")
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _recompress(self, data):
+        """缩小并重新压缩，返回 (字节, 扩展名)；不支持的格式返回None"""
+        image = Image.open(io.BytesIO(data))
+        fmt = image.format
+        if fmt not in ('PNG', 'JPEG'):
+            return None
+        info = image.info
+        # 按EXIF方向旋转，重新保存后方向信息会丢失
+        image = ImageOps.exif_transpose(image)
+
+        resized = image.width > self.max_width
+        if resized:
+            if image.mode == 'P':
+                image = image.convert('RGBA' if 'transparency' in info else 'RGB')
+            height = max(1, round(image.height * self.max_width / image.width))
+            image = image.resize((self.max_width, height), Image.LANCZOS)
+
+        options = {}
+        if resized:
+            # 缩小后的图片正好占满正文宽度
+            options['dpi'] = (self.dpi, self.dpi)
+        elif 'dpi' in info:
+            options['dpi'] = info['dpi']
+        if info.get('icc_profile'):
+            options['icc_profile'] = info['icc_profile']
+
+        out = io.BytesIO()
+        if fmt == 'JPEG':
+            if image.mode not in ('RGB', 'L', 'CMYK'):
+                image = image.convert('RGB')
+            image.save(out, 'JPEG', quality=self.quality, optimize=True, progressive=True, **options)
+            ext = '.jpg'
+        else:
+            image.save(out, 'PNG', optimize=True, **options)
+            ext = '.png'
+        result = out.getvalue()
+        # 没有缩小且重新压缩后没有变小时保留原图
+        if not resized and len(result) >= len(data):
+            result = data
+        return result, ext
+
+    def optimize(self, ref, base_dir, stats=None, allow=None):
+        """优化一张图片，返回优化后文件的路径；不需要或无法处理时返回None"""
+        data = self._read(ref, base_dir, allow)
+        if data is None:
+            return None
+        key = make_key(IMAGE_VERSION, hashlib.sha256(data).hexdigest(), str(self.max_width),
+                       str(self.dpi), str(self.quality))
+        prefix = os.path.join(self.root, key[:2], key)
+        for ext in ('.jpg', '.png'):
+            if os.path.exists(prefix + ext):
+                # 标记为最近使用
+                os.utime(prefix + ext)
+                if stats is not None:
+                    stats.add(len(data), os.path.getsize(prefix + ext), cached=True)
+                return prefix + ext
+
+        result = self._recompress(data)
+        if result is None:
+            return None
+        optimized, ext = result
+        _write_atomic(prefix + ext, optimized)
+        if stats is not None:
+            stats.add(len(data), len(optimized), cached=False)
+        return prefix + ext
+
+    def optimize_all(self, refs, base_dir, allow=None):
+        """并发优化多张图片，返回 ({原引用: 优化后的路径}, 统计)"""
+        stats = ImageStats()
+        refs = list(dict.fromkeys(refs))
+        if Image is None or not refs:
+            return {}, stats
+
+        def run(ref):
+            try:
+                return ref, self.optimize(ref, base_dir, stats, allow)
+            except Exception as e:
+                logger.warning(f"⚠ 图片处理失败，使用原图: {ref} ({e})")
+                stats.fail()
+                return ref, None
+
+        with profiling.stage('images', count=len(refs)):
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(refs))) as executor:
+                results = dict(executor.map(run, refs))
+        if stats.images:
+            logger.info(f"图片优化: {stats}")
+            prune_files(self.root, IMAGE_CACHE_MAX_BYTES)
+        return {ref: path for ref, path in results.items() if path is not None}, stats
+
+    def rewrite_html(self, html_text, base_dir, allow=None):
+        """把HTML中 <img src> 指向的图片换成优化后的文件"""
+        refs = [html.unescape(match.group(2)) for match in _IMG_SRC_RE.finditer(html_text)]
+        if not refs:
+            return html_text
+        mapping, _ = self.optimize_all(refs, base_dir, allow)
+        if not mapping:
+            return html_text
+
+        def replace(match):
+            path = mapping.get(html.unescape(match.group(2)))
+            if path is None:
+                return match.group(0)
+            return match.group(1) + html.escape(Path(path).as_uri()) + match.group(3)
+
+        return _IMG_SRC_RE.sub(replace, html_text)
+
+    def rewrite_ast(self, ast_file, output_file, base_dir):
+        """把Pandoc JSON AST中的图片换成优化后的文件，写入output_file；返回替换的图片数"""
+        with open(ast_file, 'r', encoding='utf-8') as f:
+            ast = json.load(f)
+
+        targets = []
+
+        def walk(node):
+            if isinstance(node, dict):
+                if node.get('t') == 'Image':
+                    # Image: [attr, [inline], [url, title]]
+                    targets.append(node['c'][2])
+                for value in node.values():
+                    walk(value)
+            elif isinstance(node, list):
+                for value in node:
+                    walk(value)
+
+        walk(ast.get('blocks', []))
+        if not targets:
+            return 0
+        mapping, _ = self.optimize_all([target[0] for target in targets], base_dir)
+        replaced = 0
+        for target in targets:
+            path = mapping.get(target[0])
+            if path is not None:
+                # LaTeX需要正斜杠路径
+                target[0] = Path(path).as_posix()
+                replaced += 1
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(ast, f, ensure_ascii=False)
+        return replaced
+
+
+_optimizer = None
+_optimizer_lock = threading.Lock()
+
+
+def get_optimizer():
+    """当前进程共享的 ImageOptimizer"""
+    global _optimizer
+    with _optimizer_lock:
+        if _optimizer is None:
+            _optimizer = ImageOptimizer()
+        return _optimizer
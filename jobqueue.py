@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent conversion job queue (used by `md2pdf serve`)
+Jobs are stored in SQLite and run by a fixed number of worker threads, so any
+number of clients can submit conversions without oversubscribing the host.
+
+- Priority classes: `interactive` jobs always run before `batch` jobs.
+- Backpressure: a submission is rejected with QueueFull once the number of
+  waiting jobs reaches the limit of its class. Batch jobs hit their limit
+  first, so there is always room left for interactive work.
+- Jobs that were queued or running when the daemon stopped are run again
+  after a restart. Only one daemon at a time may use a queue file.
+- metrics() reports queue depth, wait and total latency percentiles and
+  throughput over a sliding window.
+"""
+
+import os
+import json
+import math
+import time
+import sqlite3
+import logging
+import threading
+
+import logsetup
+from cache import default_cache_dir, FileLock
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, highest first
+PRIORITIES = {'interactive': 0, 'batch': 1}
+
+# Waiting jobs allowed before submissions of a class are rejected
+DEFAULT_MAX_QUEUED = 200
+# Batch jobs may only fill this share of the queue
+BATCH_SHARE = 0.8
+
+# Time span covered by latency percentiles and throughput
+METRICS_WINDOW = 600
+# Finished jobs are deleted after this many seconds
+KEEP_FINISHED = 7 * 24 * 3600
+
+QUEUE_FILE = 'queue.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    input TEXT NOT NULL,
+    output TEXT NOT NULL,
+    engine TEXT NOT NULL,
+    options TEXT NOT NULL,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_waiting ON jobs (state, priority, id);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished);
+"""
+
+_COLUMNS = ('id', 'priority', 'state', 'input', 'output', 'engine', 'options',
+            'submitted', 'started', 'finished', 'error')
+
+
+class QueueFull(Exception):
+    """The queue has no room for another job of this priority class"""
+
+
+class QueueLocked(Exception):
+    """Another daemon is running the jobs of this queue file"""
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list (None if empty)"""
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+class JobQueue:
+    """SQLite-backed queue of conversion jobs with worker threads"""
+
+    def __init__(self, convert, path=None, workers=1, max_queued=DEFAULT_MAX_QUEUED):
+        """convert(input_file, output_file, engine, options) -> bool runs one job"""
+        self.convert = convert
+        self.path = path or os.path.join(default_cache_dir(), QUEUE_FILE)
+        self.workers = max(1, workers)
+        self.limits = {
+            'interactive': max_queued,
+            'batch': max(1, int(max_queued * BATCH_SHARE)),
+        }
+        self.started = time.time()
+        self.rejected = {name: 0 for name in PRIORITIES}
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._stopping = False
+        self._threads = []
+
+        # Requeueing 'running' jobs below is only safe if no other daemon runs them
+        self._owner = FileLock(f'{self.path}.lock')
+        if not self._owner.acquire(blocking=False):
+            raise QueueLocked(f"{self.path} is in use by another md2pdf daemon")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # One connection shared by all threads; every access holds self._lock
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(_SCHEMA)
+        with self._lock:
+            # Jobs interrupted by a previous shutdown or crash run again
+            resumed = self._db.execute(
+                "UPDATE jobs SET state = 'queued', started = NULL WHERE state = 'running'").rowcount
+            self._db.execute("DELETE FROM jobs WHERE finished < ?", (time.time() - KEEP_FINISHED,))
+        if resumed:
+            logger.info(f"Requeued {resumed} job(s) interrupted by the last shutdown")
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'queue-worker-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop taking new jobs; running jobs finish, queued ones stay for the next start"""
+        with self._lock:
+            self._stopping = True
+            self._work.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        with self._lock:
+            self._db.close()
+            self._db = None
+        self._owner.release()
+
+    def submit(self, input_file, output_file, priority='batch', engine='pandoc', options=None):
+        """Queue a conversion and return its job id; raises QueueFull or ValueError"""
+        if priority not in PRIORITIES:
+            raise ValueError(f"priority must be one of: {', '.join(PRIORITIES)}")
+        with self._lock:
+            waiting = self._db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+            if waiting >= self.limits[priority]:
+                self.rejected[priority] += 1
+                raise QueueFull(f"queue full ({waiting} waiting jobs)")
+            job_id = self._db.execute(
+                "INSERT INTO jobs (priority, state, input, output, engine, options, submitted) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+                (PRIORITIES[priority], os.path.abspath(input_file), os.path.abspath(output_file),
+                 engine, json.dumps(options or {}), time.time())
+            ).lastrowid
+            self._work.notify()
+        return job_id
+
+    def status(self, job_id):
+        """Job as a dict (None if unknown); queued jobs include their position"""
+        with self._lock:
+            row = self._db.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = dict(zip(_COLUMNS, row))
+            if job['state'] == 'queued':
+                job['position'] = self._db.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND (priority < ? OR (priority = ? AND id < ?))",
+                    (job['priority'], job['priority'], job_id)
+                ).fetchone()[0] + 1
+        job['priority'] = next(name for name, value in PRIORITIES.items() if value == job['priority'])
+        job['options'] = json.loads(job['options'])
+        return job
+
+    def _next_job(self):
+        """Claim the most urgent queued job; blocks until there is one (None when stopping)"""
+        with self._lock:
+            while True:
+                if self._stopping:
+                    return None
+                row = self._db.execute(
+                    "SELECT id, input, output, engine, options FROM jobs WHERE state = 'queued' "
+                    "ORDER BY priority, id LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    self._work.wait()
+                    continue
+                # Claim only if still queued: another connection may have taken it in between
+                claimed = self._db.execute(
+                    "UPDATE jobs SET state = 'running', started = ? WHERE id = ? AND state = 'queued'",
+                    (time.time(), row[0])
+                ).rowcount
+                if claimed:
+                    return row
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            job_id, input_file, output_file, engine, options = job
+            error = None
+            try:
+                with logsetup.job_context(f"queue-{job_id}"):
+                    success = bool(self.convert(input_file, output_file, engine, json.loads(options)))
+                if not success:
+                    error = 'conversion failed'
+            except Exception as e:
+                logger.error(f"✗ Job {job_id} crashed: {e}")
+                error = str(e)
+            with self._lock:
+                if self._db is None:
+                    return
+                self._db.execute(
+                    "UPDATE jobs SET state = ?, finished = ?, error = ? WHERE id = ?",
+                    ('failed' if error else 'done', time.time(), error, job_id)
+                )
+            logger.info(f"{'✗' if error else '✓'} Job {job_id}: {os.path.basename(input_file)}")
+
+    def metrics(self):
+        """Queue depth, latency percentiles (seconds) and throughput"""
+        now = time.time()
+        with self._lock:
+            depth = dict(self._db.execute(
+                "SELECT priority, COUNT(*) FROM jobs WHERE state = 'queued' GROUP BY priority").fetchall())
+            running = self._db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'running'").fetchone()[0]
+            recent = self._db.execute(
+                "SELECT state, started - submitted, finished - submitted FROM jobs WHERE finished >= ?",
+                (now - METRICS_WINDOW,)
+            ).fetchall()
+            totals = dict(self._db.execute(
+                "SELECT state, COUNT(*) FROM jobs WHERE finished >= ? GROUP BY state", (self.started,)).fetchall())
+
+        waits = sorted(wait for _, wait, _ in recent)
+        latencies = sorted(total for _, _, total in recent)
+        window = min(METRICS_WINDOW, now - self.started) or 1
+
+        def summary(values):
+            return {
+                'p50': percentile(values, 0.50),
+                'p90': percentile(values, 0.90),
+                'p99': percentile(values, 0.99),
+                'max': values[-1] if values else None,
+            }
+
+        return {
+            'workers': self.workers,
+            'queue_depth': {name: depth.get(value, 0) for name, value in PRIORITIES.items()},
+            'queue_limits': self.limits,
+            'running': running,
+            'completed': totals.get('done', 0),
+            'failed': totals.get('failed', 0),
+            'rejected': dict(self.rejected),
+            'window_seconds': METRICS_WINDOW,
+            'wait_seconds': summary(waits),
+            'latency_seconds': summary(latencies),
+            'throughput_per_minute': len(recent) / window * 60,
+            'uptime_seconds': now - self.started,
+        }
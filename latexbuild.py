@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental LaTeX builds
+Compiles the .tex that pandoc writes in a persistent build directory per
+document instead of letting pandoc run LaTeX in a throwaway temp dir:
+
+- the .aux/.toc/.out files of the previous build are kept, so an unchanged
+  document structure needs a single LaTeX pass instead of two or three;
+- LaTeX is rerun only while the log asks for it or the aux files still change;
+- with pdflatex the preamble (documentclass, geometry, fonts, highlighting
+  macros) is dumped into a format file once, via mylatexformat, and reused by
+  every document with the same preamble;
+- an identical .tex whose included images are unchanged and whose PDF is
+  still in the build directory is not compiled at all.
+
+Format files and build directories live in the `latex` folder of the cache
+directory. Each build directory has a lock file; callers hold it (see
+LatexBuilder.lock) while they write into the directory, and pruning only
+deletes whole build directories whose lock is free. When a format cannot be
+built (mylatexformat missing, a package that cannot be dumped) the document
+is compiled without it, and building it is retried after a day.
+"""
+
+import os
+import re
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import profiling
+import toolchain
+from cache import default_cache_dir, make_key, tool_fingerprint, FileLock
+
+logger = logging.getLogger(__name__)
+
+# Bump when the format or build layout changes
+FORMAT_VERSION = '1'
+
+# Upper bound on LaTeX passes for one build
+MAX_PASSES = 5
+
+# Files whose content decides whether another pass is needed
+AUX_EXTENSIONS = ('.aux', '.toc', '.out', '.lof', '.lot')
+
+# Engines whose preamble can be dumped; fontspec fonts (xelatex/lualatex) cannot
+FORMAT_ENGINES = ('pdflatex',)
+
+# Size limit of formats and build directories together
+LATEX_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# A preamble that could not be precompiled is tried again after this many seconds
+FORMAT_RETRY_SECONDS = 24 * 3600
+
+JOBNAME = 'document'
+# Held while a build directory is written (see LatexBuilder.lock)
+LOCK_FILE = '.lock'
+# Fingerprint of the images the last build included
+DEPS_FILE = JOBNAME + '.deps'
+
+_RERUN_RE = re.compile(
+    r'Rerun to get|Label\(s\) may have changed|Please rerun LaTeX|Rerun LaTeX'
+)
+_GRAPHICS_RE = re.compile(r'\\includegraphics\s*(?:\[[^\]]*\])?\{([^}]+)\}')
+
+
+def split_preamble(tex):
+    """Split LaTeX source into (preamble, body) at \\begin{document}"""
+    index = tex.find('\\begin{document}')
+    if index < 0:
+        return '', tex
+    return tex[:index], tex[index:]
+
+
+def _tree_size(path):
+    """(total bytes, newest mtime) of the files under path"""
+    total, newest = 0, 0.0
+    for parent, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.stat(os.path.join(parent, name))
+            except OSError:
+                continue
+            total += st.st_size
+            newest = max(newest, st.st_mtime)
+    return total, newest
+
+
+def _digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+class LatexBuilder:
+    """Compiles .tex files to PDF in persistent, per-document build directories"""
+
+    def __init__(self, cache_dir=None, use_format=True):
+        self.root = os.path.join(cache_dir or default_cache_dir(), 'latex')
+        self.formats_dir = os.path.join(self.root, 'formats')
+        self.builds_dir = os.path.join(self.root, 'build')
+        self.use_format = use_format
+
+    def build_dir(self, input_file, output_file, engine):
+        """Build directory of one document; kept between runs"""
+        key = make_key(os.path.abspath(input_file), os.path.abspath(output_file), engine)
+        path = os.path.join(self.builds_dir, key[:16])
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def lock(self, build_dir):
+        """Lock on a build directory (a context manager); hold it while writing into the directory.
+
+        Two conversions of the same document to the same output then build
+        one after the other instead of overwriting each other's files.
+        """
+        return FileLock(os.path.join(build_dir, LOCK_FILE))
+
+    def prune(self, max_bytes=LATEX_CACHE_MAX_BYTES):
+        """Delete least recently used formats and idle build directories until they fit in max_bytes.
+
+        A build directory is deleted as a whole, and only while its lock can
+        be taken, so directories in use are never touched.
+        """
+        entries = []
+        try:
+            names = os.listdir(self.formats_dir)
+        except OSError:
+            names = []
+        for name in names:
+            if name.startswith('.tmp-'):
+                continue
+            path = os.path.join(self.formats_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path, False))
+        try:
+            names = os.listdir(self.builds_dir)
+        except OSError:
+            names = []
+        for name in names:
+            path = os.path.join(self.builds_dir, name)
+            size, newest = _tree_size(path)
+            entries.append((newest, size, path, True))
+
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, path, is_build in sorted(entries):
+            if total <= max_bytes:
+                break
+            if not is_build:
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+                continue
+            lock = FileLock(os.path.join(path, LOCK_FILE))
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+            finally:
+                lock.release()
+
+    def _run(self, engine, args, cwd):
+        return toolchain.run_tool(
+            lambda tools: [tools.path(engine)] + args,
+            cwd=cwd,
+            capture_output=True,
+            text=True,
+            encoding='utf-8',
+            errors='replace'
+        )
+
+    def format_for(self, engine, tex_file, cwd):
+        """Path (without .fmt) of the precompiled preamble of tex_file, or None"""
+        if not self.use_format or engine not in FORMAT_ENGINES:
+            return None
+        with open(tex_file, 'r', encoding='utf-8') as f:
+            preamble, _ = split_preamble(f.read())
+        if not preamble:
+            return None
+
+        name = make_key(FORMAT_VERSION, preamble, tool_fingerprint(engine))[:24]
+        path = os.path.join(self.formats_dir, name)
+        if os.path.exists(path + '.fmt'):
+            # Mark as recently used
+            os.utime(path + '.fmt')
+            return path
+        try:
+            failed_at = os.path.getmtime(path + '.failed')
+        except OSError:
+            failed_at = None
+        if failed_at is not None:
+            if time.time() - failed_at < FORMAT_RETRY_SECONDS:
+                return None
+            # mylatexformat or a missing package may have been installed since
+            os.remove(path + '.failed')
+
+        os.makedirs(self.formats_dir, exist_ok=True)
+        # Dump into a temp dir and rename, so concurrent builds never load a partial format
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.formats_dir)
+        try:
+            with profiling.stage('latex_format', engine=engine):
+                self._run(engine, [
+                    '-ini',
+                    f'-jobname={name}',
+                    f'-output-directory={tmp}',
+                    '-interaction=nonstopmode',
+                    '-halt-on-error',
+                    f'&{engine}',
+                    'mylatexformat.ltx',
+                    tex_file,
+                ], cwd)
+            os.replace(os.path.join(tmp, name + '.fmt'), path + '.fmt')
+        except Exception as e:
+            logger.info(f"Preamble cannot be precompiled, compiling without a format ({str(e)})")
+            open(path + '.failed', 'w').close()
+            return None
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        logger.info(f"✓ Precompiled LaTeX preamble: {name}")
+        return path
+
+    def _aux_state(self, build_dir):
+        return {ext: _digest(os.path.join(build_dir, JOBNAME + ext)) for ext in AUX_EXTENSIONS}
+
+    def _needs_rerun(self, build_dir):
+        try:
+            with open(os.path.join(build_dir, JOBNAME + '.log'), 'r', encoding='utf-8', errors='replace') as f:
+                return _RERUN_RE.search(f.read()) is not None
+        except OSError:
+            return False
+
+    def _graphics_key(self, tex_source, cwd):
+        """Size and mtime of every image the source includes (resolved against cwd)"""
+        parts = []
+        for ref in sorted(set(_GRAPHICS_RE.findall(tex_source))):
+            try:
+                st = os.stat(os.path.join(cwd, ref.strip()))
+                parts.append(f'{ref}:{st.st_size}:{st.st_mtime_ns}')
+            except OSError:
+                parts.append(f'{ref}:missing')
+        return make_key('graphics', *parts)
+
+    def compile(self, tex_source, pdf_file, engine, build_dir, cwd):
+        """Compile LaTeX source to pdf_file; returns the number of passes run.
+
+        cwd is the directory relative image paths are resolved against (the
+        document's directory). The caller holds lock(build_dir).
+        Raises subprocess.CalledProcessError if LaTeX fails.
+        """
+        tex_file = os.path.join(build_dir, JOBNAME + '.tex')
+        built_pdf = os.path.join(build_dir, JOBNAME + '.pdf')
+        deps_file = os.path.join(build_dir, DEPS_FILE)
+        graphics = self._graphics_key(tex_source, cwd)
+
+        # Unchanged source and images, and a PDF from the last successful build: nothing to do
+        try:
+            with open(tex_file, 'r', encoding='utf-8') as f:
+                unchanged = f.read() == tex_source
+            with open(deps_file, 'r', encoding='utf-8') as f:
+                unchanged = unchanged and f.read() == graphics
+        except OSError:
+            unchanged = False
+        if unchanged and os.path.exists(built_pdf):
+            # Mark the build directory as recently used for pruning
+            os.utime(built_pdf)
+            shutil.copyfile(built_pdf, pdf_file)
+            logger.info("LaTeX source unchanged, reusing the previous build")
+            return 0
+
+        # A failed build must not leave a PDF that looks current
+        for path in (built_pdf, deps_file):
+            if os.path.exists(path):
+                os.remove(path)
+        with open(tex_file, 'w', encoding='utf-8') as f:
+            f.write(tex_source)
+
+        fmt = self.format_for(engine, tex_file, cwd)
+        args = [
+            '-interaction=nonstopmode',
+            '-halt-on-error',
+            '-file-line-error',
+            f'-output-directory={build_dir}',
+        ]
+        if fmt:
+            args.append(f'-fmt={fmt}')
+        args.append(tex_file)
+
+        passes = 0
+        while passes < MAX_PASSES:
+            before = self._aux_state(build_dir)
+            passes += 1
+            with profiling.stage('latex_pass', engine=engine, n=passes):
+                self._run(engine, args, cwd)
+            if not self._needs_rerun(build_dir) and self._aux_state(build_dir) == before:
+                break
+
+        shutil.copyfile(built_pdf, pdf_file)
+        with open(deps_file, 'w', encoding='utf-8') as f:
+            f.write(graphics)
+        logger.info(f"LaTeX finished after {passes} pass(es){' with precompiled preamble' if fmt else ''}")
+        self.prune()
+        return passes
+
+
+_builder = None
+
+
+def get_builder():
+    """The LatexBuilder of this process"""
+    global _builder
+    if _builder is None:
+        _builder = LatexBuilder()
+    return _builder
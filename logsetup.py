@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Logging for the command line, the GUI and the daemon
+Code that logs only puts records on a queue; one background thread formats
+them and does all file I/O, so a slow disk never stalls a conversion.
+
+- The console shows the usual one-line messages.
+- The log file holds one JSON object per record, with the job id of the
+  conversion that produced it, and is rotated by size. Only one process at
+  a time owns md2pdf.log; other processes started meanwhile (a second CLI
+  run next to the GUI or the daemon) write their own file under
+  processes/, so no file is rotated while another process appends to it.
+- Long pandoc/LaTeX output logged through log_output() is written to a
+  separate spill file per job; the log only keeps its tail and the file name.
+- Batch worker processes send their records to the parent's queue.
+
+    MD2PDF_LOG_DIR   directory of md2pdf.log and the spill files
+                     (default: "logs" in the cache directory)
+"""
+
+import os
+import re
+import json
+import time
+import queue
+import atexit
+import logging
+import itertools
+import contextvars
+import multiprocessing
+import logging.handlers
+from contextlib import contextmanager
+
+from cache import default_cache_dir, prune_files, FileLock
+
+LOG_FILE = 'md2pdf.log'
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 5
+# Logs of processes that did not own md2pdf.log
+PROCESS_LOG_DIR = 'processes'
+PROCESS_LOGS_MAX_BYTES = 20 * 1024 * 1024
+
+# Tool output longer than this goes to a spill file
+INLINE_OUTPUT_CHARS = 2000
+# Lines of spilled output kept in the log (LaTeX reports the error last)
+SUMMARY_LINES = 20
+SPILL_DIR = 'spill'
+SPILL_MAX_BYTES = 100 * 1024 * 1024
+
+CONSOLE_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_job_id = contextvars.ContextVar('md2pdf_job_id', default=None)
+
+_queue = None
+_listener = None
+# Held while this process writes (and rotates) md2pdf.log
+_owner = None
+
+
+def default_log_dir():
+    return os.environ.get('MD2PDF_LOG_DIR') or os.path.join(default_cache_dir(), 'logs')
+
+
+@contextmanager
+def job_context(job_id):
+    """Tag the records logged in this block (in this thread) with job_id"""
+    token = _job_id.set(str(job_id))
+    try:
+        yield
+    finally:
+        _job_id.reset(token)
+
+
+def current_job():
+    return _job_id.get()
+
+
+class _JobFilter(logging.Filter):
+    """Runs in the thread that logs, where the job context is set"""
+
+    def filter(self, record):
+        if not hasattr(record, 'job'):
+            record.job = _job_id.get()
+        record.process_name = multiprocessing.current_process().name
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'job': getattr(record, 'job', None),
+            'process': getattr(record, 'process_name', record.processName),
+        }
+        spill = getattr(record, 'spill_file', None)
+        if spill:
+            entry['spill_file'] = spill
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def summarize(text, lines=SUMMARY_LINES):
+    """Last `lines` lines of text, shortened to INLINE_OUTPUT_CHARS"""
+    tail = '\n'.join(text.rstrip().splitlines()[-lines:])
+    if len(tail) > INLINE_OUTPUT_CHARS:
+        tail = '...' + tail[-INLINE_OUTPUT_CHARS:]
+    return tail
+
+
+def log_output(logger, level, label, text):
+    """Log tool output; long output is spilled to a file by the logging thread"""
+    if not text or not logger.isEnabledFor(level):
+        return
+    if len(text) <= INLINE_OUTPUT_CHARS:
+        logger.log(level, f"{label}: {text}")
+    else:
+        logger.log(level, f"{label} ({len(text)} chars)", extra={'output': text, 'output_label': label})
+
+
+class _Listener(logging.handlers.QueueListener):
+    """Background writer; moves long tool output into spill files"""
+
+    def __init__(self, log_queue, handlers, log_dir):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.spill_dir = os.path.join(log_dir, SPILL_DIR)
+        self._numbers = itertools.count(1)
+
+    def prepare(self, record):
+        output = getattr(record, 'output', None)
+        if output is None:
+            return record
+        del record.output
+        summary = summarize(output)
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            label = re.sub(r'\W+', '-', record.output_label).strip('-').lower()
+            name = (f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(record.created))}-"
+                    f"{next(self._numbers)}-{record.job or record.process}-{label}.log")
+            path = os.path.join(self.spill_dir, re.sub(r'[^\w.-]+', '_', name))
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(output)
+            record.spill_file = path
+            record.msg = f"{record.getMessage()}, full output in {path}:\n{summary}"
+            prune_files(self.spill_dir, SPILL_MAX_BYTES)
+        except OSError as e:
+            record.msg = f"{record.getMessage()} (could not write spill file: {e}):\n{summary}"
+        record.args = None
+        return record
+
+
+def _file_handler(log_dir):
+    """(handler, path) of this process's log file: md2pdf.log if no other process owns it"""
+    global _owner
+    _owner = FileLock(os.path.join(log_dir, f'{LOG_FILE}.lock'))
+    if _owner.acquire(blocking=False):
+        path = os.path.join(log_dir, LOG_FILE)
+        return logging.handlers.RotatingFileHandler(
+            path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8', delay=True), path
+    _owner = None
+    process_dir = os.path.join(log_dir, PROCESS_LOG_DIR)
+    os.makedirs(process_dir, exist_ok=True)
+    prune_files(process_dir, PROCESS_LOGS_MAX_BYTES)
+    path = os.path.join(process_dir, f"{os.path.splitext(LOG_FILE)[0]}-{os.getpid()}.log")
+    return logging.FileHandler(path, encoding='utf-8', delay=True), path
+
+
+def _release_owner():
+    global _owner
+    if _owner is not None:
+        _owner.release()
+        _owner = None
+
+
+def setup_logging(level=logging.INFO, log_dir=None, console=True):
+    """Route all logging through a queue to the console and a JSON log file.
+
+    `level` applies to the root logger, so it covers every module (--debug).
+    Replaces the handlers of the root logger; safe to call more than once.
+    Returns the log file path (None if it could not be opened).
+    """
+    global _queue, _listener
+    if _listener is not None:
+        _listener.stop()
+    _release_owner()
+
+    log_dir = log_dir or default_log_dir()
+    handlers = []
+    if console:
+        stream = logging.StreamHandler()
+        stream.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        handlers.append(stream)
+    try:
+        os.makedirs(log_dir, exist_ok=True)
+        file_handler, log_path = _file_handler(log_dir)
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+    except OSError:
+        log_path = None
+
+    # A multiprocessing queue so batch workers can log to it as well
+    _queue = multiprocessing.Queue(-1)
+    _listener = _Listener(_queue, handlers, log_dir)
+    _install(_queue, level)
+    _listener.start()
+    # Registered after the queue exists, so it runs before multiprocessing's
+    # exit handler closes the queue under the listener thread
+    atexit.unregister(shutdown)
+    atexit.register(shutdown)
+    return log_path
+
+
+def _install(log_queue, level):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(_JobFilter())
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+def worker_config():
+    """Arguments for init_worker in a child process (None if logging is not set up)"""
+    if _queue is None:
+        return None
+    return _queue, logging.getLogger().level
+
+
+def init_worker(config):
+    """Send the records of a worker process to the parent's logging thread"""
+    if config is not None:
+        _install(*config)
+
+
+def shutdown():
+    """Write out the queued records and stop the logging thread"""
+    global _listener
+    if _listener is not None:
+        try:
+            _listener.stop()
+        except (OSError, ValueError, queue.Full):
+            pass
+        _listener = None
+    _release_owner()
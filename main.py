@@ -1,6 +1,12 @@
+import time
+
+# 启动计时：从进程开始执行脚本到窗口第一次显示
+START_TIME = time.perf_counter()
+
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
 import threading
+import multiprocessing
 import sys
 import os
 from pathlib import Path
@@ -13,7 +19,18 @@ else:
 
 sys.path.insert(0, application_path)
 
-from converter import convert_md_to_pdf
+import profiling
+from uievents import UiQueue, LogView, StageProgress
+
+# converter（markdown、weasyprint）导入较慢，窗口显示后在后台线程中加载
+
+# 各转换方式依次经过的阶段及其大致耗时占比，用于显示进度
+STAGE_PLANS = {
+    'single': {'cache_lookup': 1, 'read': 1, 'preprocess_math': 2, 'markdown': 5, 'render_math': 10,
+               'highlight': 3, 'html_assembly': 2, 'images': 5, 'font_subset': 4, 'layout': 50, 'write_pdf': 20},
+    'streaming': {'cache_lookup': 1, 'stream_html': 30, 'font_subset': 4, 'layout': 45, 'write_pdf': 20},
+    'chunked': {'cache_lookup': 1, 'read': 1, 'render_chunks': 88, 'merge_pdf': 10},
+}
 
 class MDToPDFConverter:
     def __init__(self, root):
@@ -22,8 +39,23 @@ class MDToPDFConverter:
         self.root.geometry("700x500")
         self.root.resizable(True, True)
         
+        # 转换引擎加载完成后置位；之前提交的转换会等待
+        self.ready = threading.Event()
+        self.convert = None
+        self.warm_up_error = None
+        
         # 创建UI
         self.create_widgets()
+        
+        # 工作线程只向队列发送事件，由Tk主循环定时批量更新界面
+        self.events = UiQueue(self.root)
+        self.events.on('log', self.log_view.append)
+        self.events.on('status', self.status_var.set, coalesce=True)
+        self.events.on('progress', self.progress_var.set, coalesce=True)
+        self.events.start()
+        
+        # 窗口显示后记录启动耗时并开始后台加载
+        self.root.bind('<Map>', self.on_first_map)
     
     def create_widgets(self):
         # 主框架
@@ -48,15 +80,24 @@ class MDToPDFConverter:
         self.convert_btn = ttk.Button(button_frame, text="开始转换", command=self.start_conversion)
         self.convert_btn.pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="使用说明", command=self.show_help).pack(side=tk.LEFT, padx=5)
+        self.chunked_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(button_frame, text="分块并行渲染（超大文档）", variable=self.chunked_var).pack(side=tk.LEFT, padx=5)
         
-        # 进度条
-        self.progress = ttk.Progressbar(main_frame, mode='indeterminate')
+        # 进度条：按转换阶段推进
+        self.progress_var = tk.DoubleVar()
+        self.progress = ttk.Progressbar(main_frame, mode='determinate', maximum=100, variable=self.progress_var)
         self.progress.grid(row=3, column=0, columnspan=3, sticky=tk.EW, pady=(0, 10))
         
         # 日志区域
         ttk.Label(main_frame, text="转换日志:").grid(row=4, column=0, sticky=tk.W, pady=(10, 5))
         self.log_text = scrolledtext.ScrolledText(main_frame, height=15, font=('Consolas', 9))
         self.log_text.grid(row=5, column=0, columnspan=3, sticky=tk.EW)
+        # 只保留最近的日志行
+        self.log_view = LogView(self.log_text)
+        
+        # 状态栏
+        self.status_var = tk.StringVar(value="⏳ 正在加载转换引擎...")
+        ttk.Label(main_frame, textvariable=self.status_var).grid(row=6, column=0, columnspan=3, sticky=tk.W, pady=(5, 0))
         
         # 配置列权重
         main_frame.columnconfigure(1, weight=1)
@@ -64,6 +105,36 @@ class MDToPDFConverter:
         # 设置默认值
         self.set_defaults()
     
+    def on_first_map(self, event):
+        if event.widget is not self.root:
+            return
+        self.root.unbind('<Map>')
+        elapsed = (time.perf_counter() - START_TIME) * 1000
+        self.log(f"窗口启动用时 {elapsed:.0f} ms")
+        threading.Thread(target=self.warm_up, daemon=True).start()
+    
+    def warm_up(self):
+        """后台线程：导入转换模块并预热字体和排版引擎"""
+        start = time.perf_counter()
+        try:
+            import converter
+            self.convert = converter.convert_md_to_pdf
+            converter.warm_up(application_path)
+        except Exception as e:
+            # 预热失败不影响转换：转换时会报告真正的错误
+            self.warm_up_error = e
+        elapsed = time.perf_counter() - start
+        self.ready.set()
+        self.events.call(self.show_ready, elapsed)
+    
+    def show_ready(self, elapsed):
+        if self.convert is None:
+            self.status_var.set(f"❌ 转换引擎加载失败: {self.warm_up_error}")
+        elif self.warm_up_error is not None:
+            self.status_var.set(f"⚠ 转换引擎已加载，预热失败: {self.warm_up_error}")
+        else:
+            self.status_var.set(f"✅ 就绪（转换引擎加载用时 {elapsed:.1f} 秒）")
+    
     def set_defaults(self):
         desktop = str(Path.home() / "Desktop")
         self.pdf_var.set(os.path.join(desktop, "output.pdf"))
@@ -89,9 +160,8 @@ class MDToPDFConverter:
             self.pdf_var.set(file_path)
     
     def log(self, message):
-        self.log_text.insert(tk.END, message + "\n")
-        self.log_text.see(tk.END)
-        self.root.update_idletasks()
+        """可在任意线程调用"""
+        self.events.post('log', message)
     
     def start_conversion(self):
         md_file = self.md_var.get().strip()
@@ -105,40 +175,77 @@ class MDToPDFConverter:
             messagebox.showerror("错误", f"文件不存在: {md_file}")
             return
         
-        # 禁用按钮，启用进度条
+        # 禁用按钮，进度清零
         self.convert_btn.config(state=tk.DISABLED)
-        self.progress.start()
-        self.log_text.delete(1.0, tk.END)
+        self.progress_var.set(0)
+        self.log_view.clear()
         
         # 在新线程中执行转换
         threading.Thread(
             target=self.run_conversion,
-            args=(md_file, pdf_file),
+            args=(md_file, pdf_file, self.chunked_var.get()),
             daemon=True
         ).start()
     
-    def run_conversion(self, md_file, pdf_file):
+    def run_conversion(self, md_file, pdf_file, chunked=False):
         try:
             self.log("开始转换...")
             self.log(f"输入: {md_file}")
             self.log(f"输出: {pdf_file}")
             
+            # 转换引擎还在后台加载时排队等待
+            if not self.ready.is_set():
+                self.log("⏳ 转换引擎加载中，任务已排队...")
+                self.ready.wait()
+            if self.convert is None:
+                raise RuntimeError(f"转换引擎加载失败: {self.warm_up_error}")
+            
             # 执行转换
-            success = convert_md_to_pdf(md_file, pdf_file, application_path)
+            if chunked:
+                self.log("分块并行渲染已开启")
+            success = self.convert_with_progress(md_file, pdf_file, chunked)
             
             if success:
+                self.events.post('progress', 100)
+                self.events.post('status', "✅ 转换完成")
                 self.log("✅ 转换成功！")
                 # 询问是否打开PDF
-                self.root.after(0, lambda: self.ask_open_pdf(pdf_file))
+                self.events.call(self.ask_open_pdf, pdf_file)
             else:
+                self.events.post('status', "❌ 转换失败")
                 self.log("❌ 转换失败")
-                self.root.after(0, lambda: messagebox.showerror("错误", "转换失败，请查看日志"))
+                self.events.call(messagebox.showerror, "错误", "转换失败，请查看日志")
                 
         except Exception as e:
+            self.events.post('status', f"❌ 错误: {str(e)}")
             self.log(f"❌ 错误: {str(e)}")
-            self.root.after(0, lambda: messagebox.showerror("错误", str(e)))
+            self.events.call(messagebox.showerror, "错误", str(e))
+        finally:
+            self.events.call(self.restore_ui)
+    
+    def convert_with_progress(self, md_file, pdf_file, chunked):
+        """转换线程：通过profiling的阶段回调报告进度"""
+        import converter
+        if chunked:
+            plan = STAGE_PLANS['chunked']
+        elif converter.use_streaming(md_file):
+            plan = STAGE_PLANS['streaming']
+        else:
+            plan = STAGE_PLANS['single']
+        
+        def report(fraction, stage):
+            self.events.post('progress', fraction * 100)
+            self.events.post('status', f"⏳ 转换中：{stage} 完成（{fraction:.0%}）")
+        
+        progress = StageProgress(plan, report)
+        # 只计时，不跟踪内存
+        profiling.start_tracing(trace_memory=False)
+        profiling.add_hook(progress.hook)
+        try:
+            return self.convert(md_file, pdf_file, application_path, chunked=chunked)
         finally:
-            self.root.after(0, self.restore_ui)
+            profiling.remove_hook(progress.hook)
+            profiling.stop_tracing()
     
     def ask_open_pdf(self, pdf_file):
         if os.path.exists(pdf_file):
@@ -155,7 +262,6 @@ class MDToPDFConverter:
     
     def restore_ui(self):
         self.convert_btn.config(state=tk.NORMAL)
-        self.progress.stop()
     
     def show_help(self):
         help_text = """
@@ -173,13 +279,14 @@ class MDToPDFConverter:
    - PDF包含可点击目录和正确渲染的数学公式
 
 注意事项：
-- 首次运行可能需要几秒钟初始化
+- 转换引擎在后台加载，状态栏显示"就绪"之前提交的转换会自动排队
 - 确保有足够的磁盘空间
 - 中文显示需要系统支持
         """
         messagebox.showinfo("使用说明", help_text)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = MDToPDFConverter(root)
     root.mainloop()
\ No newline at end of file
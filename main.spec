@@ -5,7 +5,7 @@ a = Analysis(
     ['main.py'],
     pathex=[],
     binaries=[],
-    datas=[('mathjax', 'mathjax')],
+    datas=[('mathjax', 'mathjax'), ('styles.css', '.')],
     hiddenimports=['markdown.extensions.tables', 'markdown.extensions.fenced_code'],
     hookspath=[],
     hooksconfig={},
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+离线数学公式渲染
+
+把TeX公式渲染成WeasyPrint可以排版的SVG，结果按 (公式, 显示模式) 缓存在内存和磁盘上，
+同一文档和同一批次中重复出现的公式只渲染一次。
+
+渲染后端（按优先级）：
+- ziamath：纯Python，支持完整的LaTeX数学语法
+- matplotlib.mathtext：支持常用的TeX子集
+都未安装时退回到原样输出TeX源码。
+"""
+
+import io
+import os
+import re
+import html
+import base64
+import logging
+import threading
+
+from cache import default_cache_dir, make_key, prune_files, LRUDict
+from mathscan import render_formula
+
+logger = logging.getLogger(__name__)
+
+# 公式字号（与正文12pt/16px一致）
+FONT_SIZE_PX = 16
+
+# 内存中保留的公式数（常驻服务和图形界面会转换很多文档）
+MEMORY_ENTRIES = 4096
+# 磁盘缓存的大小上限；每写入 PRUNE_INTERVAL 个新公式检查一次
+MATH_CACHE_MAX_BYTES = 256 * 1024 * 1024
+PRUNE_INTERVAL = 500
+
+_VIEWBOX_RE = re.compile(r'viewBox="\s*([-\d.]+)[\s,]+([-\d.]+)[\s,]+([-\d.]+)[\s,]+([-\d.]+)\s*"')
+
+
+def _render_ziamath(tex, display):
+    """用ziamath渲染，返回 (svg, 基线以下的深度px)"""
+    import ziamath
+    svg = ziamath.Latex(tex, size=FONT_SIZE_PX, inline=not display).svg()
+    depth = 0.0
+    match = _VIEWBOX_RE.search(svg)
+    if match:
+        # viewBox的y=0是基线
+        min_y, height = float(match.group(2)), float(match.group(4))
+        depth = max(0.0, min_y + height)
+    return svg, depth
+
+
+def _render_matplotlib(tex, display):
+    """用matplotlib.mathtext渲染，返回 (svg, 基线以下的深度px)"""
+    from matplotlib import mathtext
+    from matplotlib.font_manager import FontProperties
+    buf = io.BytesIO()
+    # mathtext按72dpi输出，单位为pt；换算为px
+    depth = mathtext.math_to_image(f'${tex}$', buf, prop=FontProperties(size=FONT_SIZE_PX * 0.75), format='svg')
+    return buf.getvalue().decode('utf-8'), (depth or 0.0) / 0.75
+
+
+def _detect_backend():
+    """返回 (后端名称, 渲染函数)"""
+    try:
+        import ziamath
+        return f'ziamath-{getattr(ziamath, "__version__", "0")}', _render_ziamath
+    except ImportError:
+        pass
+    try:
+        import matplotlib
+        return f'matplotlib-{matplotlib.__version__}', _render_matplotlib
+    except ImportError:
+        pass
+    return 'tex', None
+
+
+class MathRenderer:
+    """带两级缓存（内存+磁盘）的公式渲染器"""
+
+    def __init__(self, cache_dir=None):
+        self.backend, self._render = _detect_backend()
+        self.cache_dir = cache_dir or os.path.join(default_cache_dir(), 'math')
+        self._memory = LRUDict(MEMORY_ENTRIES)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # 距上次清理磁盘缓存后写入的公式数；None表示本进程还没有清理过
+        self._saved = None
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.html')
+
+    def render(self, tex, display):
+        """返回公式的HTML片段"""
+        if self._render is None:
+            return render_formula(tex, display)
+
+        key = make_key(self.backend, 'display' if display else 'inline', tex)
+        cached = self._memory.get(key)
+        if cached is not None:
+            self._count(hit=True)
+            return cached
+
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                fragment = f.read()
+            self._count(hit=True)
+            # 标记为最近使用
+            os.utime(path)
+        except OSError:
+            self._count(hit=False)
+            fragment = self._render_fragment(tex, display)
+            if fragment is None:
+                # 渲染失败不写入磁盘，升级渲染后端或修正公式后会重新渲染
+                fragment = render_formula(tex, display)
+            else:
+                self._save(path, fragment)
+
+        self._memory.put(key, fragment)
+        return fragment
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _render_fragment(self, tex, display):
+        """渲染为HTML片段，失败时返回None"""
+        try:
+            svg, depth = self._render(tex, display)
+        except Exception as e:
+            # 后端不支持的语法保留TeX源码，不影响整篇文档
+            logger.warning(f"⚠ 公式渲染失败，保留源码: {tex[:60]} ({e})")
+            return None
+
+        data = base64.b64encode(svg.encode('utf-8')).decode('ascii')
+        alt = html.escape(tex)
+        src = f'data:image/svg+xml;base64,{data}'
+        if display:
+            return f'<div class="math"><img class="math-svg" alt="{alt}" src="{src}"></div>'
+        return (f'<span class="math inline"><img class="math-svg" alt="{alt}" '
+                f'style="vertical-align: -{depth:.2f}px" src="{src}"></span>')
+
+    def _save(self, path, fragment):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(fragment)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.debug(f"无法写入公式缓存: {e}")
+            return
+        with self._lock:
+            prune = self._saved is None or self._saved >= PRUNE_INTERVAL
+            self._saved = 0 if prune else self._saved + 1
+        if prune:
+            prune_files(self.cache_dir, MATH_CACHE_MAX_BYTES)
+
+
+_default_renderer = None
+
+
+def get_renderer():
+    """进程内共享的渲染器，批量转换时内存缓存跨文档复用"""
+    global _default_renderer
+    if _default_renderer is None:
+        _default_renderer = MathRenderer()
+    return _default_renderer
+
+
+def render_math(tex, display):
+    """restore_math 使用的渲染回调"""
+    return get_renderer().render(tex, display)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+单遍扫描的数学公式/代码分词器
+
+在一次线性扫描中识别 $$...$$（块级公式）和 $...$（行内公式），
+跳过围栏代码块、行内代码和链接/图片，处理转义的 \\$，并把公式替换成占位符，
+Markdown转换完成后再还原成HTML。
+
+与Markdown一样，行内代码和公式的闭合符号不会越过空行或围栏代码块。
+"""
+
+import re
+import html
+
+# 占位符使用Unicode私有区字符，Markdown不会改动它们
+PLACEHOLDER_START = '\ue000'
+PLACEHOLDER_END = '\ue001'
+PLACEHOLDER_RE = re.compile(PLACEHOLDER_START + r'(\d+)' + PLACEHOLDER_END)
+# 单独成段的块级公式，还原时去掉外层<p>
+DISPLAY_PARAGRAPH_RE = re.compile(r'<p>\s*' + PLACEHOLDER_START + r'(\d+)' + PLACEHOLDER_END + r'\s*</p>')
+
+# 需要停下来处理的字符：只有公式、代码和转义符号的起始字符
+_SPECIAL_RE = re.compile(r'[$`\\]')
+# 行内公式的闭合 $：前面不是空白或反斜杠，后面不紧跟数字
+_INLINE_CLOSE_RE = re.compile(r'\$(?!\d)(?<=[^\s\\]\$)')
+# 围栏代码块的起始行
+_FENCE_RE = re.compile(r'[ \t]*(`{3,}|~{3,})')
+_FENCE_LINE_RE = re.compile(r'^[ \t]*(`{3,}|~{3,})', re.M)
+# 段落的结束：空行之前或围栏代码块之前的换行
+_BLOCK_END_RE = re.compile(r'\n(?=[ \t]*(?:\n|$|`{3,}|~{3,}))')
+# 链接和图片：[文字](地址)、[文字][引用]；文字中允许一层方括号（如图片链接）
+_LINK_RE = re.compile(
+    r'\[(?:[^\[\]\\]|\\.|\[(?:[^\[\]\\]|\\.)*\])*\]'
+    r'(?:\((?:[^()\\]|\\.|\([^()]*\))*\)|\[[^\[\]]*\])', re.S)
+
+
+def _placeholder(index):
+    return f'{PLACEHOLDER_START}{index}{PLACEHOLDER_END}'
+
+
+def _line_end(text, pos):
+    end = text.find('\n', pos)
+    return len(text) if end < 0 else end
+
+
+def _next_of(text, needles, start, end):
+    """needles中任一个在text[start:end]中第一次出现的位置，都没有时返回end"""
+    for needle in needles:
+        found = text.find(needle, start, end)
+        if found >= 0:
+            end = found
+    return end
+
+
+def _block_end(text, pos):
+    """pos所在段落的结束位置"""
+    match = _BLOCK_END_RE.search(text, pos)
+    return len(text) if match is None else match.start()
+
+
+def _closer(fence):
+    return re.compile(r'^[ \t]*' + re.escape(fence[0]) + '{' + str(len(fence)) + r',}[ \t]*$', re.M)
+
+
+def match_fence(line):
+    """line是围栏代码块的起始行时返回围栏（如 '```'），否则返回None"""
+    match = _FENCE_RE.match(line)
+    return match.group(1) if match else None
+
+
+def closes_fence(line, fence):
+    """line是否结束以fence开始的围栏代码块"""
+    return _closer(fence).match(line.rstrip('\r\n')) is not None
+
+
+def _skip_fence(text, pos, fence):
+    """返回围栏代码块之后的位置（找不到结束围栏时代码块延续到文末）"""
+    found = _closer(fence).search(text, _line_end(text, pos) + 1)
+    return len(text) if found is None else found.end()
+
+
+def scan_math(text):
+    """扫描文本，把公式替换为占位符
+
+    返回 (替换后的文本, 公式列表)，公式列表的元素为 (tex, display)。
+    扫描只停在 $、` 和 \\ 上；段落、行和围栏代码块的边界以及链接，
+    都只在遇到这些字符时才向前查找，总耗时与文本长度成正比。
+    """
+    n = len(text)
+    out = []
+    formulas = []
+    # 下一个围栏代码块的起始行
+    fence = _FENCE_LINE_RE.search(text)
+    # 当前段落、当前行的结束位置；闭合符号只在段落（行内公式只在本行）内查找
+    block_end = -1
+    line_end = -1
+    # 已知到该位置（所在段落的结束）为止不存在闭合的 $$ / 某长度的反引号串 / 链接，
+    # 以及本行的行内闭合 $
+    no_display_until = -1
+    no_backticks_until = {}
+    no_link_until = -1
+    no_inline_from = -1
+    no_inline_until = -1
+    # 该位置之前的 [ 都已检查过
+    links_checked = 0
+
+    copied = 0
+    pos = 0
+    while pos < n:
+        match = _SPECIAL_RE.search(text, pos)
+        if match is None:
+            break
+        pos = match.start()
+        if fence is not None and pos >= fence.start():
+            # 围栏代码块原样保留
+            pos = links_checked = _skip_fence(text, fence.start(), fence.group(1))
+            fence = _FENCE_LINE_RE.search(text, pos)
+            continue
+        char = text[pos]
+
+        if char == '\\':
+            if text.startswith('$', pos + 1):
+                # 转义的美元符号输出为普通的 $
+                out.append(text[copied:pos])
+                out.append('$')
+                copied = pos + 2
+            pos += 2
+            continue
+
+        if pos > block_end:
+            block_end = _block_end(text, pos)
+
+        # 链接和图片原样保留：替代文本和地址在HTML属性中，不能放入公式的HTML
+        link_end = -1
+        if pos >= no_link_until:
+            bracket = text.find('[', links_checked, pos)
+            while bracket >= 0:
+                if text.find(']', bracket + 1, block_end) < 0:
+                    # 本段余下部分没有 ]，也就没有链接
+                    no_link_until = block_end
+                    break
+                escaped = text.startswith('\\', bracket - 1, bracket)
+                link = None if escaped else _LINK_RE.match(text, bracket, block_end)
+                if link is None:
+                    links_checked = bracket + 1
+                elif link.end() <= pos:
+                    links_checked = link.end()
+                elif _block_end(text, bracket) >= pos:
+                    link_end = link.end()
+                    break
+                else:
+                    # 链接在前面的段落，不能越过段落包住当前位置
+                    links_checked = bracket + 1
+                bracket = text.find('[', links_checked, pos)
+        if link_end >= 0:
+            pos = links_checked = link_end
+            continue
+        links_checked = pos
+
+        if char == '`':
+            run_end = pos
+            while run_end < n and text[run_end] == '`':
+                run_end += 1
+            length = run_end - pos
+            close = -1
+            if run_end >= no_backticks_until.get(length, -1):
+                closer = re.compile(r'(?<!`)`{' + str(length) + r'}(?!`)')
+                found = closer.search(text, run_end, block_end)
+                if found:
+                    close = found.end()
+                else:
+                    no_backticks_until[length] = block_end
+            # 行内代码原样保留；没有闭合时反引号按普通字符处理
+            pos = close if close >= 0 else run_end
+
+        elif text.startswith('$$', pos):
+            close = -1
+            if pos >= no_display_until:
+                close = text.find('$$', pos + 2, block_end)
+                if close < 0:
+                    no_display_until = block_end
+            if close < 0:
+                pos += 2
+                continue
+            out.append(text[copied:pos])
+            out.append(_placeholder(len(formulas)))
+            formulas.append((text[pos + 2:close].strip(), True))
+            pos = copied = close + 2
+
+        else:
+            # 行内公式：$ 后不能是空白，闭合 $ 前不能是空白且后面不能紧跟数字
+            close = -1
+            if pos > line_end:
+                line_end = _line_end(text, pos)
+            next_char = text[pos + 1] if pos + 1 < n else ' '
+            if not next_char.isspace() and not (no_inline_from <= pos < no_inline_until):
+                found = _INLINE_CLOSE_RE.search(text, pos + 2, line_end)
+                if found:
+                    close = found.start()
+                else:
+                    # 本行余下部分不存在合法的闭合 $
+                    no_inline_from, no_inline_until = pos, line_end
+            if close < 0:
+                if no_inline_from <= pos < no_inline_until:
+                    # 本行余下的单个 $ 都是普通字符，一次跳过
+                    pos = _next_of(text, ('$$', '`', '\\'), pos + 1, no_inline_until)
+                else:
+                    pos += 1
+                continue
+            out.append(text[copied:pos])
+            out.append(_placeholder(len(formulas)))
+            formulas.append((text[pos + 1:close], False))
+            pos = copied = close + 1
+
+    out.append(text[copied:])
+    return ''.join(out), formulas
+
+
+def render_formula(tex, display):
+    """默认的公式HTML：保留TeX源码，交给样式表排版"""
+    if display:
+        return f'<div class="math">{html.escape(tex, quote=False)}</div>'
+    return f'<span class="math inline">{html.escape(tex, quote=False)}</span>'
+
+
+def restore_math(html_text, formulas, render=render_formula):
+    """把HTML中的占位符还原为公式HTML"""
+    if not formulas:
+        return html_text
+
+    def replace_paragraph(match):
+        tex, display = formulas[int(match.group(1))]
+        if not display:
+            return match.group(0)
+        return render(tex, display)
+
+    html_text = DISPLAY_PARAGRAPH_RE.sub(replace_paragraph, html_text)
+    return PLACEHOLDER_RE.sub(lambda m: render(*formulas[int(m.group(1))]), html_text)
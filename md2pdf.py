@@ -7,64 +7,51 @@ Requires: pandoc, miktex (xelatex)
 """
 
 import argparse
+import atexit
 import subprocess
 import logging
 import os
 import tempfile
 import sys
+import contextvars
+import multiprocessing
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from batch import run_batch, default_workers, output_collisions
+from cache import OutputCache, make_key, tool_fingerprint, release_output
+import profiling
+from logsetup import setup_logging, log_output
+import toolchain
+import images
+import highlight
+import latexbuild
+from treebuild import references_key
+import engines
+from supervisor import JobKilled
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('md2pdf.log', encoding='utf-8')
-    ]
-)
 logger = logging.getLogger(__name__)
 
-def check_dependencies():
-    """Check if required dependencies are installed"""
+def check_dependencies(refresh=False):
+    """Check if required dependencies are installed
+    
+    Uses the cached toolchain probe; refresh=True spawns the tools again.
+    """
     logger.info("Checking dependencies...")
+    tools = toolchain.get_toolchain(refresh=refresh)
     
     # Check pandoc
-    try:
-        result = subprocess.run(
-            ['pandoc', '--version'],
-            capture_output=True,
-            text=True,
-            check=True,
-            encoding='utf-8'
-        )
-        logger.info(f"✓ Pandoc found: {result.stdout.splitlines()[0]}")
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    if not tools.has('pandoc'):
         logger.error("✗ Pandoc not found. Please install pandoc first.")
         return False
-    except UnicodeDecodeError:
-        logger.warning("⚠ Pandoc version check: Unicode decode error, but pandoc is available")
+    logger.info(f"✓ Pandoc found: {tools.version('pandoc')}")
     
-    # Check xelatex (miktex)
-    try:
-        result = subprocess.run(
-            ['xelatex', '--version'],
-            capture_output=True,
-            text=True,
-            check=True,
-            encoding='utf-8'
-        )
-        # Try to get version info, but don't fail if it's not available
-        try:
-            version_line = result.stdout.splitlines()[0].strip()
-            logger.info(f"✓ XeLaTeX found: {version_line}")
-        except (IndexError, AttributeError):
-            logger.info("✓ XeLaTeX found: Version information not available")
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        logger.error("✗ XeLaTeX not found. Please install MikTeX first.")
+    # Check LaTeX engines (miktex)
+    if not tools.pdf_engines:
+        logger.error("✗ No LaTeX engine (pdflatex/xelatex) found. Please install MikTeX first.")
         return False
-    except UnicodeDecodeError:
-        logger.warning("⚠ XeLaTeX version check: Unicode decode error, but xelatex is available")
+    for engine in tools.pdf_engines:
+        logger.info(f"✓ {engine} found: {tools.version(engine)}")
     
     return True
 
@@ -79,7 +66,7 @@ def build_pandoc_command(input_file, output_file, debug=False):
         'pandoc',
         input_abs,
         '-o', output_abs,
-        '--syntax-highlighting=tango',  # Replace deprecated --highlight-style
+        toolchain.get_toolchain().highlight_option('tango'),  # --highlight-style on older pandoc
         '-V', 'geometry:margin=1in',
         '-V', 'documentclass=article',
         '-V', 'fontsize=12pt',
@@ -92,8 +79,48 @@ def build_pandoc_command(input_file, output_file, debug=False):
     
     return cmd
 
-def convert_md_to_pdf(input_file, output_file, debug=False):
-    """Convert Markdown file to PDF"""
+# Output formats that can be emitted from the parsed document, with their extensions
+OUTPUT_FORMATS = {'pdf': '.pdf', 'html': '.html', 'docx': '.docx', 'epub': '.epub'}
+
+# Markdown dialect of the input
+INPUT_FORMAT = 'markdown+raw_html+tex_math_dollars'  # Support math and raw html
+
+def format_options(fmt, tools):
+    """pandoc writer options for each output format"""
+    highlight = tools.highlight_option('default')  # Use default highlighting which requires fewer packages
+    if fmt == 'pdf':
+        return [
+            f"--pdf-engine={tools.pdf_engine('pdflatex')}",  # Use pdflatex for better reliability
+            highlight,
+            '-V', 'geometry:margin=1in',
+            '-V', 'documentclass=article',
+            '-V', 'fontsize=12pt'
+        ]
+    if fmt == 'html':
+        return [
+            '--mathjax',
+            '-s',  # Standalone HTML with header and footer
+            highlight
+        ]
+    return [highlight]
+
+def convert_md_to_pdf(input_file, output_file, debug=False, use_cache=True, formats=('pdf',),
+                      optimize_images=True, incremental=False):
+    """Convert Markdown file to PDF
+    
+    The input is parsed once into pandoc's JSON AST (cached), and every
+    requested format is written from that AST concurrently. Other formats are
+    written next to output_file with their own extension. HTML is always
+    produced as a fallback when the PDF fails. With optimize_images, images
+    wider than the page are downscaled and recompressed (cached) first.
+    With incremental, pandoc writes LaTeX that is compiled in a persistent
+    build directory with a precompiled preamble (see latexbuild).
+    """
+    with profiling.stage('convert', input=input_file):
+        return _convert_md_to_pdf(input_file, output_file, debug, use_cache, formats, optimize_images,
+                                  incremental)
+
+def _convert_md_to_pdf(input_file, output_file, debug, use_cache, formats, optimize_images, incremental):
     logger.info(f"Converting {input_file} to {output_file}...")
     
     # Check input file exists
@@ -101,6 +128,12 @@ def convert_md_to_pdf(input_file, output_file, debug=False):
         logger.error(f"✗ Input file not found: {input_file}")
         return False
     
+    # Paths, versions and supported options of the installed tools (probed once, cached)
+    tools = toolchain.get_toolchain()
+    if not tools.has('pandoc'):
+        logger.error("✗ Pandoc not found. Please install pandoc first.")
+        return False
+    
     # Create output directory if it doesn't exist
     output_dir = os.path.dirname(output_file)
     if output_dir and not os.path.exists(output_dir):
@@ -110,91 +143,261 @@ def convert_md_to_pdf(input_file, output_file, debug=False):
     # Use absolute paths for input and output to avoid issues
     input_abs = os.path.abspath(input_file)
     output_abs = os.path.abspath(output_file)
+    output_stem = os.path.splitext(output_abs)[0]
+    outputs = {fmt: output_abs if fmt == 'pdf' else output_stem + OUTPUT_FORMATS[fmt]
+               for fmt in formats}
+    html_output = output_stem + OUTPUT_FORMATS['html']
+    # Images are resolved relative to the document, not the working directory
+    resource_path = f"--resource-path={os.pathsep.join(['.', os.path.dirname(input_abs)])}"
+    # Preamble for pre-highlighted code blocks (-H header), set once the PDF's AST is rewritten
+    highlight_args = []
     
-    # Basic pandoc command with pdflatex for better reliability
-    basic_cmd = [
-        'pandoc',
-        input_abs,
-        '-o', output_abs,
-        '--pdf-engine=pdflatex',  # Use pdflatex for better reliability
-        '--from=markdown+raw_html+tex_math_dollars',  # Support math and raw html
-        '--syntax-highlighting=default',  # Use default highlighting which requires fewer packages
-        '-V', 'geometry:margin=1in',
-        '-V', 'documentclass=article',
-        '-V', 'fontsize=12pt'
-    ]
+    def parse_command(ast_file):
+        def build(tools):
+            return [tools.path('pandoc'), input_abs, f'--from={INPUT_FORMAT}', '--to=json', '-o', ast_file]
+        return build
     
-    logger.debug(f"Using basic command: {' '.join(basic_cmd)}")
+    def emit_command(ast_file, fmt, path):
+        def build(tools):
+            return [tools.path('pandoc'), ast_file, '--from=json', '-o', path, resource_path] \
+                + format_options(fmt, tools) + (highlight_args if fmt == 'pdf' else [])
+        return build
     
-    # Try PDF conversion first
-    pdf_success = False
-    try:
-        # Execute basic pandoc command
-        result = subprocess.run(
-            basic_cmd,
-            capture_output=True,
-            text=True,
-            check=True,
-            encoding='utf-8'
-        )
+    def latex_command(ast_file, tex_file):
+        def build(tools):
+            return [tools.path('pandoc'), ast_file, '--from=json', '--to=latex', '-s', '-o', tex_file,
+                    resource_path] + format_options('pdf', tools) + highlight_args
+        return build
+    
+    # Reuse the outputs of an identical earlier conversion
+    cache = OutputCache() if use_cache else None
+    if cache is not None:
+        with profiling.stage('cache_lookup'):
+            with open(input_abs, 'rb') as f:
+                source = f.read()
+            # Paths are left out of the key so moved or renamed documents still hit
+            ast_key = make_key('md2pdf-ast', source, INPUT_FORMAT, tool_fingerprint('pandoc'))
+            cache_key = make_key(
+                'md2pdf',
+                ast_key,
+                # Images and included files referenced by the document
+                references_key(input_abs),
+                f'images={optimize_images}',
+                highlight.get_highlighter().fingerprint(),
+                '\0'.join(f"{fmt}:{' '.join(format_options(fmt, tools))}" for fmt in sorted(outputs)),
+                tool_fingerprint(tools.pdf_engine('pdflatex') or 'pdflatex'),
+            )
+            hit = cache.fetch(cache_key, outputs) is not None
+        if hit:
+            logger.info(f"✓ Output unchanged, restored from cache: {output_file}")
+            return True
+    
+    # Never write through a hardlink into the cache
+    for path in set(outputs.values()) | {html_output}:
+        release_output(path)
+    
+    def emit(ast_file, fmt, path):
+        """Write one format from the AST; returns True on success"""
+        try:
+            if fmt == 'pdf' and tools.pdf_engine() is None:
+                raise FileNotFoundError("no LaTeX engine (pdflatex/xelatex) found")
+            
+            if fmt == 'pdf' and incremental:
+                return emit_incremental(ast_file, path)
+            
+            # Re-probes the toolchain and retries if it changed
+            with profiling.stage(f'pandoc_{fmt}'):
+                result = toolchain.run_tool(
+                    emit_command(ast_file, fmt, path),
+                    capture_output=True,
+                    text=True,
+                    encoding='utf-8'
+                )
+            
+            log_output(logger, logging.DEBUG, "Pandoc stdout", result.stdout)
+            log_output(logger, logging.WARNING, "Pandoc stderr", result.stderr)
+            
+            logger.info(f"✓ {fmt.upper()} conversion successful! Output: {path}")
+            return True
+            
+        except JobKilled as e:
+            # Timeout, resource limit or cancellation
+            logger.error(f"✗ {fmt.upper()} conversion stopped: {e.reason}")
+            logger.error(f"Command: {' '.join(e.cmd)}")
+        except subprocess.CalledProcessError as e:
+            logger.error(f"✗ {fmt.upper()} conversion failed with exit code {e.returncode}")
+            logger.error(f"Command: {' '.join(e.cmd)}")
+            log_output(logger, logging.ERROR, "Stdout", e.stdout)
+            log_output(logger, logging.ERROR, "Stderr", e.stderr)
+        except Exception as e:
+            logger.error(f"✗ Unexpected error during {fmt.upper()} conversion: {str(e)}")
+        return False
+    
+    def emit_incremental(ast_file, path):
+        """pandoc writes LaTeX, which is compiled in the document's build directory"""
+        builder = latexbuild.get_builder()
+        engine = tools.pdf_engine('pdflatex')
+        build_dir = builder.build_dir(input_abs, path, engine)
+        tex_file = os.path.join(build_dir, 'pandoc.tex')
+        # Concurrent conversions of the same document take turns in its build directory
+        with builder.lock(build_dir):
+            with profiling.stage('pandoc_latex'):
+                result = toolchain.run_tool(
+                    latex_command(ast_file, tex_file),
+                    capture_output=True,
+                    text=True,
+                    encoding='utf-8'
+                )
+            log_output(logger, logging.WARNING, "Pandoc stderr", result.stderr)
+            with open(tex_file, 'r', encoding='utf-8') as f:
+                tex_source = f.read()
+            with profiling.stage('latex', engine=engine):
+                builder.compile(tex_source, path, engine, build_dir, os.path.dirname(input_abs))
+        logger.info(f"✓ PDF conversion successful! Output: {path}")
+        return True
+    
+    with tempfile.TemporaryDirectory(prefix='md2pdf-ast-') as tmp:
+        ast_file = os.path.join(tmp, 'document.json')
         
-        if result.stdout:
-            logger.debug(f"Pandoc stdout: {result.stdout}")
-        if result.stderr:
-            logger.warning(f"Pandoc stderr: {result.stderr}")
+        # Parse the Markdown once (or reuse the cached AST of identical input)
+        if cache is None or cache.fetch(ast_key, {'ast': ast_file}) is None:
+            try:
+                with profiling.stage('pandoc_parse'):
+                    toolchain.run_tool(
+                        parse_command(ast_file),
+                        capture_output=True,
+                        text=True,
+                        encoding='utf-8'
+                    )
+            except JobKilled as e:
+                logger.error(f"✗ Parsing {input_file} stopped: {e.reason}")
+                return False
+            except subprocess.CalledProcessError as e:
+                logger.error(f"✗ Parsing {input_file} failed with exit code {e.returncode}")
+                log_output(logger, logging.ERROR, "Stderr", e.stderr)
+                return False
+            except Exception as e:
+                logger.error(f"✗ Unexpected error while parsing {input_file}: {str(e)}")
+                return False
+            if cache is not None:
+                cache.store(ast_key, {'ast': ast_file})
         
-        logger.info(f"✓ PDF conversion successful! Output: {output_file}")
-        pdf_success = True
+        # The PDF's images point at downscaled, recompressed copies; HTML, EPUB, DOCX and
+        # the HTML fallback keep the original images (the cached AST stays untouched)
+        pdf_ast = ast_file
+        if 'pdf' in outputs and optimize_images:
+            optimized_ast = os.path.join(tmp, 'document-images.json')
+            try:
+                if images.get_optimizer().rewrite_ast(ast_file, optimized_ast, os.path.dirname(input_abs)):
+                    pdf_ast = optimized_ast
+            except Exception as e:
+                logger.warning(f"⚠ Image optimization skipped: {str(e)}")
         
-    except subprocess.CalledProcessError as e:
-        logger.error(f"✗ PDF conversion failed with exit code {e.returncode}")
-        logger.error(f"Command: {' '.join(basic_cmd)}")
-        if e.stdout:
-            logger.error(f"Stdout: {e.stdout}")
-        if e.stderr:
-            logger.error(f"Stderr: {e.stderr}")
-    except Exception as e:
-        logger.error(f"✗ Unexpected error during PDF conversion: {str(e)}")
+        # Code blocks of the PDF become pre-rendered LaTeX (tokenized once, cached per block),
+        # so LaTeX only needs fancyvrb and the colour macros; other formats keep pandoc's highlighting
+        if 'pdf' in outputs:
+            highlighted_ast = os.path.join(tmp, 'document-highlight.json')
+            highlight_file = os.path.join(tmp, 'highlight.tex')
+            try:
+                highlighter = highlight.get_highlighter()
+                with profiling.stage('highlight'):
+                    if highlighter.rewrite_ast(pdf_ast, highlighted_ast):
+                        with open(highlight_file, 'w', encoding='utf-8') as f:
+                            f.write(highlighter.latex_preamble())
+                        pdf_ast = highlighted_ast
+                        highlight_args = ['-H', highlight_file]
+            except Exception as e:
+                logger.warning(f"⚠ Code highlighting left to pandoc: {str(e)}")
+        
+        # Emit all requested formats concurrently (in the caller's context, which holds the log job id)
+        with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+            futures = {fmt: executor.submit(contextvars.copy_context().run, emit,
+                                            pdf_ast if fmt == 'pdf' else ast_file, fmt, path)
+                       for fmt, path in outputs.items()}
+            results = {fmt: future.result() for fmt, future in futures.items()}
+        
+        # HTML fallback, only when the PDF failed and HTML was not requested anyway
+        fallback_ok = results.get('html', False)
+        if results.get('pdf') is False and 'html' not in results:
+            logger.info("Generating HTML fallback...")
+            fallback_ok = emit(ast_file, 'html', html_output)
     
-    # Always convert to HTML as fallback
-    logger.info("Generating HTML fallback...")
+    if results.get('pdf') is False:
+        if not fallback_ok:
+            logger.error("✗ HTML conversion also failed")
+            return False
+        logger.warning("✗ PDF conversion failed. Please use the generated HTML file.")
     
-    # Convert to HTML first
-    html_output = output_abs.replace('.pdf', '.html')
-    html_cmd = [
-        'pandoc',
-        input_abs,
-        '-o', html_output,
-        '--mathjax',
-        '-s',  # Standalone HTML with header and footer
-        '--syntax-highlighting=default'
-    ]
+    if not all(ok for fmt, ok in results.items() if fmt != 'pdf'):
+        return False
+    
+    # Only complete, successful conversions are cached
+    if cache is not None and all(results.values()):
+        with profiling.stage('cache_store'):
+            cache.store(cache_key, outputs)
+    
+    return True
+
+def convert_via_server(input_file, output_file, server):
+    """Convert Markdown file to PDF through a running `md2pdf serve` daemon"""
+    from server import convert_remote
     
+    # No output cache and no HTML fallback here: the daemon keeps its session warm instead
+    logger.info(f"Converting {input_file} to {output_file} via {server}...")
     try:
-        # Convert to HTML
-        subprocess.run(
-            html_cmd,
-            capture_output=True,
-            text=True,
-            check=True,
-            encoding='utf-8'
-        )
-        logger.info(f"✓ HTML conversion successful: {html_output}")
-        
-        if not pdf_success:
-            logger.warning("✗ PDF conversion failed. Please use the generated HTML file.")
-        
-        return True
-        
-    except subprocess.CalledProcessError as e2:
-        logger.error(f"✗ HTML conversion also failed: {e2.returncode}")
+        with open(input_file, 'r', encoding='utf-8') as f:
+            md_text = f.read()
+        base_url = Path(os.path.abspath(input_file)).parent.as_uri() + '/'
+        pdf_bytes = convert_remote(md_text, server, base_url=base_url)
+    except Exception as e:
+        logger.error(f"✗ Daemon conversion failed: {str(e)}")
         return False
+    
+    output_dir = os.path.dirname(output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    release_output(output_file)
+    with open(output_file, 'wb') as f:
+        f.write(pdf_bytes)
+    logger.info(f"✓ PDF conversion successful! Output: {output_file}")
+    return True
+
+def convert_via_queue(input_file, output_file, server, priority, engine, options):
+    """Convert Markdown file through the job queue of a running `md2pdf serve` daemon"""
+    from server import submit_job, wait_for_job
+    
+    logger.info(f"Queueing {input_file} on {server} ({priority})...")
+    try:
+        job_id = submit_job(server, input_file, output_file, priority, engine, options)
+        job = wait_for_job(server, job_id)
     except Exception as e:
-        logger.error(f"✗ Unexpected error during HTML conversion: {str(e)}")
+        logger.error(f"✗ Queued conversion failed: {str(e)}")
+        return False
+    
+    if job['state'] != 'done':
+        logger.error(f"✗ Job {job_id} failed: {job.get('error') or 'unknown error'}")
         return False
+    logger.info(f"✓ PDF conversion successful! Output: {output_file} "
+                f"(waited {job['started'] - job['submitted']:.1f}s, total {job['finished'] - job['submitted']:.1f}s)")
+    return True
+
+def write_profile(tracer, path, fmt):
+    """Stop tracing and write the collected stage records"""
+    profiling.stop_tracing()
+    try:
+        tracer.write(path, fmt)
+        logger.info(f"Profile written to {path}")
+    except OSError as e:
+        logger.error(f"✗ Cannot write profile {path}: {str(e)}")
 
 def main():
     """Main function"""
+    # `md2pdf serve ...` runs the resident conversion daemon
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from server import main as serve_main
+        serve_main(sys.argv[2:])
+        return
+    
     parser = argparse.ArgumentParser(
         description='Markdown to PDF Converter with LaTeX Math Support',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -202,22 +405,52 @@ def main():
 Examples:
   %(prog)s input.md -o output.pdf
   %(prog)s input.md  # Output will be input.pdf
+  %(prog)s a.md b.md c.md -j 4  # Convert several files with 4 workers
+  %(prog)s a.md b.md -o out_dir  # Write a.pdf and b.pdf into out_dir
   %(prog)s input.md --debug  # Enable debug logging
+  %(prog)s input.md --formats pdf,html,docx  # Parse once, write several formats
+  %(prog)s input.md --engine auto  # Pick the faster engine that can handle the document
+  %(prog)s --watch docs/ --incremental  # Fast rebuilds: keep LaTeX aux files and preamble
+  %(prog)s a.md b.md --profile trace.json --profile-format chrome  # Per-stage timings
   %(prog)s --check-deps  # Only check dependencies
+  %(prog)s --watch docs/  # Rebuild documents in docs/ whenever they change
+  %(prog)s --build docs/ -o out/  # Rebuild only what changed since the last build
+  %(prog)s manual.md --split pages:500  # manual-vol01.pdf, manual-vol02.pdf, ... (WeasyPrint)
+  %(prog)s manual.md --pages 120-130 -o preview.pdf  # Lay out only what is needed for these pages
+  %(prog)s serve --port 8765  # Run the resident conversion daemon
+  %(prog)s input.md --server http://127.0.0.1:8765  # Convert through the daemon
+  %(prog)s a.md b.md --queue http://127.0.0.1:8765 --priority interactive  # Use the daemon's job queue
         """
     )
     
     parser.add_argument(
-        'input_file',
+        'input_files',
         type=str,
-        nargs='?',
-        help='Input Markdown file path'
+        nargs='*',
+        metavar='input_file',
+        help='Input Markdown file path(s)'
     )
     
     parser.add_argument(
         '-o', '--output',
         type=str,
-        help='Output PDF file path (default: input filename with .pdf extension)'
+        help='Output PDF file path (default: input filename with .pdf extension); '
+             'an output directory when several input files are given'
+    )
+    
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=default_workers(),
+        help='Number of parallel conversions for multiple input files (default: number of CPU cores)'
+    )
+    
+    parser.add_argument(
+        '--formats',
+        type=str,
+        default='pdf',
+        help=f"Comma-separated output formats from: {', '.join(OUTPUT_FORMATS)} (default: pdf); "
+             'HTML is also written when the PDF fails'
     )
     
     parser.add_argument(
@@ -226,6 +459,130 @@ Examples:
         help='Enable debug logging'
     )
     
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Always run a full conversion, bypassing the output cache'
+    )
+    
+    parser.add_argument(
+        '--no-optimize-images',
+        action='store_true',
+        help='Embed images as they are instead of downscaled, recompressed copies'
+    )
+    
+    parser.add_argument(
+        '--engine',
+        choices=sorted(engines.ENGINES) + [engines.AUTO, engines.RACE],
+        default='pandoc',
+        help='Conversion engine: pandoc+LaTeX (default), weasyprint, auto (fastest engine that can '
+             'handle the document, learned from earlier timings) or race (run all, keep the first result)'
+    )
+    
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Compile the LaTeX in a persistent build directory with a precompiled preamble '
+             '(much faster repeat builds of edited documents)'
+    )
+    
+    parser.add_argument(
+        '--split',
+        type=str,
+        metavar='SPEC',
+        help='Write volumes instead of one PDF: pages:N (at most N pages each), size:N[KB|MB|GB] '
+             'or headings (one per top-level heading); links between volumes keep working. '
+             'Uses the WeasyPrint engine'
+    )
+    
+    parser.add_argument(
+        '--pages',
+        type=str,
+        metavar='RANGE',
+        help='Preview: only lay out and write pages N, N-M or N- of the document. Uses the WeasyPrint engine'
+    )
+    
+    parser.add_argument(
+        '--section',
+        type=str,
+        metavar='TITLE',
+        help='Preview: only lay out and write the top-level section whose heading contains TITLE. '
+             'Uses the WeasyPrint engine'
+    )
+    
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        metavar='SECONDS',
+        help='Stop a pandoc/LaTeX run after this many seconds (default: 300; 0 = no limit)'
+    )
+    
+    parser.add_argument(
+        '--cpu-timeout',
+        type=float,
+        metavar='SECONDS',
+        help='CPU time limit per pandoc/LaTeX process (default: 240; 0 = no limit; not on Windows)'
+    )
+    
+    parser.add_argument(
+        '--memory-limit',
+        type=float,
+        metavar='MB',
+        help='Memory limit per pandoc/LaTeX process (default: 4096; 0 = no limit; not on Windows)'
+    )
+    
+    parser.add_argument(
+        '--server',
+        type=str,
+        help='Convert through a running daemon (http://host:port or unix:/path) started with "serve"; '
+             'the daemon writes the PDF with WeasyPrint, without the output cache and the HTML fallback'
+    )
+    
+    parser.add_argument(
+        '--queue',
+        type=str,
+        metavar='SERVER',
+        help='Run the conversion in the job queue of a daemon (http://host:port or unix:/path) '
+             'started with "serve"; pandoc and LaTeX run on the daemon side'
+    )
+    
+    parser.add_argument(
+        '--priority',
+        choices=['interactive', 'batch'],
+        default='batch',
+        help='Priority class of --queue jobs (default: batch); interactive jobs run first'
+    )
+    
+    parser.add_argument(
+        '--watch',
+        type=str,
+        metavar='PATH',
+        help='Watch a Markdown file or directory and rebuild changed documents'
+    )
+    
+    parser.add_argument(
+        '--build',
+        type=str,
+        metavar='DIR',
+        help='Convert every Markdown file under DIR into the -o directory (default: DIR), '
+             'rebuilding only documents whose sources, images, stylesheets or options changed '
+             'and deleting outputs of removed documents'
+    )
+    
+    parser.add_argument(
+        '--profile',
+        type=str,
+        metavar='FILE',
+        help='Record wall time, CPU time and peak memory of every conversion stage to FILE'
+    )
+    
+    parser.add_argument(
+        '--profile-format',
+        choices=['json', 'chrome'],
+        default='json',
+        help='Format of the --profile file: plain JSON or Chrome trace events (default: json)'
+    )
+    
     parser.add_argument(
         '--check-deps',
         action='store_true',
@@ -234,38 +591,148 @@ Examples:
     
     args = parser.parse_args()
     
-    # Set debug logging if requested
-    if args.debug:
-        logger.setLevel(logging.DEBUG)
+    # Console plus rotating JSON log file, written by a background thread;
+    # --debug applies to every module, not only this one
+    setup_logging(logging.DEBUG if args.debug else logging.INFO)
     
-    # Check dependencies
-    if not check_dependencies():
-        sys.exit(1)
+    # Per-stage tracing; the profile is written on every exit path
+    if args.profile:
+        tracer = profiling.start_tracing()
+        atexit.register(write_profile, tracer, args.profile, args.profile_format)
+    
+    # Limits are passed through the environment so batch workers inherit them
+    for name, value in (('MD2PDF_TIMEOUT', args.timeout), ('MD2PDF_CPU_TIMEOUT', args.cpu_timeout),
+                        ('MD2PDF_MEMORY_MB', args.memory_limit)):
+        if value is not None:
+            os.environ[name] = str(value)
     
-    # If only checking dependencies, exit
+    formats = [fmt.strip().lower() for fmt in args.formats.split(',') if fmt.strip()]
+    unknown = [fmt for fmt in formats if fmt not in OUTPUT_FORMATS]
+    if unknown or not formats:
+        parser.error(f"--formats must be a comma-separated subset of: {', '.join(OUTPUT_FORMATS)}")
+    
+    # Volumes and previews are laid out page by page, which only WeasyPrint can do
+    if args.split or args.pages:
+        from volumes import parse_split, parse_pages
+        try:
+            if args.split:
+                parse_split(args.split)
+            if args.pages:
+                parse_pages(args.pages)
+        except ValueError as e:
+            parser.error(str(e))
+    if sum(1 for value in (args.split, args.pages, args.section) if value) > 1:
+        parser.error('--split, --pages and --section cannot be combined')
+    if args.split or args.pages or args.section:
+        if formats != ['pdf']:
+            parser.error('--split, --pages and --section only write PDF')
+        if args.incremental:
+            parser.error('--incremental builds with LaTeX and cannot be combined with --split, --pages or --section')
+        if args.engine == 'pandoc':
+            args.engine = 'weasyprint'
+    
+    # --server only returns a PDF rendered by the daemon's WeasyPrint session
+    if args.server and formats != ['pdf']:
+        parser.error('--server only writes PDF; use --queue for other formats')
+    if args.server and (args.split or args.pages or args.section):
+        parser.error('--server converts whole documents; use --queue with --split, --pages or --section')
+    
+    # The daemon does the conversion; pandoc and LaTeX are not needed locally
+    options = {'debug': args.debug, 'use_cache': not args.no_cache, 'formats': formats,
+               'optimize_images': not args.no_optimize_images, 'incremental': args.incremental,
+               'split': args.split, 'pages': args.pages, 'section': args.section}
+    if args.server:
+        convert, convert_args = convert_via_server, (args.server,)
+    elif args.queue:
+        convert, convert_args = convert_via_queue, (args.queue, args.priority, args.engine, options)
+    elif args.engine != 'pandoc':
+        convert, convert_args = engines.convert_document, (args.engine, options)
+    else:
+        convert, convert_args = convert_md_to_pdf, (args.debug, not args.no_cache, formats,
+                                                    not args.no_optimize_images, args.incremental)
+    
+    # Check dependencies (always probes the tools again); conversions use the
+    # cached toolchain probe instead of spawning pandoc/LaTeX on every start
     if args.check_deps:
+        if not check_dependencies(refresh=True):
+            sys.exit(1)
         logger.info("All dependencies are installed correctly.")
         sys.exit(0)
     
+    # Watch mode: rebuild on every change until interrupted
+    if args.watch:
+        from watch import watch
+        watch(args.watch, convert, convert_args, output_dir=args.output)
+        sys.exit(0)
+    
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    
+    # Directory build: only stale documents are converted
+    if args.build:
+        if not os.path.isdir(args.build):
+            parser.error(f'--build needs a directory: {args.build}')
+        from treebuild import build_tree
+        # styles.css is only used by the WeasyPrint engine
+        stylesheet = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'styles.css')
+        shared_deps = [stylesheet] if args.engine != 'pandoc' and os.path.exists(stylesheet) else []
+        # HTML is also written when the PDF fails, and must be cleaned up with the others
+        extensions = [OUTPUT_FORMATS[fmt] for fmt in formats]
+        if OUTPUT_FORMATS['html'] not in extensions:
+            extensions.append(OUTPUT_FORMATS['html'])
+        built, failed, removed, up_to_date = build_tree(
+            args.build, args.output or args.build, convert, convert_args,
+            extensions=extensions, shared_deps=shared_deps, workers=args.jobs
+        )
+        sys.exit(1 if failed else 0)
+    
     # If no input file provided and not checking dependencies, show help
-    if args.input_file is None:
+    if not args.input_files:
         parser.print_help()
         sys.exit(1)
     
-    # Determine output file path
-    input_path = Path(args.input_file)
-    if args.output:
-        output_file = args.output
-    else:
-        output_file = str(input_path.with_suffix('.pdf'))
+    # Single file: convert in this process
+    if len(args.input_files) == 1:
+        input_path = Path(args.input_files[0])
+        if args.output:
+            output_file = args.output
+        else:
+            output_file = str(input_path.with_suffix('.pdf'))
+        
+        success = convert(args.input_files[0], output_file, *convert_args)
+        sys.exit(0 if success else 1)
     
-    # Convert the file
-    success = convert_md_to_pdf(args.input_file, output_file, args.debug)
+    # Multiple files: -o names the output directory
+    jobs = []
+    seen = set()
+    for input_file in args.input_files:
+        if os.path.abspath(input_file) in seen:
+            continue
+        seen.add(os.path.abspath(input_file))
+        input_path = Path(input_file)
+        if args.output:
+            output_file = os.path.join(args.output, input_path.stem + '.pdf')
+        else:
+            output_file = str(input_path.with_suffix('.pdf'))
+        jobs.append((input_file, output_file))
     
-    if success:
-        sys.exit(0)
-    else:
-        sys.exit(1)
+    # Jobs run concurrently, so two inputs must never share an output file
+    collisions = output_collisions(jobs)
+    if collisions:
+        parser.error('several inputs would write the same output:\n' + '\n'.join(
+            f"  {output_file}: {', '.join(inputs)}" for output_file, inputs in collisions.items()))
+    
+    def report(result, done, total):
+        status = '✓' if result.success else '✗'
+        logger.info(f"[{done}/{total}] {status} {result.input_file}")
+    
+    results = run_batch(jobs, convert, args=convert_args,
+                        workers=args.jobs, on_result=report)
+    success_count = sum(1 for r in results if r.success)
+    logger.info(f"Batch finished: {success_count}/{len(results)} succeeded")
+    
+    sys.exit(0 if success_count == len(results) else 1)
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main()
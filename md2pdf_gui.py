@@ -16,16 +16,16 @@ from pathlib import Path
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from threading import Thread
+import multiprocessing
+
+from batch import run_batch, default_workers, output_collisions
+from treebuild import build_tree
+from logsetup import setup_logging, log_output
+from uievents import UiQueue
+import toolchain
+import engines
+from supervisor import JobKilled
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('md2pdf.log', encoding='utf-8')
-    ]
-)
 logger = logging.getLogger(__name__)
 
 class MD2PDFConverter:
@@ -37,11 +37,23 @@ class MD2PDFConverter:
         
         # Initialize variables
         self.input_files = []
+        # A document folder replaces the file list: only changed documents are rebuilt
+        self.source_folder = None
         self.output_folder = ""
         self.debug = False
+        self.workers = default_workers()
+        self.engine = 'pandoc'
+        # Set by the stop button; shared with the batch worker processes
+        self.cancel_event = multiprocessing.Event()
         
         # Create UI components
         self.create_widgets()
+        
+        # Worker threads post updates; the Tk loop applies them once per frame
+        self.events = UiQueue(self.root)
+        self.events.on('status', self.status_var.set, coalesce=True)
+        self.events.on('progress', self.progress_var.set, coalesce=True)
+        self.events.start()
     
     def create_widgets(self):
         # Create main frame
@@ -55,6 +67,9 @@ class MD2PDFConverter:
         # Select files button
         ttk.Button(input_frame, text="选择MD文件", command=self.select_files).pack(side=tk.LEFT, padx=5)
         
+        # Select folder button
+        ttk.Button(input_frame, text="选择文件夹", command=self.select_folder).pack(side=tk.LEFT, padx=5)
+        
         # Clear files button
         ttk.Button(input_frame, text="清空列表", command=self.clear_files).pack(side=tk.LEFT, padx=5)
         
@@ -84,10 +99,26 @@ class MD2PDFConverter:
         
         ttk.Button(output_frame, text="浏览", command=self.select_output_folder).grid(row=0, column=2, padx=5, pady=5)
         
+        # Number of parallel conversions
+        ttk.Label(output_frame, text="并行数:").grid(row=1, column=0, sticky=tk.W, pady=5)
+        
+        self.workers_var = tk.IntVar(value=default_workers())
+        ttk.Spinbox(output_frame, from_=1, to=max(64, default_workers()), textvariable=self.workers_var, width=5).grid(row=1, column=1, sticky=tk.W, padx=5, pady=5)
+        
+        # Conversion engine: auto picks the faster capable engine, race runs all of them
+        ttk.Label(output_frame, text="转换引擎:").grid(row=2, column=0, sticky=tk.W, pady=5)
+        
+        self.engine_var = tk.StringVar(value='pandoc')
+        ttk.Combobox(output_frame, textvariable=self.engine_var, state='readonly', width=12,
+                     values=sorted(engines.ENGINES) + [engines.AUTO, engines.RACE]).grid(row=2, column=1, sticky=tk.W, padx=5, pady=5)
+        
         # Convert button
         convert_frame = ttk.Frame(main_frame, padding="10")
         convert_frame.pack(fill=tk.X, pady=5)
         
+        self.stop_button = ttk.Button(convert_frame, text="停止", command=self.stop_conversion, state=tk.DISABLED)
+        self.stop_button.pack(side=tk.RIGHT, padx=(5, 0))
+        
         self.convert_button = ttk.Button(convert_frame, text="开始转换", command=self.start_conversion, style="Accent.TButton")
         self.convert_button.pack(fill=tk.X)
         
@@ -111,6 +142,10 @@ class MD2PDFConverter:
             filetypes=[("Markdown文件", "*.md"), ("所有文件", "*.*")]
         )
         
+        if files and self.source_folder:
+            self.source_folder = None
+            self.files_listbox.delete(0, tk.END)
+        
         for file in files:
             if file not in self.input_files:
                 self.input_files.append(file)
@@ -118,7 +153,17 @@ class MD2PDFConverter:
         
         self.update_status(f"已选择 {len(self.input_files)} 个文件")
     
+    def select_folder(self):
+        folder = filedialog.askdirectory(title="选择文档文件夹")
+        if folder:
+            self.source_folder = folder
+            self.input_files.clear()
+            self.files_listbox.delete(0, tk.END)
+            self.files_listbox.insert(tk.END, f"{folder}（增量构建，仅转换有改动的文档）")
+            self.update_status(f"文档文件夹：{folder}")
+    
     def clear_files(self):
+        self.source_folder = None
         self.input_files.clear()
         self.files_listbox.delete(0, tk.END)
         self.update_status("就绪")
@@ -131,15 +176,15 @@ class MD2PDFConverter:
             self.update_status(f"输出文件夹：{folder}")
     
     def update_status(self, message):
-        self.status_var.set(message)
-        self.root.update_idletasks()
+        """Safe from any thread"""
+        self.events.post('status', message)
     
     def update_progress(self, value):
-        self.progress_var.set(value)
-        self.root.update_idletasks()
+        """Safe from any thread"""
+        self.events.post('progress', value)
     
     def start_conversion(self):
-        if not self.input_files:
+        if not self.input_files and not self.source_folder:
             messagebox.showwarning("警告", "请先选择要转换的MD文件")
             return
         
@@ -148,9 +193,17 @@ class MD2PDFConverter:
             self.output_folder_var.set(self.output_folder)
         
         self.debug = self.debug_var.get()
+        self.engine = self.engine_var.get()
+        try:
+            self.workers = max(1, self.workers_var.get())
+        except tk.TclError:
+            self.workers = default_workers()
+            self.workers_var.set(self.workers)
         
         # Disable convert button during conversion
         self.convert_button.config(state=tk.DISABLED)
+        self.stop_button.config(state=tk.NORMAL)
+        self.cancel_event.clear()
         
         # Create a thread for conversion to avoid freezing the UI
         conversion_thread = Thread(target=self.convert_files)
@@ -158,180 +211,223 @@ class MD2PDFConverter:
         conversion_thread.start()
     
     def convert_files(self):
-        total_files = len(self.input_files)
-        success_count = 0
-        
+        # finish_conversion re-enables the buttons, so it is posted even when the batch fails
+        title, message = "转换出错", "转换意外中止，详见日志"
+        try:
+            title, message = self._convert_files()
+        except Exception as e:
+            logger.error(f"转换意外中止：{e}")
+            message = f"转换出错：{e}"
+        finally:
+            self.events.call(self.finish_conversion, title, message)
+    
+    def _convert_files(self):
+        """Runs the conversion; returns the (title, message) shown when it is done"""
         self.update_status("开始转换...")
         self.update_progress(0)
         
-        for i, input_file in enumerate(self.input_files):
-            try:
-                self.update_status(f"转换中：{os.path.basename(input_file)} ({i+1}/{total_files})")
-                
-                # Determine output file paths
-                input_path = Path(input_file)
-                output_file = os.path.join(self.output_folder, input_path.stem + ".pdf")
-                html_output = os.path.join(self.output_folder, input_path.stem + ".html")
-                
-                # Convert to PDF
-                success = self.convert_md_to_pdf(input_file, output_file, self.debug)
-                
-                if success:
-                    success_count += 1
-                else:
-                    self.update_status(f"PDF转换失败，生成HTML：{os.path.basename(input_file)}")
-                
-                # Update progress
-                progress = (i + 1) / total_files * 100
-                self.update_progress(progress)
-                
-            except Exception as e:
-                logger.error(f"转换文件 {input_file} 时出错：{str(e)}")
-                self.update_status(f"转换 {os.path.basename(input_file)} 时出错：{str(e)}")
-        
-        self.update_progress(100)
-        self.update_status(f"转换完成！成功：{success_count}/{total_files}")
-        self.convert_button.config(state=tk.NORMAL)
-        
-        messagebox.showinfo("转换完成", f"转换完成！成功：{success_count}/{total_files}")
+        # Determine output file paths
+        jobs = []
+        for input_file in dict.fromkeys(os.path.abspath(path) for path in self.input_files):
+            input_path = Path(input_file)
+            output_file = os.path.join(self.output_folder, input_path.stem + ".pdf")
+            jobs.append((input_file, output_file))
+        
+        # 同名文件会并发写入同一个输出文件
+        collisions = output_collisions(jobs) if not self.source_folder else {}
+        if collisions:
+            names = "\n".join(f"{os.path.basename(output_file)}: {', '.join(inputs)}"
+                              for output_file, inputs in collisions.items())
+            return "转换出错", f"以下文件的输出文件名相同，请分开转换：\n{names}"
+        
+        def on_result(result, done, total):
+            name = os.path.basename(result.input_file)
+            if result.error:
+                logger.error(f"转换文件 {result.input_file} 时出错：{result.error}")
+                self.update_status(f"转换 {name} 时出错：{result.error}")
+            elif not result.success:
+                self.update_status(f"PDF转换失败，生成HTML：{name}")
+            else:
+                self.update_status(f"已完成：{name} ({done}/{total})")
+            
+            # Update progress
+            self.update_progress(done / total * 100)
+        
+        # Convert files concurrently on a process pool
+        if self.engine == 'pandoc':
+            convert, args = convert_md_to_pdf, (self.debug,)
+        else:
+            convert, args = engines.convert_document, (self.engine, {'debug': self.debug})
+        if self.source_folder:
+            return self.build_folder(convert, args, on_result)
+        results = run_batch(jobs, convert, args=args,
+                            workers=self.workers, on_result=on_result, cancel=self.cancel_event)
+        success_count = sum(1 for r in results if r.success)
+        total_files = len(results)
+        
+        if self.cancel_event.is_set():
+            return "转换已停止", f"转换已停止。成功：{success_count}/{total_files}"
+        return "转换完成", f"转换完成！成功：{success_count}/{total_files}"
     
-    def check_dependencies(self):
-        """Check if required dependencies are installed"""
-        # Check pandoc
+    def build_folder(self, convert, args, on_result):
+        """Incremental build of the selected folder into the output folder; returns (title, message)"""
         try:
-            result = subprocess.run(
-                ['pandoc', '--version'],
-                capture_output=True,
-                text=True,
-                check=True,
-                encoding='utf-8'
+            built, failed, removed, up_to_date = build_tree(
+                self.source_folder, self.output_folder, convert, args,
+                # The PDF, or the HTML written when it fails
+                extensions=('.pdf', '.html'), workers=self.workers, on_result=on_result, cancel=self.cancel_event
             )
-            logger.info(f"✓ Pandoc found: {result.stdout.splitlines()[0]}")
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            logger.error("✗ Pandoc not found. Please install pandoc first.")
-            messagebox.showerror("错误", "未找到Pandoc。请先安装Pandoc。")
-            return False
-        except UnicodeDecodeError:
-            logger.warning("⚠ Pandoc version check: Unicode decode error, but pandoc is available")
-        
-        # Check xelatex (miktex)
-        try:
-            result = subprocess.run(
-                ['xelatex', '--version'],
-                capture_output=True,
-                text=True,
-                check=True,
-                encoding='utf-8'
-            )
-            try:
-                version_line = result.stdout.splitlines()[0].strip()
-                logger.info(f"✓ XeLaTeX found: {version_line}")
-            except (IndexError, AttributeError):
-                logger.info("✓ XeLaTeX found: Version information not available")
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            logger.error("✗ XeLaTeX not found. Please install MikTeX first.")
-            messagebox.showerror("错误", "未找到XeLaTeX。请先安装MiKTeX。")
-            return False
-        except UnicodeDecodeError:
-            logger.warning("⚠ XeLaTeX version check: Unicode decode error, but xelatex is available")
-        
-        return True
+            message = f"重新生成：{built}，失败：{failed}，删除：{removed}，未变化：{up_to_date}"
+        except OSError as e:
+            logger.error(f"构建文件夹 {self.source_folder} 时出错：{e}")
+            message = f"构建出错：{e}"
+        
+        return "构建完成", message
+    
+    def finish_conversion(self, title, message):
+        """Runs on the Tk thread once the worker thread is done"""
+        self.progress_var.set(100)
+        self.stop_button.config(state=tk.DISABLED)
+        self.convert_button.config(state=tk.NORMAL)
+        self.status_var.set(message)
+        messagebox.showinfo(title, message)
+    
+    def stop_conversion(self):
+        """Kill the running pandoc/LaTeX processes and skip the remaining files"""
+        self.cancel_event.set()
+        self.stop_button.config(state=tk.DISABLED)
+        self.update_status("正在停止...")
+    
+    def check_dependencies(self):
+        """Check dependencies in the background so the window opens immediately
+        
+        Uses the cached toolchain probe; tools are only spawned when it is stale.
+        """
+        def check():
+            tools = toolchain.get_toolchain()
+            if not tools.has('pandoc'):
+                logger.error("✗ Pandoc not found. Please install pandoc first.")
+                self.events.call(self.dependency_error, "未找到Pandoc。请先安装Pandoc。")
+            elif not tools.pdf_engines:
+                logger.error("✗ No LaTeX engine (pdflatex/xelatex) found. Please install MikTeX first.")
+                self.events.call(self.dependency_error, "未找到LaTeX（pdflatex/xelatex）。请先安装MiKTeX。")
+            else:
+                logger.info(f"✓ Pandoc found: {tools.version('pandoc')}")
+                for engine in tools.pdf_engines:
+                    logger.info(f"✓ {engine} found: {tools.version(engine)}")
+        
+        Thread(target=check, daemon=True).start()
+    
+    def dependency_error(self, message):
+        self.convert_button.config(state=tk.DISABLED)
+        self.status_var.set(message)
+        messagebox.showerror("错误", message)
     
     def convert_md_to_pdf(self, input_file, output_file, debug=False):
         """Convert Markdown file to PDF with reliable fallback"""
-        logger.info(f"Converting {input_file} to {output_file}...")
-        
-        # Use absolute paths for input and output to avoid issues
-        input_abs = os.path.abspath(input_file)
-        output_abs = os.path.abspath(output_file)
-        
-        # Basic pandoc command with math and HTML support
-        basic_cmd = [
-            'pandoc',
+        return convert_md_to_pdf(input_file, output_file, debug)
+
+def convert_md_to_pdf(input_file, output_file, debug=False):
+    """Convert Markdown file to PDF with reliable fallback
+    
+    Module-level so that batch worker processes can run it.
+    """
+    logger.info(f"Converting {input_file} to {output_file}...")
+    
+    # Use absolute paths for input and output to avoid issues
+    input_abs = os.path.abspath(input_file)
+    output_abs = os.path.abspath(output_file)
+    
+    # Basic pandoc command with math and HTML support
+    def pdf_command(tools):
+        return [
+            tools.path('pandoc'),
             input_abs,
             '-o', output_abs,
             '--from=markdown+raw_html+tex_math_dollars',  # Support math and raw html
-            '--syntax-highlighting=default',  # Use default highlighting which requires fewer packages
+            tools.highlight_option('default'),  # Use default highlighting which requires fewer packages
             '-V', 'geometry:margin=1in',
             '-V', 'documentclass=article',
             '-V', 'fontsize=12pt'
         ]
-        
-        logger.debug(f"Using basic command: {' '.join(basic_cmd)}")
-        
-        # Try PDF conversion first
-        pdf_success = False
-        try:
-            # Execute basic pandoc command
-            result = subprocess.run(
-                basic_cmd,
-                capture_output=True,
-                text=True,
-                check=True,
-                encoding='utf-8'
-            )
-            
-            if result.stdout:
-                logger.debug(f"Pandoc stdout: {result.stdout}")
-            if result.stderr:
-                logger.warning(f"Pandoc stderr: {result.stderr}")
-            
-            logger.info(f"✓ PDF conversion successful! Output: {output_file}")
-            pdf_success = True
-            
-        except subprocess.CalledProcessError as e:
-            logger.error(f"✗ PDF conversion failed with exit code {e.returncode}")
-            logger.error(f"Command: {' '.join(basic_cmd)}")
-            if e.stdout:
-                logger.error(f"Stdout: {e.stdout}")
-            if e.stderr:
-                logger.error(f"Stderr: {e.stderr}")
-        except Exception as e:
-            logger.error(f"✗ Unexpected error during PDF conversion: {str(e)}")
-        
-        # Always convert to HTML as reliable fallback
-        logger.info("Generating HTML fallback...")
-        
-        # Convert to HTML first
-        html_output = output_abs.replace('.pdf', '.html')
-        html_cmd = [
-            'pandoc',
+    
+    # Try PDF conversion first
+    pdf_success = False
+    try:
+        # Execute basic pandoc command; re-probes the toolchain and retries if it changed
+        result = toolchain.run_tool(
+            pdf_command,
+            capture_output=True,
+            text=True,
+            encoding='utf-8'
+        )
+    
+        log_output(logger, logging.DEBUG, "Pandoc stdout", result.stdout)
+        log_output(logger, logging.WARNING, "Pandoc stderr", result.stderr)
+    
+        logger.info(f"✓ PDF conversion successful! Output: {output_file}")
+        pdf_success = True
+    
+    except JobKilled as e:
+        # Timeout, resource limit or the stop button
+        logger.error(f"✗ PDF conversion stopped: {e.reason}")
+    except subprocess.CalledProcessError as e:
+        logger.error(f"✗ PDF conversion failed with exit code {e.returncode}")
+        logger.error(f"Command: {' '.join(e.cmd)}")
+        log_output(logger, logging.ERROR, "Stdout", e.stdout)
+        log_output(logger, logging.ERROR, "Stderr", e.stderr)
+    except Exception as e:
+        logger.error(f"✗ Unexpected error during PDF conversion: {str(e)}")
+    
+    # Always convert to HTML as reliable fallback
+    logger.info("Generating HTML fallback...")
+    
+    # Convert to HTML first
+    html_output = output_abs.replace('.pdf', '.html')
+    def html_command(tools):
+        return [
+            tools.path('pandoc'),
             input_abs,
             '-o', html_output,
             '--mathjax',
             '-s',  # Standalone HTML with header and footer
-            '--syntax-highlighting=default'
+            tools.highlight_option('default')
         ]
-        
-        try:
-            # Convert to HTML
-            subprocess.run(
-                html_cmd,
-                capture_output=True,
-                text=True,
-                check=True,
-                encoding='utf-8'
-            )
-            logger.info(f"✓ HTML conversion successful: {html_output}")
-            
-            return pdf_success
-            
-        except subprocess.CalledProcessError as e2:
-            logger.error(f"✗ HTML conversion also failed: {e2.returncode}")
-            return False
-        except Exception as e:
-            logger.error(f"✗ Unexpected error during HTML conversion: {str(e)}")
-            return False
+    
+    try:
+        # Convert to HTML
+        toolchain.run_tool(
+            html_command,
+            capture_output=True,
+            text=True,
+            encoding='utf-8'
+        )
+        logger.info(f"✓ HTML conversion successful: {html_output}")
+    
+        return pdf_success
+    
+    except JobKilled as e2:
+        logger.error(f"✗ HTML conversion stopped: {e2.reason}")
+        return False
+    except subprocess.CalledProcessError as e2:
+        logger.error(f"✗ HTML conversion also failed: {e2.returncode}")
+        return False
+    except Exception as e:
+        logger.error(f"✗ Unexpected error during HTML conversion: {str(e)}")
+        return False
 
 def main():
+    # Console plus rotating JSON log file, written by a background thread
+    setup_logging()
+    
     root = tk.Tk()
     app = MD2PDFConverter(root)
     
-    # Check dependencies on startup
-    if not app.check_dependencies():
-        sys.exit(1)
+    # Check dependencies without blocking startup
+    app.check_dependencies()
     
     root.mainloop()
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing and memory tracing
+Conversion code wraps its stages in `profiling.stage(name)`. While tracing is
+off this costs almost nothing; while it is on every stage records its wall
+time, CPU time, subprocess CPU time, peak Python memory and peak RSS.
+Memory peaks are process-wide: tracemalloc has a single peak, so a stage
+reports the highest traced memory of the process while it was open, which
+includes allocations by stages running concurrently in other threads.
+
+    tracer = profiling.start_tracing()
+    profiling.add_hook(lambda record: print(record['name'], record['wall']))
+    ... convert ...
+    profiling.stop_tracing()
+    tracer.write('profile.json', 'chrome')   # or 'json'
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_tracer = None
+_hooks = []
+
+
+def _children_cpu():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class Tracer:
+    """Collects stage records for one process"""
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.records = []
+        # Records carry wall-clock start times so stages from other processes line up
+        self.epoch = time.time()
+        self.origin = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._started_tracemalloc = False
+        # Open stages of all threads; each keeps the highest peak seen while open
+        self._open = []
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def stop(self):
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name, **args):
+        stack = self._stack()
+        memory = self.trace_memory and tracemalloc.is_tracing()
+        entry = {'peak': 0}
+        if memory:
+            with self._lock:
+                # The peak is process-global: fold it into every open stage
+                # (in any thread) before resetting it for this one
+                peak = tracemalloc.get_traced_memory()[1]
+                for other in self._open:
+                    other['peak'] = max(other['peak'], peak)
+                tracemalloc.reset_peak()
+                self._open.append(entry)
+        stack.append(entry)
+
+        start = time.perf_counter()
+        cpu = time.thread_time()
+        child = _children_cpu()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            stack.pop()
+            record = {
+                'name': name,
+                'start': self.epoch + (start - self.origin),
+                'wall': wall,
+                'cpu': time.thread_time() - cpu,
+                'child_cpu': _children_cpu() - child,
+                'depth': len(stack),
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'peak_rss_mb': _peak_rss_mb(),
+            }
+            if memory:
+                with self._lock:
+                    peak = max(entry['peak'], tracemalloc.get_traced_memory()[1])
+                    self._open.remove(entry)
+                record['peak_python_mb'] = peak / (1024 * 1024)
+            if args:
+                record['args'] = args
+            with self._lock:
+                self.records.append(record)
+            for hook in list(_hooks):
+                try:
+                    hook(record)
+                except Exception:
+                    pass
+
+    def merge(self, records):
+        """Add records collected by another process (e.g. a batch worker)"""
+        if records:
+            with self._lock:
+                self.records.extend(records)
+
+    def _relative(self):
+        """Records with start times relative to the start of tracing"""
+        records = [dict(r, start=r['start'] - self.epoch) for r in self.records]
+        return sorted(records, key=lambda r: (r['pid'], r['start']))
+
+    def to_json(self):
+        return {'stages': self._relative()}
+
+    def to_chrome_trace(self):
+        """Chrome trace event format (load in chrome://tracing or Perfetto)"""
+        events = []
+        for r in self._relative():
+            args = {k: v for k, v in r.items() if k not in ('name', 'start', 'wall', 'pid', 'tid')}
+            events.append({
+                'name': r['name'],
+                'ph': 'X',
+                'ts': r['start'] * 1e6,
+                'dur': r['wall'] * 1e6,
+                'pid': r['pid'],
+                'tid': r['tid'],
+                'args': args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path, fmt='json'):
+        data = self.to_chrome_trace() if fmt == 'chrome' else self.to_json()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1, ensure_ascii=False)
+
+
+def start_tracing(trace_memory=True):
+    """Activate a new process-wide tracer and return it"""
+    global _tracer
+    tracer = Tracer(trace_memory)
+    tracer.start()
+    _tracer = tracer
+    return tracer
+
+
+def stop_tracing():
+    """Deactivate the current tracer and return it (None if tracing was off)"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.stop()
+    return tracer
+
+
+def is_tracing():
+    return _tracer is not None
+
+
+def current_tracer():
+    return _tracer
+
+
+def add_hook(callback):
+    """Call callback(record) whenever a traced stage finishes"""
+    _hooks.append(callback)
+
+
+def remove_hook(callback):
+    if callback in _hooks:
+        _hooks.remove(callback)
+
+
+@contextmanager
+def _noop():
+    yield
+
+
+def stage(name, **args):
+    """Context manager timing a stage of the active tracer (no-op when tracing is off)"""
+    tracer = _tracer
+    if tracer is None:
+        return _noop()
+    return tracer.stage(name, **args)
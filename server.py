@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resident conversion daemon (md2pdf serve)
+Keeps WeasyPrint, a Markdown instance, the compiled stylesheet and the font
+configuration loaded, and converts Markdown posted over loopback HTTP or a
+Unix socket into PDF bytes. It also runs a persistent job queue (see
+jobqueue) so that several local services share a bounded number of
+pandoc/LaTeX conversions instead of each forking their own.
+
+    POST /convert    body: UTF-8 Markdown, optional header X-Base-URL
+                     returns: application/pdf
+    POST /jobs       body: JSON {"input", "output", "priority", "engine", "options"}
+                     returns: 202 {"id": ...}, or 429 with Retry-After when the queue is full
+    GET  /jobs/<id>  returns: JSON job status (state queued/running/done/failed)
+    GET  /metrics    returns: JSON queue depth, latency percentiles and throughput
+    GET  /health     returns: ok
+
+The daemon converts with its own privileges, so it only listens on loopback
+(or a Unix socket only its user can open) unless --allow-remote is given,
+documents may only read local files inside the --allow-dir directories
+(default: the directory the daemon was started in), and queued jobs must
+have their input, output and stylesheets inside them too.
+"""
+
+import os
+import sys
+import json
+import stat
+import time
+import socket
+import argparse
+import functools
+import ipaddress
+import logging
+import http.client
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+from batch import default_workers
+from cache import is_within
+from logsetup import setup_logging
+from jobqueue import JobQueue, QueueFull, QueueLocked, DEFAULT_MAX_QUEUED
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Largest request body accepted, in bytes
+DEFAULT_MAX_BODY = 64 * 1024 * 1024
+
+# Seconds a client is asked to wait before resubmitting to a full queue
+RETRY_AFTER = 2
+# Interval between status polls of a queued job (grows up to POLL_MAX)
+POLL_MIN = 0.2
+POLL_MAX = 2.0
+
+
+def is_loopback(host):
+    """True if every address host resolves to is a loopback address"""
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+        return bool(addresses) and all(ipaddress.ip_address(address.split('%')[0]).is_loopback
+                                       for address in addresses)
+    except (OSError, ValueError):
+        return False
+
+
+def is_allowed(path, allowed_dirs):
+    """True if path lies inside one of allowed_dirs"""
+    return any(is_within(path, directory) for directory in allowed_dirs)
+
+
+def local_path(url):
+    """Filesystem path of a file: URL or a plain path; raises ValueError for other URLs"""
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        return url2pathname(parsed.path)
+    # One-letter schemes are Windows drive letters
+    if parsed.scheme and len(parsed.scheme) > 1:
+        raise ValueError(f"not a local path: {url}")
+    return url
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    """HTTP front end of the daemon"""
+
+    server_version = 'md2pdf'
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, 'text/plain', b'ok')
+        elif self.path == '/metrics':
+            self._reply_json(200, self.server.queue.metrics())
+        elif self.path.startswith('/jobs/'):
+            try:
+                job = self.server.queue.status(int(self.path[len('/jobs/'):]))
+            except ValueError:
+                job = None
+            if job is None:
+                self._reply_json(404, {'error': 'unknown job'})
+            else:
+                self._reply_json(200, job)
+        else:
+            self._reply(404, 'text/plain', b'not found')
+
+    def do_POST(self):
+        if self.path not in ('/convert', '/jobs'):
+            self._reply(404, 'text/plain', b'not found')
+            return
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            self._reply(411, 'text/plain', b'Content-Length required')
+            return
+        if length < 0 or length > self.server.max_body:
+            # The body is not read, so the connection cannot be reused
+            self.close_connection = True
+            self._reply(413, 'text/plain', f'request body larger than {self.server.max_body} bytes'.encode('utf-8'))
+            return
+        body = self.rfile.read(length)
+        if self.path == '/jobs':
+            self._submit(body)
+            return
+        base_url = self.headers.get('X-Base-URL')
+        if base_url:
+            try:
+                base_url = local_path(base_url)
+            except ValueError as e:
+                self._reply(400, 'text/plain; charset=utf-8', str(e).encode('utf-8'))
+                return
+            if not self.server.allows(base_url):
+                self._reply(403, 'text/plain; charset=utf-8',
+                            f"base URL outside the allowed directories: {base_url}".encode('utf-8'))
+                return
+        if self.server.converter is None:
+            self._reply(503, 'text/plain', b'WeasyPrint is not available in this daemon')
+            return
+
+        try:
+            md_text = body.decode('utf-8')
+            pdf_bytes = self.server.converter.write_pdf(md_text, base_url=base_url)
+        except Exception as e:
+            logger.error(f"✗ Conversion failed: {e}")
+            self._reply(500, 'text/plain; charset=utf-8', str(e).encode('utf-8'))
+            return
+        self._reply(200, 'application/pdf', pdf_bytes)
+
+    def _submit(self, body):
+        try:
+            request = json.loads(body.decode('utf-8'))
+            options = request.get('options') or {}
+            # Queued jobs read and write with the daemon's rights: every path must be allowed
+            paths = [request['input'], request['output'], *options.get('stylesheets', ())]
+            if options.get('app_path'):
+                paths.append(options['app_path'])
+            denied = [path for path in paths if not self.server.allows(os.path.abspath(path))]
+            if denied:
+                self._reply_json(403, {'error': f"path outside the allowed directories: {denied[0]}"})
+                return
+            job_id = self.server.queue.submit(
+                request['input'],
+                request['output'],
+                priority=request.get('priority', 'batch'),
+                engine=request.get('engine', 'pandoc'),
+                options=options,
+            )
+        except QueueFull as e:
+            self._reply_json(429, {'error': str(e)}, {'Retry-After': str(RETRY_AFTER)})
+            return
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._reply_json(400, {'error': f"bad job request: {e}"})
+            return
+        self._reply_json(202, {'id': job_id})
+
+    def _reply(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply_json(self, status, data, headers=None):
+        self._reply(status, 'application/json', json.dumps(data).encode('utf-8'), headers)
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server listening on a Unix domain socket"""
+
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ''
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """http.client connection over a Unix domain socket"""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def make_server(host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, workers=None,
+                max_queued=DEFAULT_MAX_QUEUED, queue_path=None, allowed_dirs=None,
+                max_body=DEFAULT_MAX_BODY, allow_remote=False):
+    """Create (but do not start) a daemon with a warm converter and a job queue attached
+
+    Documents may only read local files inside `allowed_dirs` (default: the
+    current directory). A non-loopback `host` (unless `allow_remote` is
+    set) or a `socket_path` that exists but is not a socket raises
+    ValueError; QueueLocked is raised when another daemon uses the same
+    queue file.
+    The queue's worker threads are started here; call httpd.queue.stop() on shutdown.
+    """
+    if not socket_path and not allow_remote and not is_loopback(host):
+        raise ValueError(f"{host} is not a loopback address; pass --allow-remote to listen on it anyway")
+    if socket_path:
+        try:
+            st = os.lstat(socket_path)
+        except FileNotFoundError:
+            pass
+        else:
+            # A stale socket of an earlier daemon is replaced, anything else is left alone
+            if not stat.S_ISSOCK(st.st_mode):
+                raise ValueError(f"{socket_path} exists and is not a socket")
+            os.remove(socket_path)
+        # Only the daemon's user may connect, from the moment the socket exists.
+        # The umask is process-wide: files other threads create meanwhile (logs) are private too.
+        umask = os.umask(0o177)
+        try:
+            httpd = UnixHTTPServer(socket_path, ConversionHandler)
+        finally:
+            os.umask(umask)
+    else:
+        httpd = ThreadingHTTPServer((host, port), ConversionHandler)
+    httpd.allowed_dirs = [os.path.abspath(directory) for directory in (allowed_dirs or [os.getcwd()])]
+    httpd.allows = functools.partial(is_allowed, allowed_dirs=httpd.allowed_dirs)
+    httpd.max_body = max_body
+    # Heavy imports happen here, once per daemon instead of once per document
+    try:
+        from converter import ConverterSession
+        httpd.converter = ConverterSession(allow_file=httpd.allows)
+    except (ImportError, OSError) as e:
+        # Queued pandoc jobs still work without WeasyPrint
+        logger.warning(f"⚠ WeasyPrint unavailable, /convert is disabled: {e}")
+        httpd.converter = None
+    from engines import convert_document
+    try:
+        httpd.queue = JobQueue(convert_document, path=queue_path, workers=workers or default_workers(),
+                               max_queued=max_queued)
+    except QueueLocked:
+        httpd.server_close()
+        raise
+    httpd.queue.start()
+    return httpd
+
+
+def _connect(server, timeout=None):
+    """HTTP connection to a daemon given as http://host:port or unix:/path/to/socket"""
+    if server.startswith('unix:'):
+        return UnixHTTPConnection(server[len('unix:'):], timeout=timeout)
+    url = urlparse(server if '://' in server else f'http://{server}')
+    return http.client.HTTPConnection(url.hostname, url.port or DEFAULT_PORT, timeout=timeout)
+
+
+def _request(server, method, path, body=None, headers=None, timeout=None):
+    """Send one request; returns (response, body bytes)"""
+    conn = _connect(server, timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response, response.read()
+    finally:
+        conn.close()
+
+
+def convert_remote(md_text, server, base_url=None, timeout=None):
+    """Send Markdown to a running daemon and return the PDF bytes.
+
+    `server` is either http://host:port or unix:/path/to/socket.
+    Raises RuntimeError when the daemon reports a failure.
+    """
+    headers = {'Content-Type': 'text/markdown; charset=utf-8'}
+    if base_url:
+        headers['X-Base-URL'] = base_url
+    response, body = _request(server, 'POST', '/convert', md_text.encode('utf-8'), headers, timeout)
+    if response.status != 200:
+        raise RuntimeError(body.decode('utf-8', 'replace') or f"HTTP {response.status}")
+    return body
+
+
+def submit_job(server, input_file, output_file, priority='batch', engine='pandoc', options=None,
+               wait_when_full=True, timeout=None):
+    """Queue a conversion on a running daemon and return the job id.
+
+    Paths are sent as absolute paths; the daemon runs on the same machine.
+    When the queue is full, waits as asked by Retry-After and tries again
+    (wait_when_full=False raises RuntimeError instead).
+    """
+    request = json.dumps({
+        'input': os.path.abspath(input_file),
+        'output': os.path.abspath(output_file),
+        'priority': priority,
+        'engine': engine,
+        'options': options or {},
+    }).encode('utf-8')
+    while True:
+        response, body = _request(server, 'POST', '/jobs', request,
+                                  {'Content-Type': 'application/json'}, timeout)
+        data = json.loads(body.decode('utf-8') or '{}')
+        if response.status == 202:
+            return data['id']
+        if response.status == 429 and wait_when_full:
+            delay = float(response.getheader('Retry-After') or RETRY_AFTER)
+            logger.info(f"Queue full, retrying in {delay:g}s")
+            time.sleep(delay)
+            continue
+        raise RuntimeError(data.get('error') or f"HTTP {response.status}")
+
+
+def job_status(server, job_id, timeout=None):
+    """Status dict of a queued job"""
+    response, body = _request(server, 'GET', f'/jobs/{job_id}', timeout=timeout)
+    data = json.loads(body.decode('utf-8') or '{}')
+    if response.status != 200:
+        raise RuntimeError(data.get('error') or f"HTTP {response.status}")
+    return data
+
+
+def wait_for_job(server, job_id, timeout=None):
+    """Poll until the job has finished; returns its final status dict"""
+    delay = POLL_MIN
+    while True:
+        job = job_status(server, job_id, timeout)
+        if job['state'] in ('done', 'failed'):
+            return job
+        time.sleep(delay)
+        delay = min(POLL_MAX, delay * 1.5)
+
+
+def main(argv=None):
+    """Entry point of `md2pdf serve`"""
+    parser = argparse.ArgumentParser(
+        prog='md2pdf serve',
+        description='Run a resident Markdown to PDF conversion daemon'
+    )
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f'Loopback address to listen on (default: {DEFAULT_HOST})')
+    parser.add_argument('--allow-remote', action='store_true',
+                        help='Allow --host to be a non-loopback address (anyone who can reach it converts '
+                             'with the daemon\'s privileges)')
+    parser.add_argument('--allow-dir', action='append', metavar='DIR',
+                        help='Directory whose files documents may use (repeatable; default: the current directory)')
+    parser.add_argument('--max-body', type=float, default=DEFAULT_MAX_BODY / 1024 / 1024, metavar='MB',
+                        help=f'Largest request accepted (default: {DEFAULT_MAX_BODY // 1024 // 1024} MB)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'Port to listen on (default: {DEFAULT_PORT})')
+    parser.add_argument('--socket', help='Listen on this Unix socket instead of TCP')
+    parser.add_argument('--workers', type=int, default=default_workers(),
+                        help='Queued conversions run at the same time (default: number of CPU cores)')
+    parser.add_argument('--max-queued', type=int, default=DEFAULT_MAX_QUEUED,
+                        help=f'Waiting jobs before new ones are rejected (default: {DEFAULT_MAX_QUEUED}; '
+                             'batch jobs are rejected earlier)')
+    parser.add_argument('--queue-db', help='SQLite file of the job queue (default: queue.sqlite in the cache directory)')
+    parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    args = parser.parse_args(argv)
+
+    setup_logging(logging.DEBUG if args.debug else logging.INFO)
+    if args.socket and not hasattr(socket, 'AF_UNIX'):
+        parser.error('Unix sockets are not supported on this platform')
+
+    for directory in args.allow_dir or []:
+        if not os.path.isdir(directory):
+            parser.error(f'--allow-dir needs a directory: {directory}')
+
+    logger.info("Loading conversion engine...")
+    try:
+        httpd = make_server(args.host, args.port, args.socket, workers=args.workers,
+                            max_queued=args.max_queued, queue_path=args.queue_db, allowed_dirs=args.allow_dir,
+                            max_body=int(args.max_body * 1024 * 1024), allow_remote=args.allow_remote)
+    except (ValueError, QueueLocked) as e:
+        parser.error(str(e))
+    if args.allow_remote and not args.socket and not is_loopback(args.host):
+        logger.warning(f"⚠ Listening on {args.host}: anyone who can reach it can convert files with this user's rights")
+    where = f"unix:{args.socket}" if args.socket else f"http://{args.host}:{args.port}"
+    logger.info(f"✓ md2pdf daemon listening on {where} ({args.workers} queue workers), "
+                f"serving files under {', '.join(httpd.allowed_dirs)}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down...")
+    finally:
+        httpd.server_close()
+        httpd.queue.stop(timeout=5)
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
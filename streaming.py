@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+大文件流式转换
+
+逐行读取Markdown，按块（空行分隔的段落、整个代码块或原始HTML块）转换为HTML，
+写入溢出到临时文件的缓冲区，再交给WeasyPrint。
+Python侧的峰值内存与最大的块成正比，而不是与整个文件成正比。
+
+块的边界与 mathscan 一致：围栏代码块整体作为一块，行间公式不跨越空行。
+引用式链接的定义只对所在块有效，因此含有引用定义的文档不使用流式转换
+（见 has_reference_definitions）。
+"""
+
+import re
+import tempfile
+
+from markdown.util import BLOCK_LEVEL_ELEMENTS
+
+from mathscan import scan_math, restore_math, render_formula, match_fence, closes_fence
+
+# 缓冲区超过该大小后写入临时文件
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# 列表项和缩进的续行不能作为新块的开头，否则列表会被拆开、编号重新开始
+_CONTINUATION_RE = re.compile(r'[ \t]|([*+-]|\d+[.)])[ \t]')
+# 引用式链接的定义：[label]: url
+_REFERENCE_DEF_RE = re.compile(r' {0,3}\[[^\]]+\]:')
+# 顶格的块级HTML标签开始一个原始HTML块，markdown 把它保留到对应的结束标签（可以跨越空行）
+_HTML_BLOCK_RE = re.compile(r'<([a-zA-Z][a-zA-Z0-9]*)(?=[\s>/]|$)')
+_VOID_ELEMENTS = {'hr'}
+
+
+def _html_depth(line, tag):
+    """一行中 tag 的开始标签数减去结束标签数（自闭合的标签不计）"""
+    opened = len(re.findall(r'<' + tag + r'(?=[\s>])(?![^>]*/>)', line, re.I))
+    closed = len(re.findall(r'</' + tag + r'\s*>', line, re.I))
+    return opened - closed
+
+
+def has_reference_definitions(lines):
+    """行迭代器中是否有（代码块之外的）引用式链接定义"""
+    fence = None
+    for line in lines:
+        if fence is not None:
+            if closes_fence(line, fence):
+                fence = None
+        elif _REFERENCE_DEF_RE.match(line):
+            return True
+        else:
+            fence = match_fence(line)
+    return False
+
+
+def iter_blocks(lines):
+    """把行迭代器切分成可以独立转换的Markdown块"""
+    block = []
+    fence = None
+    html_tag = None
+    html_depth = 0
+    in_comment = False
+    pending_blank = False
+
+    for line in lines:
+        if fence is not None:
+            block.append(line)
+            if closes_fence(line, fence):
+                fence = None
+            continue
+
+        if in_comment or html_tag is not None:
+            # 原始HTML块中的空行不结束块
+            block.append(line)
+            if in_comment:
+                in_comment = '-->' not in line
+            else:
+                html_depth += _html_depth(line, html_tag)
+                if html_depth <= 0:
+                    html_tag = None
+            continue
+
+        if not line.strip():
+            block.append(line)
+            pending_blank = True
+            continue
+
+        if pending_blank and not _CONTINUATION_RE.match(line):
+            yield ''.join(block)
+            block = []
+        pending_blank = False
+
+        block.append(line)
+        fence = match_fence(line)
+        if fence is None:
+            if line.startswith('<!--'):
+                in_comment = '-->' not in line[4:]
+            else:
+                match = _HTML_BLOCK_RE.match(line)
+                tag = match and match.group(1).lower()
+                if tag in BLOCK_LEVEL_ELEMENTS and tag not in _VOID_ELEMENTS:
+                    html_depth = _html_depth(line, tag)
+                    if html_depth > 0:
+                        html_tag = tag
+
+    if block:
+        yield ''.join(block)
+
+
+def iter_html(lines, md, render=render_formula, transform=None):
+    """逐块转换为HTML片段；md是可复用的 markdown.Markdown 实例
+
+    transform: 对每个HTML片段的后处理（例如替换图片），可为None
+    """
+    for block in iter_blocks(lines):
+        text, formulas = scan_math(block)
+        md.reset()
+        html = restore_math(md.convert(text), formulas, render=render)
+        yield html if transform is None else transform(html)
+
+
+def write_html(md_file, out, md, head, tail, render=render_formula, transform=None):
+    """把md_file流式转换为完整的HTML页面，写入二进制文件对象out"""
+    out.write(head.encode('utf-8'))
+    with open(md_file, 'r', encoding='utf-8') as f:
+        for html in iter_html(f, md, render, transform):
+            out.write(html.encode('utf-8'))
+            out.write(b'\n')
+    out.write(tail.encode('utf-8'))
+
+
+def spool_html(md_file, md, head, tail, render=render_formula, transform=None):
+    """流式转换到SpooledTemporaryFile，返回已回到开头的文件对象"""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+b')
+    write_html(md_file, spool, md, head, tail, render, transform)
+    spool.seek(0)
+    return spool
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Supervised subprocesses for the pandoc/LaTeX engines
+Every tool run goes through Supervisor.run (via toolchain.run_tool), which
+
+- starts the tool in its own process group, so pandoc's LaTeX children are
+  stopped together with it;
+- enforces a wall-clock timeout, and on POSIX a CPU-time and a memory rlimit
+  per process;
+- stops the job when the process-wide cancel event is set (GUI stop button,
+  batch cancellation);
+- retries transient failures (fork failures, files locked by another MiKTeX
+  process) with exponential backoff.
+
+A job that is stopped raises JobKilled, whose `reason` says why. Limits come
+from the environment so that batch worker processes inherit them:
+
+    MD2PDF_TIMEOUT       wall-clock seconds per tool run (default 300, 0 = none)
+    MD2PDF_CPU_TIMEOUT   CPU seconds per process (default 240, 0 = none)
+    MD2PDF_MEMORY_MB     data segment limit per process in MB (default 4096, 0 = none)
+"""
+
+import os
+import re
+import sys
+import time
+import errno
+import shutil
+import signal
+import random
+import logging
+import threading
+import subprocess
+from collections import namedtuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WALL_TIMEOUT = 300
+DEFAULT_CPU_TIMEOUT = 240
+DEFAULT_MEMORY_MB = 4096
+
+# How often a running job checks for cancellation
+POLL_INTERVAL = 0.5
+
+RETRIES = 2
+BACKOFF_SECONDS = 0.5
+
+# Failing to start a process for these reasons is worth another try
+TRANSIENT_ERRNOS = {errno.EAGAIN, errno.ENOMEM, errno.ETXTBSY, errno.EBUSY}
+# Tool output of failures that go away on their own
+TRANSIENT_RE = re.compile(
+    r'Resource temporarily unavailable|database is locked|'
+    r'being used by another process|Text file busy',
+    re.I
+)
+# Tool output of a process that ran out of memory
+MEMORY_RE = re.compile(r'out of memory|Cannot allocate memory|memory exhausted|MemoryError', re.I)
+
+Limits = namedtuple('Limits', ['wall', 'cpu', 'memory_mb'])
+
+
+def _env_number(name, default):
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning(f"⚠ Ignoring invalid {name}={value!r}")
+        return default
+
+
+def limits_from_env():
+    """Current limits; 0 disables a limit"""
+    return Limits(
+        wall=_env_number('MD2PDF_TIMEOUT', DEFAULT_WALL_TIMEOUT) or None,
+        cpu=_env_number('MD2PDF_CPU_TIMEOUT', DEFAULT_CPU_TIMEOUT) or None,
+        memory_mb=_env_number('MD2PDF_MEMORY_MB', DEFAULT_MEMORY_MB) or None,
+    )
+
+
+class JobKilled(subprocess.SubprocessError):
+    """A supervised job was stopped; `reason` says why"""
+
+    def __init__(self, cmd, reason, stdout=None, stderr=None):
+        super().__init__(f"{os.path.basename(str(cmd[0]))} stopped: {reason}")
+        self.cmd = cmd
+        self.reason = reason
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+_cancel_event = None
+
+
+def set_cancel_event(event):
+    """Use `event` (threading or multiprocessing Event) to cancel running jobs.
+
+    Also called by batch worker processes at start-up.
+    """
+    global _cancel_event
+    _cancel_event = event
+
+
+def cancelled():
+    return _cancel_event is not None and _cancel_event.is_set()
+
+
+# Where prlimit(2) is missing the limits are set by a shell that then execs the
+# tool; no Python code may run between fork and exec in a threaded process.
+# $1 = CPU seconds, $2 = data segment KB (0 = no limit)
+_ULIMIT_WRAPPER = ('if [ "$1" -gt 0 ]; then ulimit -St "$1" && ulimit -Ht $(($1 + 5)) || exit 126; fi; '
+                   'if [ "$2" -gt 0 ]; then ulimit -d "$2" || exit 126; fi; '
+                   'shift 2; exec "$@"')
+
+
+def _limit_process(pid, limits):
+    """Apply the CPU and memory limits to a process that has just been started"""
+    try:
+        if limits.cpu:
+            # SIGXCPU at the soft limit, SIGKILL a little later
+            cpu = int(limits.cpu)
+            resource.prlimit(pid, resource.RLIMIT_CPU, (cpu, cpu + 5))
+        if limits.memory_mb:
+            # RLIMIT_DATA rather than RLIMIT_AS: pandoc's runtime reserves a huge
+            # address space up front and would not start under an address space limit
+            memory = int(limits.memory_mb * 1024 * 1024)
+            resource.prlimit(pid, resource.RLIMIT_DATA, (memory, memory))
+    except ProcessLookupError:
+        pass  # Already finished
+
+
+def _ulimit_command(cmd, limits):
+    """cmd run through the ulimit shell wrapper"""
+    # Keep the OSError of a missing tool, which would otherwise become exit code 127
+    if shutil.which(cmd[0]) is None:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), cmd[0])
+    cpu = int(limits.cpu or 0)
+    memory_kb = int((limits.memory_mb or 0) * 1024)
+    return ['/bin/sh', '-c', _ULIMIT_WRAPPER, 'sh', str(cpu), str(memory_kb)] + list(cmd)
+
+
+def _kill_group(proc):
+    """Stop a job together with every process it started"""
+    try:
+        if sys.platform == 'win32':
+            # taskkill /T also stops the children
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(proc.pid)], capture_output=True)
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        proc.kill()
+
+
+class Supervisor:
+    """Runs tool commands with limits, cancellation and retries"""
+
+    def __init__(self, limits=None, retries=RETRIES, backoff=BACKOFF_SECONDS):
+        self.limits = limits
+        self.retries = retries
+        self.backoff = backoff
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def cancel_all(self):
+        """Stop every job this supervisor is running"""
+        with self._lock:
+            running = list(self._running)
+        for proc in running:
+            _kill_group(proc)
+
+    def _popen(self, cmd, limits, capture_output, text, encoding, errors, cwd, env):
+        kwargs = {}
+        limited = resource is not None and (limits.cpu or limits.memory_mb)
+        if sys.platform == 'win32':
+            kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs['start_new_session'] = True
+            if limited and not hasattr(resource, 'prlimit'):
+                cmd = _ulimit_command(cmd, limits)
+        pipe = subprocess.PIPE if capture_output else None
+        proc = subprocess.Popen(cmd, stdout=pipe, stderr=pipe, stdin=subprocess.DEVNULL, cwd=cwd, env=env,
+                                text=text, encoding=encoding, errors=errors, **kwargs)
+        if limited and hasattr(resource, 'prlimit'):
+            # Linux: set right after the start, before pandoc gets to spawn LaTeX
+            _limit_process(proc.pid, limits)
+        return proc
+
+    def _run_once(self, cmd, limits, **kwargs):
+        proc = self._popen(cmd, limits, **kwargs)
+        with self._lock:
+            self._running.add(proc)
+        start = time.monotonic()
+        reason = None
+        try:
+            while True:
+                try:
+                    stdout, stderr = proc.communicate(timeout=POLL_INTERVAL)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                if cancelled():
+                    reason = 'cancelled'
+                elif limits.wall and time.monotonic() - start > limits.wall:
+                    reason = f'wall time limit of {limits.wall:g}s exceeded'
+                if reason:
+                    _kill_group(proc)
+                    stdout, stderr = proc.communicate()
+                    raise JobKilled(cmd, reason, stdout, stderr)
+        finally:
+            with self._lock:
+                self._running.discard(proc)
+            if proc.poll() is None:
+                # Interrupted from outside (KeyboardInterrupt): do not leave LaTeX running
+                _kill_group(proc)
+                proc.wait()
+
+        returncode = proc.returncode
+        if limits.cpu and hasattr(signal, 'SIGXCPU') and returncode == -signal.SIGXCPU:
+            raise JobKilled(cmd, f'CPU time limit of {limits.cpu:g}s exceeded', stdout, stderr)
+        if returncode != 0 and limits.memory_mb and MEMORY_RE.search(f"{stdout or ''}{stderr or ''}"):
+            raise JobKilled(cmd, f'memory limit of {limits.memory_mb:g} MB exceeded', stdout, stderr)
+        return subprocess.CompletedProcess(cmd, returncode, stdout, stderr)
+
+    def run(self, cmd, check=False, capture_output=False, text=None, encoding=None, errors=None,
+            cwd=None, env=None, limits=None):
+        """subprocess.run replacement; raises JobKilled when a limit stops the job"""
+        limits = limits or self.limits or limits_from_env()
+        attempt = 0
+        while True:
+            if cancelled():
+                raise JobKilled(cmd, 'cancelled')
+            try:
+                result = self._run_once(cmd, limits, capture_output=capture_output, text=text,
+                                        encoding=encoding, errors=errors, cwd=cwd, env=env)
+            except OSError as e:
+                if e.errno not in TRANSIENT_ERRNOS or attempt >= self.retries:
+                    raise
+                why = str(e)
+            else:
+                output = f"{result.stdout or ''}{result.stderr or ''}" if capture_output else ''
+                if result.returncode == 0 or attempt >= self.retries or not TRANSIENT_RE.search(output):
+                    if check and result.returncode != 0:
+                        raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
+                    return result
+                why = f"exit code {result.returncode}"
+            attempt += 1
+            delay = self.backoff * 2 ** (attempt - 1) * random.uniform(1, 1.5)
+            logger.warning(f"⚠ {os.path.basename(str(cmd[0]))} failed transiently ({why}), "
+                           f"retrying in {delay:.1f}s ({attempt}/{self.retries})")
+            time.sleep(delay)
+
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+
+def get_supervisor():
+    """The Supervisor of this process"""
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = Supervisor()
+        return _supervisor
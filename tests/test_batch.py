@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import multiprocessing
+
+import pytest
+
+import supervisor
+from batch import run_batch, output_collisions
+
+
+def slow_first(input_file, output_file):
+    """Earlier jobs finish last, so results arrive out of order"""
+    time.sleep(0.3 if input_file == 'a.md' else 0.0)
+    return input_file != 'c.md'
+
+
+def crash(input_file, output_file):
+    raise RuntimeError(f'cannot read {input_file}')
+
+
+def cancel_after_first(input_file, output_file, cancel):
+    cancel.set()
+    return True
+
+
+@pytest.fixture(autouse=True)
+def no_cancel_event(monkeypatch):
+    monkeypatch.setattr(supervisor, '_cancel_event', None)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_results_are_reported_in_input_order(workers):
+    jobs = [('a.md', 'a.pdf'), ('b.md', 'b.pdf'), ('c.md', 'c.pdf')]
+    reported = []
+    results = run_batch(jobs, slow_first, workers=workers,
+                        on_result=lambda result, done, total: reported.append((result.index, done, total)))
+    assert [result.input_file for result in results] == ['a.md', 'b.md', 'c.md']
+    assert [result.success for result in results] == [True, True, False]
+    assert reported == [(0, 1, 3), (1, 2, 3), (2, 3, 3)]
+
+
+def test_exceptions_become_failed_results():
+    results = run_batch([('a.md', 'a.pdf'), ('b.md', 'b.pdf')], crash, workers=2)
+    assert [result.error for result in results] == ['cannot read a.md', 'cannot read b.md']
+    assert not any(result.success for result in results)
+
+
+def test_output_collisions():
+    jobs = [('docs/a.md', 'out/a.pdf'), ('notes/a.md', 'out/a.pdf'), ('b.md', 'out/b.pdf'),
+            ('b.md', 'out/b.pdf'), ('c.md', 'out/c.pdf'), ('c.markdown', 'out/c.html')]
+    collisions = output_collisions(jobs)
+    assert collisions == {'out/a.pdf': ['docs/a.md', 'notes/a.md'], 'out/c.pdf': ['c.md', 'c.markdown']}
+
+
+def test_cancel_fails_the_remaining_jobs():
+    cancel = multiprocessing.Event()
+    jobs = [(f'{i}.md', f'{i}.pdf') for i in range(3)]
+    results = run_batch(jobs, cancel_after_first, args=(cancel,), workers=1, cancel=cancel)
+    assert results[0].success
+    assert [result.error for result in results[1:]] == ['cancelled', 'cancelled']
+
+
+def test_cancel_before_start_with_a_pool():
+    cancel = multiprocessing.Event()
+    cancel.set()
+    results = run_batch([(f'{i}.md', f'{i}.pdf') for i in range(4)], slow_first, workers=2, cancel=cancel)
+    assert [result.error for result in results] == ['cancelled'] * 4
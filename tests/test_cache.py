@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+
+import pytest
+
+from cache import OutputCache, LRUDict, FileLock, make_key, release_output, USAGE_FILE
+
+
+def make_output(path, size=1000):
+    path.write_bytes(b'x' * size)
+    return str(path)
+
+
+def age(cache, key, seconds):
+    """Make an entry look used `seconds` ago"""
+    meta = os.path.join(cache._entry_dir(key), 'meta.json')
+    st = os.stat(meta)
+    os.utime(meta, (st.st_atime - seconds, st.st_mtime - seconds))
+
+
+def test_make_key_is_stable_and_separates_parts():
+    assert make_key('a', b'b') == make_key(b'a', 'b')
+    assert make_key('ab', 'c') != make_key('a', 'bc')
+    assert make_key('a', 'b') != make_key('b', 'a')
+
+
+def test_lru_dict_evicts_least_recently_used():
+    items = LRUDict(2)
+    items.put('a', 1)
+    items.put('b', 2)
+    assert items.get('a') == 1  # b is now the oldest
+    items.put('c', 3)
+    assert items.get('b') is None
+    assert (items.get('a'), items.get('c'), len(items)) == (1, 3, 2)
+
+
+def test_fetch_restores_stored_outputs(tmp_path):
+    cache = OutputCache(str(tmp_path / 'cache'))
+    cache.store('k' * 64, {'pdf': make_output(tmp_path / 'a.pdf')}, {'tool': 'pandoc'})
+    dest = tmp_path / 'out' / 'b.pdf'
+    assert cache.fetch('k' * 64, {'pdf': str(dest)})['tool'] == 'pandoc'
+    assert dest.read_bytes() == b'x' * 1000
+    # A role that was never stored is a miss
+    assert cache.fetch('k' * 64, {'pdf': str(dest), 'html': str(tmp_path / 'b.html')}) is None
+
+
+def test_eviction_removes_least_recently_used_entries(tmp_path):
+    cache = OutputCache(str(tmp_path / 'cache'), max_bytes=2500)
+    keys = [c * 64 for c in 'abc']
+    cache.store(keys[0], {'pdf': make_output(tmp_path / 'a.pdf')})
+    cache.store(keys[1], {'pdf': make_output(tmp_path / 'b.pdf')})
+    age(cache, keys[0], 200)
+    age(cache, keys[1], 100)
+    # Using the oldest entry makes the other one the eviction candidate
+    assert cache.fetch(keys[0], {'pdf': str(tmp_path / 'restored.pdf')}) is not None
+    cache.store(keys[2], {'pdf': make_output(tmp_path / 'c.pdf')})
+    assert os.path.exists(cache._entry_dir(keys[0]))
+    assert not os.path.exists(cache._entry_dir(keys[1]))
+    assert os.path.exists(cache._entry_dir(keys[2]))
+
+
+def test_stores_trust_the_size_estimate(tmp_path):
+    cache = OutputCache(str(tmp_path / 'cache'), max_bytes=2500)
+    cache.store('a' * 64, {'pdf': make_output(tmp_path / 'a.pdf')})
+    with open(os.path.join(cache.objects_dir, USAGE_FILE)) as f:
+        assert json.load(f)['bytes'] > 1000
+    # While the estimate says the cache fits, it is not walked
+    with open(os.path.join(cache.objects_dir, USAGE_FILE), 'w') as f:
+        json.dump({'bytes': 0}, f)
+    cache.store('b' * 64, {'pdf': make_output(tmp_path / 'b.pdf')})
+    cache.store('c' * 64, {'pdf': make_output(tmp_path / 'c.pdf', 400)})
+    assert all(os.path.exists(cache._entry_dir(c * 64)) for c in 'abc')
+    # Once it does not, the walk evicts and corrects it
+    cache.store('d' * 64, {'pdf': make_output(tmp_path / 'd.pdf')})
+    with open(os.path.join(cache.objects_dir, USAGE_FILE)) as f:
+        assert json.load(f)['bytes'] <= 2500 * 0.9
+
+
+@pytest.mark.skipif(not hasattr(os, 'link'), reason='needs hardlinks')
+def test_release_output_detaches_a_hardlinked_output(tmp_path):
+    cache = OutputCache(str(tmp_path / 'cache'))
+    cache.store('k' * 64, {'pdf': make_output(tmp_path / 'a.pdf')})
+    dest = tmp_path / 'b.pdf'
+    cache.fetch('k' * 64, {'pdf': str(dest)})
+    if os.stat(dest).st_nlink < 2:
+        pytest.skip('the file system does not support hardlinks')
+    release_output(str(dest))
+    assert not dest.exists()
+    dest.write_bytes(b'rewritten')
+    assert cache.fetch('k' * 64, {'pdf': str(tmp_path / 'c.pdf')}) is not None
+    assert (tmp_path / 'c.pdf').read_bytes() == b'x' * 1000
+
+
+@pytest.mark.skipif(not hasattr(os, 'link'), reason='needs hardlinks')
+def test_entry_modified_through_a_hardlink_is_dropped(tmp_path):
+    cache = OutputCache(str(tmp_path / 'cache'))
+    cache.store('k' * 64, {'pdf': make_output(tmp_path / 'a.pdf')})
+    dest = tmp_path / 'b.pdf'
+    cache.fetch('k' * 64, {'pdf': str(dest)})
+    if os.stat(dest).st_nlink < 2:
+        pytest.skip('the file system does not support hardlinks')
+    # A tool writing in place without release_output changes the cached copy too
+    with open(dest, 'ab') as f:
+        f.write(b'more')
+    assert cache.fetch('k' * 64, {'pdf': str(tmp_path / 'c.pdf')}) is None
+    assert not os.path.exists(cache._entry_dir('k' * 64))
+
+
+def test_file_lock_is_exclusive(tmp_path):
+    path = str(tmp_path / 'locks' / 'build.lock')
+    first = FileLock(path)
+    assert first.acquire()
+    second = FileLock(path)
+    assert not second.acquire(blocking=False)
+    first.release()
+    assert second.acquire(blocking=False)
+    second.release()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from chunked import split_sections, group_sections, cross_chunk_reference
+
+
+def test_no_headings_is_one_section():
+    assert split_sections('just text\n\nmore\n') == ['just text\n\nmore\n']
+
+
+def test_splits_at_top_level_headings():
+    text = '# A\na\n## A.1\nx\n# B\nb\n'
+    assert split_sections(text) == ['# A\na\n## A.1\nx\n', '# B\nb\n']
+
+
+def test_top_level_is_the_highest_level_present():
+    text = '## A\na\n### A.1\n## B\nb\n'
+    assert split_sections(text) == ['## A\na\n### A.1\n', '## B\nb\n']
+
+
+def test_text_before_first_heading_is_its_own_section():
+    assert split_sections('intro\n# A\na\n') == ['intro\n', '# A\na\n']
+
+
+@pytest.mark.parametrize('fence', ['```', '~~~', '````'])
+def test_hash_in_fenced_code_is_not_a_heading(fence):
+    text = f'# A\n{fence}\n# not a heading\n{fence}\n# B\n'
+    assert split_sections(text) == [f'# A\n{fence}\n# not a heading\n{fence}\n', '# B\n']
+
+
+def test_shorter_fence_does_not_close_longer_one():
+    text = '# A\n````\n```\n# inside\n````\n# B\n'
+    assert split_sections(text) == ['# A\n````\n```\n# inside\n````\n', '# B\n']
+
+
+def test_heading_needs_a_space():
+    assert split_sections('# A\n#hashtag\n') == ['# A\n#hashtag\n']
+
+
+def test_sections_round_trip():
+    text = 'pre\n# A\n```\n# x\n```\n# B\n\n## C\n'
+    assert ''.join(split_sections(text)) == text
+
+
+def test_group_sections_keeps_order_and_count():
+    sections = [f'# {i}\n' + 'x' * (i * 10) + '\n' for i in range(10)]
+    chunks = group_sections(sections, 3)
+    assert len(chunks) == 3
+    assert ''.join(chunks) == ''.join(sections)
+
+
+def test_group_sections_with_more_chunks_than_sections():
+    assert group_sections(['a', 'b'], 5) == ['a', 'b']
+
+
+def test_cross_chunk_reference_definition():
+    assert cross_chunk_reference(['see [doc]\n', '[doc]: http://x\n']) is not None
+    assert cross_chunk_reference(['see [doc]\n\n[doc]: http://x\n', 'other\n']) is None
+
+
+def test_cross_chunk_anchor_link():
+    assert cross_chunk_reference(['[go](#target)\n', '<a id="target"></a>\n']) is not None
+    assert cross_chunk_reference(['[go](#target)\n<a id="target"></a>\n', 'b\n']) is None
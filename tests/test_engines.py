@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+
+import pytest
+
+import engines
+from engines import Engine, EngineSelector, TimingHistory
+
+
+class CrashingEngine(Engine):
+    """Dies without reporting, like a worker killed by the OOM killer"""
+    name = 'crashing'
+
+    def unavailable(self):
+        return None
+
+    def estimate(self, features):
+        return 1.0
+
+    def convert(self, input_file, output_file, options):
+        os._exit(9)
+
+
+class SlowEngine(CrashingEngine):
+    name = 'slow'
+
+    def convert(self, input_file, output_file, options):
+        time.sleep(0.5)
+        with open(output_file, 'w') as f:
+            f.write('pdf')
+        return True
+
+
+class PdfOnlyEngine(SlowEngine):
+    name = 'pdf-only'
+
+    def unsupported(self, features, options):
+        return "only writes PDF" if options.get('formats', ('pdf',)) != ('pdf',) else None
+
+
+@pytest.fixture
+def selector(tmp_path, monkeypatch):
+    monkeypatch.setattr(engines, 'ENGINES', {})
+    monkeypatch.setattr(engines, '_selector', None)
+    selector = EngineSelector(engines.ENGINES, TimingHistory(str(tmp_path / 'engines.json')))
+    monkeypatch.setattr(engines, '_selector', selector)
+    (tmp_path / 'a.md').write_text('# A\n')
+    return selector
+
+
+def register(*classes):
+    for cls in classes:
+        engines.ENGINES[cls.name] = cls()
+    return list(engines.ENGINES.values())
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='race workers inherit the test engines by fork')
+def test_race_survives_crashed_engine(selector, tmp_path):
+    candidates = register(CrashingEngine, SlowEngine)
+    md = str(tmp_path / 'a.md')
+    output = tmp_path / 'a.pdf'
+    assert selector.race(candidates, md, str(output), engines.analyze(md), {})
+    assert output.read_text() == 'pdf'
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='race workers inherit the test engines by fork')
+def test_race_returns_when_every_engine_crashed(selector, tmp_path):
+    class OtherCrashingEngine(CrashingEngine):
+        name = 'crashing2'
+
+    candidates = register(CrashingEngine, OtherCrashingEngine)
+    md = str(tmp_path / 'a.md')
+    start = time.monotonic()
+    assert not selector.race(candidates, md, str(tmp_path / 'a.pdf'), engines.analyze(md), {})
+    assert time.monotonic() - start < 10
+
+
+def test_named_engine_checks_support(selector, tmp_path):
+    register(PdfOnlyEngine)
+    md = str(tmp_path / 'a.md')
+    assert not engines.convert_document(md, str(tmp_path / 'a.pdf'), 'pdf-only', {'formats': ('pdf', 'html')})
+    assert not (tmp_path / 'a.pdf').exists()
+    assert engines.convert_document(md, str(tmp_path / 'a.pdf'), 'pdf-only', {'formats': ('pdf',)})
+
+
+def test_engine_must_implement_the_interface():
+    class Incomplete(Engine):
+        name = 'incomplete'
+
+        def unavailable(self):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_weasyprint_passes_optimize_images_through(tmp_path, monkeypatch):
+    calls = []
+    fake = type(sys)('converter')
+    fake.convert_md_to_pdf = lambda *args, **kwargs: calls.append(kwargs) or True
+    monkeypatch.setitem(sys.modules, 'converter', fake)
+    engine = engines.WeasyPrintEngine()
+    md = tmp_path / 'a.md'
+    md.write_text('# A\n')
+    options = {'optimize_images': False}
+    assert engine.unsupported(engines.analyze(str(md)), options) is None
+    assert engine.convert(str(md), str(tmp_path / 'a.pdf'), options)
+    assert calls[0]['optimize_images'] is False
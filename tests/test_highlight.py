@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+pytest.importorskip('pygments')
+
+import highlight
+from highlight import Highlighter
+
+
+def code_block(classes, attrs=(), code='x = 1\n'):
+    return {'t': 'CodeBlock', 'c': [['', list(classes), [list(attr) for attr in attrs]], code]}
+
+
+def rewrite(tmp_path, *blocks):
+    ast_file = tmp_path / 'in.json'
+    ast_file.write_text(json.dumps({'blocks': list(blocks)}), encoding='utf-8')
+    output = tmp_path / 'out.json'
+    replaced = Highlighter(cache_dir=str(tmp_path / 'cache')).rewrite_ast(str(ast_file), str(output))
+    return replaced, json.loads(output.read_text(encoding='utf-8'))['blocks'] if replaced else None
+
+
+def test_first_known_language_class_is_used(tmp_path):
+    replaced, blocks = rewrite(tmp_path, code_block(['example', 'python']))
+    assert replaced == 1
+    assert blocks[0]['t'] == 'RawBlock' and 'Verbatim' in blocks[0]['c'][1]
+
+
+def test_blocks_with_line_numbers_are_left_to_pandoc(tmp_path):
+    replaced, blocks = rewrite(tmp_path,
+                               code_block(['python', 'numberLines']),
+                               code_block(['python'], [('startFrom', '10')]),
+                               code_block(['python']))
+    assert replaced == 1
+    assert [block['t'] for block in blocks] == ['CodeBlock', 'CodeBlock', 'RawBlock']
+
+
+def test_unknown_language_is_kept(tmp_path):
+    assert rewrite(tmp_path, code_block(['no-such-language']))[0] == 0
+
+
+def test_memory_cache_is_bounded_and_counts(tmp_path, monkeypatch):
+    monkeypatch.setattr(highlight, 'MEMORY_ENTRIES', 2)
+    highlighter = Highlighter(cache_dir=str(tmp_path / 'cache'), workers=1)
+    blocks = [('python', f'x = {i}\n') for i in range(3)]
+    highlighter.highlight_many(blocks)
+    assert len(highlighter._memory) == 2
+    assert (highlighter.hits, highlighter.misses) == (0, 3)
+    # The evicted block comes back from disk
+    highlighter.highlight_many(blocks[:1])
+    assert (highlighter.hits, highlighter.misses) == (1, 3)
+
+
+def test_failed_blocks_are_not_cached(tmp_path, monkeypatch):
+    highlighter = Highlighter(cache_dir=str(tmp_path / 'cache'), workers=1)
+
+    def fail(*args):
+        raise ValueError('lexer crashed')
+
+    monkeypatch.setattr(highlight, '_format', fail)
+    assert highlighter.highlight_many([('python', 'x\n')]) == [None]
+    assert len(highlighter._memory) == 0
+    assert not (tmp_path / 'cache').exists()
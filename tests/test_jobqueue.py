@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from jobqueue import JobQueue, QueueFull, QueueLocked, percentile
+
+
+def make_queue(tmp_path, convert=None, **kwargs):
+    return JobQueue(convert or (lambda *args: True), path=str(tmp_path / 'queue.sqlite'), **kwargs)
+
+
+def test_interactive_jobs_are_ahead_of_batch_jobs(tmp_path):
+    queue = make_queue(tmp_path)
+    first_batch = queue.submit('a.md', 'a.pdf', 'batch')
+    second_batch = queue.submit('b.md', 'b.pdf', 'batch')
+    interactive = queue.submit('c.md', 'c.pdf', 'interactive')
+    assert queue.status(interactive)['position'] == 1
+    assert queue.status(first_batch)['position'] == 2
+    assert queue.status(second_batch)['position'] == 3
+    queue.stop()
+
+
+def test_workers_run_jobs_in_priority_order(tmp_path):
+    order = []
+    done = threading.Event()
+
+    def convert(input_file, output_file, engine, options):
+        order.append(os.path.basename(input_file))
+        if len(order) == 3:
+            done.set()
+        return True
+
+    queue = make_queue(tmp_path, convert)
+    queue.submit('a.md', 'a.pdf', 'batch')
+    queue.submit('b.md', 'b.pdf', 'batch')
+    queue.submit('c.md', 'c.pdf', 'interactive')
+    queue.start()
+    assert done.wait(10)
+    queue.stop()
+    assert order == ['c.md', 'a.md', 'b.md']
+
+
+def test_batch_jobs_are_rejected_first(tmp_path):
+    queue = make_queue(tmp_path, max_queued=5)
+    assert queue.limits == {'interactive': 5, 'batch': 4}
+    for i in range(4):
+        queue.submit(f'{i}.md', f'{i}.pdf', 'batch')
+    with pytest.raises(QueueFull):
+        queue.submit('x.md', 'x.pdf', 'batch')
+    # Room is left for interactive work
+    queue.submit('y.md', 'y.pdf', 'interactive')
+    with pytest.raises(QueueFull):
+        queue.submit('z.md', 'z.pdf', 'interactive')
+    assert queue.metrics()['rejected'] == {'interactive': 1, 'batch': 1}
+    queue.stop()
+
+
+def test_unknown_priority(tmp_path):
+    queue = make_queue(tmp_path)
+    with pytest.raises(ValueError):
+        queue.submit('a.md', 'a.pdf', 'urgent')
+    queue.stop()
+
+
+def test_failed_job_state(tmp_path):
+    finished = threading.Event()
+
+    def convert(*args):
+        finished.set()
+        raise RuntimeError('boom')
+
+    queue = make_queue(tmp_path, convert)
+    job = queue.submit('a.md', 'a.pdf')
+    queue.start()
+    assert finished.wait(10)
+    queue.stop(timeout=10)
+    queue = make_queue(tmp_path)
+    status = queue.status(job)
+    assert status['state'] == 'failed' and status['error'] == 'boom'
+    queue.stop()
+
+
+def test_percentile():
+    assert percentile([], 0.5) is None
+    assert percentile([1, 2, 3, 4], 0.5) == 2
+    assert percentile([1, 2, 3, 4], 0.99) == 4
+
+
+def test_queue_file_belongs_to_one_daemon(tmp_path):
+    queue = make_queue(tmp_path)
+    with pytest.raises(QueueLocked):
+        make_queue(tmp_path)
+    queue.stop()
+    make_queue(tmp_path).stop()
+
+
+def test_job_claimed_elsewhere_is_skipped(tmp_path):
+    queue = make_queue(tmp_path)
+    first = queue.submit('a.md', 'a.pdf')
+    second = queue.submit('b.md', 'b.pdf')
+    other = sqlite3.connect(queue.path, isolation_level=None)
+
+    class RacingConnection:
+        """Another connection takes the first job between the SELECT and the UPDATE"""
+        def __init__(self, db):
+            self.db = db
+
+        def execute(self, sql, *args):
+            result = self.db.execute(sql, *args)
+            if sql.startswith('SELECT id, input'):
+                other.execute("UPDATE jobs SET state = 'running' WHERE id = ?", (first,))
+            return result
+
+        def close(self):
+            self.db.close()
+
+    queue._db = RacingConnection(queue._db)
+    assert queue._next_job()[0] == second
+    other.close()
+    queue.stop()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import textwrap
+
+import pytest
+
+import latexbuild
+import toolchain
+from latexbuild import LatexBuilder, FORMAT_RETRY_SECONDS
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='fake tools are shell scripts')
+
+# Writes document.pdf into -output-directory and counts its runs
+FAKE_PDFLATEX = textwrap.dedent('''\
+    #!/bin/sh
+    [ "$1" = "--version" ] && { echo "pdfTeX 3.14"; exit 0; }
+    echo run >> "$FAKE_LATEX_LOG"
+    for a; do
+        case "$a" in -output-directory=*) out="${a#-output-directory=}";; esac
+    done
+    echo pdf > "$out/document.pdf"
+    : > "$out/document.log"
+''')
+
+TEX = '\\documentclass{article}\n\\begin{document}\n\\includegraphics[width=1in]{img.png}\n\\end{document}\n'
+
+
+@pytest.fixture
+def builder(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    for name in ('pdflatex', 'pandoc'):
+        (bin_dir / name).write_text(FAKE_PDFLATEX)
+        (bin_dir / name).chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}")
+    monkeypatch.setenv('MD2PDF_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('FAKE_LATEX_LOG', str(tmp_path / 'runs'))
+    monkeypatch.setattr(toolchain, '_current', None)
+    doc_dir = tmp_path / 'doc'
+    doc_dir.mkdir()
+    (doc_dir / 'img.png').write_bytes(b'image')
+    builder = LatexBuilder(str(tmp_path / 'cache'), use_format=False)
+
+    def compile_once():
+        build_dir = builder.build_dir(str(doc_dir / 'a.md'), str(tmp_path / 'a.pdf'), 'pdflatex')
+        with builder.lock(build_dir):
+            return builder.compile(TEX, str(tmp_path / 'a.pdf'), 'pdflatex', build_dir, str(doc_dir))
+
+    return builder, doc_dir, compile_once
+
+
+def test_unchanged_source_is_not_compiled_again(builder):
+    _, _, compile_once = builder
+    assert compile_once() == 1
+    assert compile_once() == 0
+
+
+def test_changed_image_is_compiled_again(builder):
+    _, doc_dir, compile_once = builder
+    compile_once()
+    image = doc_dir / 'img.png'
+    image.write_bytes(b'another image')
+    st = image.stat()
+    os.utime(image, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert compile_once() == 1
+
+
+def test_prune_keeps_locked_build_dirs(builder, tmp_path):
+    builder, _, compile_once = builder
+    compile_once()
+    build_dir = os.path.join(builder.builds_dir, os.listdir(builder.builds_dir)[0])
+    with builder.lock(build_dir):
+        builder.prune(max_bytes=0)
+        assert os.path.exists(os.path.join(build_dir, 'document.pdf'))
+    builder.prune(max_bytes=0)
+    assert not os.path.exists(build_dir)
+
+
+def test_failed_format_is_retried_after_a_while(tmp_path, monkeypatch):
+    builder = LatexBuilder(str(tmp_path))
+    attempts = []
+
+    def failing_run(engine, args, cwd):
+        attempts.append(args)
+        raise OSError('no mylatexformat')
+
+    monkeypatch.setattr(builder, '_run', failing_run)
+    tex_file = tmp_path / 'doc.tex'
+    tex_file.write_text(TEX, encoding='utf-8')
+    assert builder.format_for('pdflatex', str(tex_file), str(tmp_path)) is None
+    assert builder.format_for('pdflatex', str(tex_file), str(tmp_path)) is None
+    assert len(attempts) == 1
+    marker = next(p for p in os.listdir(builder.formats_dir) if p.endswith('.failed'))
+    old = time.time() - FORMAT_RETRY_SECONDS - 1
+    os.utime(os.path.join(builder.formats_dir, marker), (old, old))
+    assert builder.format_for('pdflatex', str(tex_file), str(tmp_path)) is None
+    assert len(attempts) == 2
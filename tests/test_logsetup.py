@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import logging
+import subprocess
+
+import pytest
+
+import logsetup
+from cache import FileLock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def log_dir(tmp_path):
+    """setup_logging into tmp_path; the root logger's handlers are put back afterwards"""
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    # setup_logging closes the handlers it replaces
+    for handler in handlers:
+        root.removeHandler(handler)
+    yield tmp_path
+    logsetup.shutdown()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def records(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_records_are_json_with_the_job_id(log_dir):
+    path = logsetup.setup_logging(log_dir=str(log_dir), console=False)
+    assert path == str(log_dir / logsetup.LOG_FILE)
+    with logsetup.job_context(7):
+        logging.getLogger('md2pdf').info('converted')
+    logsetup.shutdown()
+    [record] = records(path)
+    assert record['message'] == 'converted' and record['job'] == '7' and record['level'] == 'INFO'
+
+
+def test_long_output_is_spilled(log_dir):
+    path = logsetup.setup_logging(log_dir=str(log_dir), console=False)
+    output = ''.join(f'line {i}\n' for i in range(1000)) + '! LaTeX Error: File `x.sty\' not found.\n'
+    assert len(output) > logsetup.INLINE_OUTPUT_CHARS
+    logger = logging.getLogger('md2pdf')
+    with logsetup.job_context('job-1'):
+        logsetup.log_output(logger, logging.ERROR, 'pdflatex output', output)
+        logsetup.log_output(logger, logging.ERROR, 'pandoc output', 'short')
+    logsetup.shutdown()
+
+    spilled, inline = records(path)
+    spill_file = spilled['spill_file']
+    assert os.path.dirname(spill_file) == str(log_dir / logsetup.SPILL_DIR)
+    assert 'job-1' in os.path.basename(spill_file) and 'pdflatex-output' in spill_file
+    with open(spill_file, encoding='utf-8') as f:
+        assert f.read() == output
+    # The log keeps the tail, where LaTeX reports the error
+    assert 'LaTeX Error' in spilled['message'] and 'line 0\n' not in spilled['message']
+    assert len(spilled['message']) < logsetup.INLINE_OUTPUT_CHARS + 500
+    assert inline['message'] == 'pandoc output: short' and 'spill_file' not in inline
+
+
+def start_logging_child(log_dir):
+    """Another md2pdf process: sets up logging in log_dir, logs, and reports its log file"""
+    code = ('import sys, logging, logsetup; '
+            f'path = logsetup.setup_logging(log_dir={str(log_dir)!r}, console=False); '
+            'logging.getLogger("md2pdf").info("from the child"); '
+            'logsetup.shutdown(); print(path)')
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return result.stdout.strip()
+
+
+def test_second_process_writes_its_own_file(log_dir):
+    path = logsetup.setup_logging(log_dir=str(log_dir), console=False)
+    child_path = start_logging_child(log_dir)
+    assert os.path.dirname(child_path) == str(log_dir / logsetup.PROCESS_LOG_DIR)
+    assert [r['message'] for r in records(child_path)] == ['from the child']
+    # md2pdf.log stays with this process
+    logging.getLogger('md2pdf').info('from the owner')
+    logsetup.shutdown()
+    assert [r['message'] for r in records(path)] == ['from the owner']
+
+
+def test_only_the_owner_rotates(log_dir, monkeypatch):
+    monkeypatch.setattr(logsetup, 'LOG_MAX_BYTES', 200)
+    lock = FileLock(str(log_dir / f'{logsetup.LOG_FILE}.lock'))
+    assert lock.acquire(blocking=False)
+    try:
+        # Another process owns md2pdf.log: this one appends to its own file and never rotates
+        path = logsetup.setup_logging(log_dir=str(log_dir), console=False)
+        for i in range(50):
+            logging.getLogger('md2pdf').info(f'message {i}')
+        logsetup.shutdown()
+    finally:
+        lock.release()
+    assert os.path.basename(path) == f'md2pdf-{os.getpid()}.log'
+    assert len(records(path)) == 50
+    assert not os.path.exists(log_dir / logsetup.LOG_FILE)
+
+    # Once the lock is free this process owns md2pdf.log and rotates it by size
+    path = logsetup.setup_logging(log_dir=str(log_dir), console=False)
+    for i in range(50):
+        logging.getLogger('md2pdf').info(f'message {i}')
+    logsetup.shutdown()
+    assert path == str(log_dir / logsetup.LOG_FILE)
+    assert os.path.exists(f'{path}.1')
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from mathscan import scan_math, restore_math, render_formula, PLACEHOLDER_START
+
+
+def placeholders(text):
+    return text.count(PLACEHOLDER_START)
+
+
+# (Markdown, formulas found)
+CASES = [
+    ('$x$', [('x', False)]),
+    ('a $x^2$ b $y$', [('x^2', False), ('y', False)]),
+    ('$$\\sum_i x_i$$', [('\\sum_i x_i', True)]),
+    ('$$\na = b\n$$', [('a = b', True)]),
+    # Prices are not math: the closing $ may not be followed by a digit
+    ('costs $5 and $10', []),
+    ('$ x$', []),
+    ('$x $', []),
+    ('\\$x$', []),
+    ('a \\$5 and $y$', [('y', False)]),
+    # Inline math does not span lines
+    ('$x\ny$', []),
+    ('`$x$`', []),
+    ('``a ` $x$ ``', []),
+    ('```\n$x$\n```\n$y$', [('y', False)]),
+    ('~~~~\n$$x$$\n~~~\n~~~~\n$y$', [('y', False)]),
+    # An unclosed code span ends at the paragraph, as in Markdown
+    ('use ` tick $x$\n\nlater ` tick', [('x', False)]),
+    ('use ` tick\n$x$ and ` here', []),
+    # $$ is not closed inside a later fence or paragraph
+    ('$$a\n```\n$$\n```', []),
+    ('$$a\n\nb$$', []),
+    # Links and images are kept as written
+    ('![a $x$](i.png) $y$', [('y', False)]),
+    ('[see $x$](http://e.com/$y$)', []),
+    ('[![a $x$](i.png)](u) $z$', [('z', False)]),
+    ('[ref][$x$] $z$', [('z', False)]),
+    # Plain brackets are not links
+    ('[$x$]', [('x', False)]),
+    ('[a $x$ [b]', [('x', False)]),
+]
+
+
+@pytest.mark.parametrize('text, expected', CASES)
+def test_scan_math(text, expected):
+    scanned, formulas = scan_math(text)
+    assert formulas == expected
+    assert placeholders(scanned) == len(expected)
+
+
+def test_escaped_dollar_becomes_plain_dollar():
+    scanned, formulas = scan_math('a \\$5')
+    assert scanned == 'a $5'
+    assert formulas == []
+
+
+def test_restore_round_trip():
+    scanned, formulas = scan_math('a $x<1$ b\n\n$$y$$')
+    html = f"<p>{scanned.split(chr(10))[0]}</p>\n<p>{scanned.split(chr(10))[-1]}</p>"
+    restored = restore_math(html, formulas)
+    assert '<span class="math inline">x&lt;1</span>' in restored
+    # A display formula alone in a paragraph loses its <p>
+    assert '<div class="math">y</div>' in restored and '<p><div' not in restored
+
+
+def test_render_formula_escapes():
+    assert render_formula('a<b', False) == '<span class="math inline">a&lt;b</span>'
+
+
+def test_unclosed_runs_stay_linear():
+    # Many unclosed openers must not rescan the rest of the document each time
+    text = '$$ a ' + ('[ ``` ' * 50000) + '\n\n$x$'
+    start = time.perf_counter()
+    scanned, formulas = scan_math(text)
+    assert formulas == [('x', False)]
+    assert time.perf_counter() - start < 1.0
+
+
+def test_escaped_bracket_is_not_a_link():
+    assert scan_math('\\[a $x$](u)')[1] == [('x', False)]
+
+
+def test_link_does_not_span_paragraphs():
+    assert scan_math('[a\n\n$x$](u)')[1] == [('x', False)]
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import textwrap
+
+import pytest
+
+import md2pdf
+import toolchain
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='fake tools are shell scripts')
+
+# Writes the -o target (an empty AST for JSON); fails for the suffixes in FAKE_PANDOC_FAIL
+FAKE_PANDOC = textwrap.dedent('''\
+    #!/bin/sh
+    case "$1" in
+    --version) echo "pandoc 3.8"; exit 0;;
+    --help) echo "  --syntax-highlighting=STYLE  --pdf-engine=PROGRAM"; exit 0;;
+    esac
+    for a; do
+        if [ "$prev" = "-o" ]; then out="$a"; fi
+        prev="$a"
+    done
+    echo "${out##*.}" >> "$FAKE_PANDOC_LOG"
+    case ",$FAKE_PANDOC_FAIL," in *",${out##*.},"*) echo "failed" >&2; exit 43;; esac
+    case "$out" in
+    *.json) echo '{"pandoc-api-version":[1,23],"meta":{},"blocks":[]}' > "$out";;
+    *) echo "output" > "$out";;
+    esac
+''')
+
+
+@pytest.fixture
+def fake_tools(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    for name, script in (('pandoc', FAKE_PANDOC), ('pdflatex', '#!/bin/sh\necho "pdfTeX 3.14"\n')):
+        path = bin_dir / name
+        path.write_text(script)
+        path.chmod(0o755)
+    log = tmp_path / 'calls'
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}")
+    monkeypatch.setenv('MD2PDF_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('FAKE_PANDOC_LOG', str(log))
+    monkeypatch.setattr(toolchain, '_current', None)
+    doc = tmp_path / 'doc.md'
+    doc.write_text('# Title\n\n$x$\n', encoding='utf-8')
+
+    def calls():
+        return log.read_text().split() if log.exists() else []
+    return tmp_path, str(doc), calls
+
+
+def convert(doc, out, **kwargs):
+    return md2pdf.convert_md_to_pdf(doc, str(out), use_cache=False, optimize_images=False, **kwargs)
+
+
+def test_pdf_only(fake_tools):
+    tmp_path, doc, calls = fake_tools
+    assert convert(doc, tmp_path / 'out.pdf')
+    assert (tmp_path / 'out.pdf').exists()
+    assert not (tmp_path / 'out.html').exists()
+    # Parsed once, then written
+    assert calls() == ['json', 'pdf']
+
+
+def test_several_formats_from_one_parse(fake_tools):
+    tmp_path, doc, calls = fake_tools
+    assert convert(doc, tmp_path / 'out.pdf', formats=('pdf', 'docx', 'epub'))
+    for ext in ('pdf', 'docx', 'epub'):
+        assert (tmp_path / f'out.{ext}').exists()
+    assert calls().count('json') == 1
+    assert sorted(calls()) == ['docx', 'epub', 'json', 'pdf']
+
+
+def test_html_fallback_when_pdf_fails(fake_tools, monkeypatch):
+    tmp_path, doc, calls = fake_tools
+    monkeypatch.setenv('FAKE_PANDOC_FAIL', 'pdf')
+    assert convert(doc, tmp_path / 'out.pdf')
+    assert not (tmp_path / 'out.pdf').exists()
+    assert (tmp_path / 'out.html').exists()
+
+
+def test_no_fallback_when_html_was_requested(fake_tools, monkeypatch):
+    tmp_path, doc, calls = fake_tools
+    monkeypatch.setenv('FAKE_PANDOC_FAIL', 'pdf')
+    assert convert(doc, tmp_path / 'out.pdf', formats=('pdf', 'html'))
+    assert calls().count('html') == 1
+
+
+def test_fails_when_fallback_fails_too(fake_tools, monkeypatch):
+    tmp_path, doc, calls = fake_tools
+    monkeypatch.setenv('FAKE_PANDOC_FAIL', 'pdf,html')
+    assert not convert(doc, tmp_path / 'out.pdf')
+
+
+def test_failed_extra_format_fails_the_conversion(fake_tools, monkeypatch):
+    tmp_path, doc, calls = fake_tools
+    monkeypatch.setenv('FAKE_PANDOC_FAIL', 'docx')
+    assert not convert(doc, tmp_path / 'out.pdf', formats=('pdf', 'docx'))
+    assert (tmp_path / 'out.pdf').exists()
+
+
+def test_cache_key_ignores_format_order(fake_tools):
+    tmp_path, doc, calls = fake_tools
+    assert md2pdf.convert_md_to_pdf(doc, str(tmp_path / 'a.pdf'), formats=('pdf', 'docx'), optimize_images=False)
+    runs = len(calls())
+    assert md2pdf.convert_md_to_pdf(doc, str(tmp_path / 'b.pdf'), formats=('docx', 'pdf'), optimize_images=False)
+    assert len(calls()) == runs
+    assert (tmp_path / 'b.pdf').exists() and (tmp_path / 'b.docx').exists()
+
+
+def test_missing_input(fake_tools):
+    tmp_path, doc, calls = fake_tools
+    assert not convert(str(tmp_path / 'missing.md'), tmp_path / 'out.pdf')
+    assert calls() == []
+
+
+@pytest.mark.parametrize('argv', [
+    ['doc.md', '--formats', 'pdf,odt'],
+    ['doc.md', '--formats', ','],
+    ['doc.md', '--server', 'http://127.0.0.1:1', '--formats', 'html'],
+    ['doc.md', '--split', 'pages:0'],
+    ['doc.md', '--pages', '1-2', '--section', 'A'],
+    ['doc.md', '--server', 'http://127.0.0.1:1', '--split', 'headings'],
+    ['doc.md', '--server', 'http://127.0.0.1:1', '--pages', '1-2'],
+    ['doc.md', '--server', 'http://127.0.0.1:1', '--section', 'A'],
+    ['doc.md', '--split', 'headings', '--formats', 'pdf,html'],
+    ['doc.md', '--pages', '1-2', '--formats', 'html'],
+    ['doc.md', '--section', 'A', '--incremental'],
+])
+def test_invalid_option_combinations(argv, tmp_path, monkeypatch):
+    monkeypatch.setenv('MD2PDF_LOG_DIR', str(tmp_path / 'logs'))
+    monkeypatch.setattr(sys, 'argv', ['md2pdf.py'] + argv)
+    with pytest.raises(SystemExit) as exc:
+        md2pdf.main()
+    assert exc.value.code == 2
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import stat
+import socket
+import threading
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    allowed = tmp_path / 'docs'
+    allowed.mkdir()
+    httpd = server.make_server(port=0, queue_path=str(tmp_path / 'queue.sqlite'), allowed_dirs=[str(allowed)],
+                               workers=1, max_body=1024)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", allowed
+    httpd.shutdown()
+    httpd.server_close()
+    httpd.queue.stop(timeout=5)
+
+
+def post_job(address, **job):
+    response, body = server._request(address, 'POST', '/jobs', json.dumps(job).encode('utf-8'))
+    return response.status, json.loads(body.decode('utf-8'))
+
+
+def test_non_loopback_host_is_refused(tmp_path):
+    with pytest.raises(ValueError, match='allow-remote'):
+        server.make_server(host='192.0.2.1', port=0, queue_path=str(tmp_path / 'queue.sqlite'))
+
+
+def test_job_paths_outside_the_allowed_directories(daemon, tmp_path):
+    address, allowed = daemon
+    inside = str(allowed / 'a.md')
+    assert post_job(address, input=str(tmp_path / 'a.md'), output=str(allowed / 'a.pdf'))[0] == 403
+    assert post_job(address, input=inside, output=str(tmp_path / 'a.pdf'))[0] == 403
+    assert post_job(address, input=inside, output=str(allowed / 'a.pdf'),
+                    options={'stylesheets': [str(tmp_path / 'x.css')]})[0] == 403
+    # ../ does not lead out of an allowed directory
+    assert post_job(address, input=inside, output=str(allowed / '..' / 'a.pdf'))[0] == 403
+
+
+def test_base_url_outside_the_allowed_directories(daemon, tmp_path):
+    address, _ = daemon
+    response, _ = server._request(address, 'POST', '/convert', b'# A\n', {'X-Base-URL': str(tmp_path)})
+    assert response.status == 403
+
+
+def test_oversized_body(daemon):
+    address, _ = daemon
+    response, _ = server._request(address, 'POST', '/convert', b'x' * 1025)
+    assert response.status == 413
+
+
+@pytest.mark.parametrize('path', ['/jobs/../../etc/passwd', '/jobs/1/../2', '/jobs/%2e%2e', '/jobs/-1', '/jobs/'])
+def test_job_status_only_takes_job_ids(daemon, path):
+    address, _ = daemon
+    response, _ = server._request(address, 'GET', path)
+    assert response.status == 404
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='needs Unix sockets')
+def test_unix_socket_is_private_and_only_replaces_sockets(tmp_path):
+    path = tmp_path / 'md2pdf.sock'
+    path.write_text('not a socket')
+    with pytest.raises(ValueError, match='not a socket'):
+        server.make_server(socket_path=str(path), queue_path=str(tmp_path / 'queue.sqlite'))
+    assert path.read_text() == 'not a socket'
+
+    path.unlink()
+    for _ in range(2):  # the second start replaces the stale socket
+        httpd = server.make_server(socket_path=str(path), queue_path=str(tmp_path / 'queue.sqlite'))
+        httpd.server_close()
+        httpd.queue.stop()
+        assert stat.S_ISSOCK(os.lstat(path).st_mode)
+        assert stat.S_IMODE(os.lstat(path).st_mode) & 0o077 == 0
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import io
+
+import markdown
+import pytest
+
+from streaming import iter_blocks, iter_html, has_reference_definitions
+
+
+def blocks(text):
+    return list(iter_blocks(io.StringIO(text)))
+
+
+def test_paragraphs_are_separate_blocks():
+    assert blocks('a\n\nb\n') == ['a\n\n', 'b\n']
+
+
+def test_blocks_round_trip():
+    text = '# t\n\npara\n\n```\ncode\n\nmore\n```\n\n- a\n\n- b\n\n<div>\nx\n\ny\n</div>\n\nend\n'
+    assert ''.join(blocks(text)) == text
+
+
+def test_fenced_code_with_blank_lines_stays_together():
+    assert blocks('```\na\n\nb\n```\n\nc\n') == ['```\na\n\nb\n```\n\n', 'c\n']
+
+
+def test_longer_fence_is_not_closed_by_shorter_one():
+    text = '~~~~\na\n~~~\n\nb\n~~~~\n\nc\n'
+    assert blocks(text) == ['~~~~\na\n~~~\n\nb\n~~~~\n\n', 'c\n']
+
+
+def test_list_continuation_is_not_split():
+    assert blocks('- a\n\n- b\n\n  more\n') == ['- a\n\n- b\n\n  more\n']
+
+
+@pytest.mark.parametrize('text', [
+    '<div>\na\n\nb\n</div>\n\n',
+    '<table>\n<tr><td>\n\nx\n</td></tr>\n</table>\n\n',
+    '<div>\n<div>\na\n</div>\n\nb\n</div>\n\n',
+    '<!-- note\n\nstill comment -->\n\n',
+])
+def test_raw_html_block_with_blank_lines_stays_together(text):
+    assert blocks(text + 'after\n') == [text, 'after\n']
+
+
+def test_void_and_inline_html_do_not_open_a_block():
+    assert blocks('<hr>\n\na\n') == ['<hr>\n\n', 'a\n']
+    assert blocks('<span>a\n\nb\n') == ['<span>a\n\n', 'b\n']
+
+
+def test_odd_dollar_count_does_not_swallow_document():
+    # A stray $$ in prose must not glue the rest of the document into one block
+    assert blocks('costs $$ 5\n\na\n\nb\n') == ['costs $$ 5\n\n', 'a\n\n', 'b\n']
+
+
+def test_display_math_in_one_block_is_rendered():
+    md = markdown.Markdown(extensions=['fenced_code'])
+    html = ''.join(iter_html(io.StringIO('$$\nx^2\n$$\n\ntext\n'), md, render=lambda tex, display: f'[{tex}]'))
+    assert '[x^2]' in html and '<p>text</p>' in html
+
+
+def test_streamed_html_matches_single_pass():
+    text = 'a\n\n<div>\nx\n\ny\n</div>\n\n```\nq\n\nr\n```\n\nb\n'
+    md = markdown.Markdown(extensions=['fenced_code'])
+    streamed = ''.join(iter_html(io.StringIO(text), md))
+    md.reset()
+    assert streamed.replace('\n', '') == md.convert(text).replace('\n', '')
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('[a]: http://x\n', True),
+    ('text\n\n   [label]: /path "t"\n', True),
+    ('[link](http://x)\n', False),
+    ('```\n[a]: http://x\n```\n', False),
+    ('    [a]: indented code\n', False),
+])
+def test_has_reference_definitions(text, expected):
+    assert has_reference_definitions(io.StringIO(text)) is expected
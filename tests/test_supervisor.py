@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import errno
+import signal
+import threading
+import subprocess
+
+import pytest
+
+import supervisor
+from supervisor import Supervisor, Limits, JobKilled
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='process groups and rlimits are POSIX')
+
+NO_LIMITS = Limits(wall=None, cpu=None, memory_mb=None)
+# Starts a grandchild in the job's process group and waits for it
+SPAWN_GRANDCHILD = 'sleep 60 & echo $! > "$0"; wait'
+
+
+@pytest.fixture(autouse=True)
+def no_cancel_event(monkeypatch):
+    monkeypatch.setattr(supervisor, '_cancel_event', None)
+
+
+@pytest.fixture(params=['prlimit', 'ulimit'])
+def limit_mode(request, monkeypatch):
+    """Run a test with prlimit(2) and again with the shell wrapper used where it is missing"""
+    if request.param == 'prlimit':
+        if not hasattr(supervisor.resource, 'prlimit'):
+            pytest.skip('no prlimit on this platform')
+    else:
+        monkeypatch.delattr(supervisor.resource, 'prlimit', raising=False)
+    return request.param
+
+
+def gone(pid, timeout=5):
+    """Whether pid exits (or is left a zombie) within timeout"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            os.kill(pid, 0)
+            with open(f'/proc/{pid}/stat') as f:
+                if f.read().rsplit(')', 1)[1].split()[0] == 'Z':
+                    return True
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+        time.sleep(0.05)
+    return False
+
+
+def grandchild_pid(pid_file, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if pid_file.exists() and pid_file.read_text().strip():
+            return int(pid_file.read_text())
+        time.sleep(0.02)
+    raise AssertionError('the job did not start its child')
+
+
+def test_wall_timeout_kills_the_process_group(tmp_path):
+    pid_file = tmp_path / 'pid'
+    start = time.monotonic()
+    with pytest.raises(JobKilled, match='wall time') as excinfo:
+        Supervisor().run(['sh', '-c', SPAWN_GRANDCHILD, str(pid_file)],
+                         limits=Limits(wall=0.5, cpu=None, memory_mb=None))
+    assert time.monotonic() - start < 10
+    assert 'wall time limit' in excinfo.value.reason
+    assert gone(grandchild_pid(pid_file))
+
+
+def test_cancel_kills_the_process_group(tmp_path, monkeypatch):
+    killed = []
+    killpg = os.killpg
+    monkeypatch.setattr(os, 'killpg', lambda pgid, sig: killed.append((pgid, sig)) or killpg(pgid, sig))
+    event = threading.Event()
+    supervisor.set_cancel_event(event)
+    pid_file = tmp_path / 'pid'
+    errors = []
+
+    def run():
+        try:
+            Supervisor().run(['sh', '-c', SPAWN_GRANDCHILD, str(pid_file)], limits=NO_LIMITS)
+        except JobKilled as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    pid = grandchild_pid(pid_file)
+    event.set()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert [e.reason for e in errors] == ['cancelled']
+    assert len(killed) == 1 and killed[0][1] == signal.SIGKILL
+    # The job leads its own group, which holds the grandchild
+    assert os.getpgid(os.getpid()) != killed[0][0]
+    assert gone(pid)
+
+
+def test_cancelled_before_start_does_not_run(tmp_path):
+    event = threading.Event()
+    event.set()
+    supervisor.set_cancel_event(event)
+    with pytest.raises(JobKilled, match='cancelled'):
+        Supervisor().run(['sh', '-c', f'touch {tmp_path}/ran'], limits=NO_LIMITS)
+    assert not (tmp_path / 'ran').exists()
+
+
+def test_limits_are_applied(limit_mode):
+    # The pause leaves time for prlimit, which is applied right after the start
+    result = Supervisor().run(['sh', '-c', 'sleep 0.3; ulimit -St; ulimit -Ht; ulimit -Sd; ulimit -Hd'],
+                              capture_output=True, text=True, limits=Limits(wall=None, cpu=7, memory_mb=512))
+    assert result.stdout.split() == ['7', '12', str(512 * 1024), str(512 * 1024)]
+
+
+def test_cpu_limit_stops_the_job(limit_mode):
+    with pytest.raises(JobKilled, match='CPU time'):
+        Supervisor().run(['sh', '-c', 'sleep 0.3; while :; do :; done'],
+                         limits=Limits(wall=30, cpu=1, memory_mb=None))
+
+
+def test_memory_limit_stops_the_job(limit_mode):
+    allocate = 'import time; time.sleep(0.3); b = bytearray(1024 * 1024 * 1024)'
+    with pytest.raises(JobKilled, match='memory limit'):
+        Supervisor().run([sys.executable, '-c', allocate], capture_output=True, text=True,
+                         limits=Limits(wall=30, cpu=None, memory_mb=256))
+
+
+def counting_job(tmp_path, script):
+    """sh command that counts its runs in tmp_path/runs before running script"""
+    return ['sh', '-c', f'echo run >> "{tmp_path}/runs"; n=$(wc -l < "{tmp_path}/runs"); {script}']
+
+
+def runs(tmp_path):
+    return len((tmp_path / 'runs').read_text().splitlines())
+
+
+def test_transient_failure_is_retried(tmp_path):
+    cmd = counting_job(tmp_path, '[ "$n" -ge 3 ] && exit 0; echo "database is locked" >&2; exit 1')
+    result = Supervisor(retries=2, backoff=0.01).run(cmd, capture_output=True, text=True, limits=NO_LIMITS)
+    assert result.returncode == 0
+    assert runs(tmp_path) == 3
+
+
+def test_retries_are_bounded(tmp_path):
+    cmd = counting_job(tmp_path, 'echo "Text file busy" >&2; exit 1')
+    with pytest.raises(subprocess.CalledProcessError):
+        Supervisor(retries=2, backoff=0.01).run(cmd, check=True, capture_output=True, text=True,
+                                                limits=NO_LIMITS)
+    assert runs(tmp_path) == 3
+
+
+def test_ordinary_failure_is_not_retried(tmp_path):
+    cmd = counting_job(tmp_path, 'echo "! LaTeX Error: File not found." >&2; exit 1')
+    result = Supervisor(retries=2, backoff=0.01).run(cmd, capture_output=True, text=True, limits=NO_LIMITS)
+    assert result.returncode == 1
+    assert runs(tmp_path) == 1
+
+
+def test_only_transient_start_errors_are_retried(monkeypatch):
+    starts = []
+    popen = Supervisor._popen
+
+    def flaky_popen(self, cmd, *args, **kwargs):
+        starts.append(cmd)
+        if starts == [['true']]:
+            raise BlockingIOError(errno.EAGAIN, 'Resource temporarily unavailable')
+        return popen(self, cmd, *args, **kwargs)
+
+    monkeypatch.setattr(Supervisor, '_popen', flaky_popen)
+    assert Supervisor(backoff=0.01).run(['true'], limits=NO_LIMITS).returncode == 0
+    assert len(starts) == 2
+
+    starts.clear()
+    with pytest.raises(FileNotFoundError):
+        Supervisor(backoff=0.01).run(['md2pdf-no-such-tool'], limits=NO_LIMITS)
+    assert len(starts) == 1
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import textwrap
+
+import pytest
+
+import toolchain
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='fake tools are shell scripts')
+
+
+def fake_tool(bin_dir, name, version, exit_code=0):
+    """A tool that logs every start, prints `version` for --version and exits with exit_code otherwise"""
+    path = bin_dir / name
+    old_mtime = path.stat().st_mtime_ns if path.exists() else 0
+    path.write_text(textwrap.dedent(f'''\
+        #!/bin/sh
+        echo "{name} $1" >> "$FAKE_TOOL_LOG"
+        [ "$1" = "--version" ] && {{ echo "{version}"; exit 0; }}
+        [ "$1" = "--help" ] && {{ echo "--highlight-style=STYLE --pdf-engine=PROGRAM"; exit 0; }}
+        exit {exit_code}
+    '''))
+    path.chmod(0o755)
+    # An upgrade within one mtime tick must still change the fingerprint
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, max(stat.st_mtime_ns, old_mtime + 10 ** 9)))
+
+
+@pytest.fixture
+def tools(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    fake_tool(bin_dir, 'pandoc', 'pandoc 3.1')
+    fake_tool(bin_dir, 'xelatex', 'XeTeX 3.14-0.999995')
+    monkeypatch.setenv('PATH', str(bin_dir))
+    monkeypatch.setenv('MD2PDF_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('FAKE_TOOL_LOG', str(tmp_path / 'starts'))
+    monkeypatch.setattr(toolchain, '_current', None)
+
+    def starts():
+        log = tmp_path / 'starts'
+        return log.read_text().splitlines() if log.exists() else []
+
+    return bin_dir, starts
+
+
+def test_probe_is_cached_across_processes(tools, monkeypatch):
+    _, starts = tools
+    first = toolchain.get_toolchain()
+    assert first.version('pandoc') == 'pandoc 3.1'
+    assert first.pdf_engines == ['xelatex']
+    assert first.supports('--highlight-style')
+    probed = len(starts())
+    # A new process only has the cache file
+    monkeypatch.setattr(toolchain, '_current', None)
+    assert toolchain.get_toolchain() == first
+    assert len(starts()) == probed
+
+
+@pytest.mark.parametrize('name, version', [('pandoc', 'pandoc 3.8.1'), ('xelatex', 'XeTeX 3.141592653')])
+def test_upgraded_tool_is_probed_again(tools, monkeypatch, name, version):
+    bin_dir, starts = tools
+    toolchain.get_toolchain()
+    monkeypatch.setattr(toolchain, '_current', None)
+    fake_tool(bin_dir, name, version)
+    assert toolchain.get_toolchain().version(name) == version
+    assert f"{name} --version" in starts()[-5:]
+
+
+def test_installed_engine_is_probed_again(tools):
+    bin_dir, _ = tools
+    assert toolchain.get_toolchain().pdf_engine() == 'xelatex'
+    fake_tool(bin_dir, 'pdflatex', 'pdfTeX 3.14')
+    assert toolchain.get_toolchain().pdf_engine() == 'pdflatex'
+
+
+def test_ordinary_failure_does_not_probe_again(tools):
+    bin_dir, starts = tools
+    fake_tool(bin_dir, 'xelatex', 'XeTeX 3.14-0.999995', exit_code=1)
+    toolchain.get_toolchain()
+    probed = len(starts())
+    with pytest.raises(subprocess.CalledProcessError):
+        toolchain.run_tool(lambda tc: [tc.path('xelatex'), 'doc.tex'])
+    assert starts()[probed:] == ['xelatex doc.tex']
+
+
+def test_failure_after_an_upgrade_reruns_with_the_new_toolchain(tools):
+    bin_dir, starts = tools
+    toolchain.get_toolchain()
+    versions = []
+
+    def build(tc):
+        versions.append(tc.version('xelatex'))
+        if len(versions) == 1:
+            # Upgraded while the job runs; the new version fails as well
+            fake_tool(bin_dir, 'xelatex', 'XeTeX 3.141592653', exit_code=1)
+        return [tc.path('xelatex'), 'doc.tex']
+
+    with pytest.raises(subprocess.CalledProcessError):
+        toolchain.run_tool(build)
+    assert versions == ['XeTeX 3.14-0.999995', 'XeTeX 3.141592653']
+    assert starts().count('xelatex doc.tex') == 2
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+from treebuild import Manifest, _dependencies, _signature, build_tree
+
+
+@pytest.fixture
+def tree(tmp_path):
+    src = tmp_path / 'src'
+    out = tmp_path / 'out'
+    src.mkdir()
+    out.mkdir()
+    (src / 'doc.md').write_text('# Doc\n\n![logo](logo.png)\n', encoding='utf-8')
+    (src / 'logo.png').write_bytes(b'png')
+    (out / 'doc.pdf').write_bytes(b'pdf')
+    manifest = Manifest(str(out), 'options')
+    source = str(src / 'doc.md')
+    manifest.documents['doc.md'] = {'outputs': ['doc.pdf'], 'deps': _dependencies(source, [])}
+    manifest.save()
+    return src, out, source
+
+
+def is_current(out, source, options='options'):
+    manifest = Manifest(str(out), options)
+    return manifest.is_current('doc.md', _signature(source), source), manifest
+
+
+def bump_mtime(path):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def test_unchanged_tree_is_current(tree):
+    _, out, source = tree
+    current, manifest = is_current(out, source)
+    assert current and not manifest.dirty
+
+
+def test_unknown_document_is_not_current(tree):
+    _, out, source = tree
+    assert not Manifest(str(out), 'options').is_current('other.md', _signature(source), source)
+
+
+def test_touched_but_unchanged_file_is_current_and_updated(tree):
+    src, out, source = tree
+    bump_mtime(src / 'logo.png')
+    current, manifest = is_current(out, source)
+    assert current and manifest.dirty
+    # The new stat is recorded, so the next check needs no hashing
+    manifest.save()
+    current, manifest = is_current(out, source)
+    assert current and not manifest.dirty
+
+
+def test_edited_source_is_stale(tree):
+    _, out, source = tree
+    with open(source, 'a', encoding='utf-8') as f:
+        f.write('more\n')
+    assert not is_current(out, source)[0]
+
+
+def test_edited_asset_is_stale(tree):
+    src, out, source = tree
+    (src / 'logo.png').write_bytes(b'a different image')
+    assert not is_current(out, source)[0]
+
+
+def test_deleted_asset_is_stale(tree):
+    src, out, source = tree
+    (src / 'logo.png').unlink()
+    assert not is_current(out, source)[0]
+
+
+def test_missing_output_is_stale(tree):
+    _, out, source = tree
+    (out / 'doc.pdf').unlink()
+    assert not is_current(out, source)[0]
+
+
+def test_changed_options_make_everything_stale(tree):
+    _, out, source = tree
+    current, manifest = is_current(out, source, options='other options')
+    assert not current
+    # The outputs stay known so they can be cleaned up
+    assert manifest.documents['doc.md']['outputs'] == ['doc.pdf']
+
+
+def write_volumes(input_file, output_file, count=2):
+    """Stands in for a --split conversion"""
+    stem = os.path.splitext(output_file)[0]
+    for number in range(1, count + 1):
+        with open(f'{stem}-vol{number:02d}.pdf', 'w') as f:
+            f.write('pdf')
+    return True
+
+
+def write_html_fallback(input_file, output_file):
+    """A PDF that failed over to HTML, which md2pdf reports as success"""
+    with open(os.path.splitext(output_file)[0] + '.html', 'w') as f:
+        f.write('html')
+    return True
+
+
+def test_split_volumes_are_outputs(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'book.md').write_text('# Book\n', encoding='utf-8')
+    out = tmp_path / 'out'
+    assert build_tree(str(src), str(out), write_volumes, workers=1) == (1, 0, 0, 0)
+    assert build_tree(str(src), str(out), write_volumes, workers=1) == (0, 0, 0, 1)
+    (src / 'book.md').unlink()
+    assert build_tree(str(src), str(out), write_volumes, workers=1)[2] == 2
+    assert sorted(os.listdir(out)) == ['.md2pdf-manifest.json']
+
+
+def test_fewer_volumes_remove_the_surplus(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'book.md').write_text('# Book\n', encoding='utf-8')
+    out = tmp_path / 'out'
+    build_tree(str(src), str(out), write_volumes, convert_args=(3,), workers=1)
+    (src / 'book.md').write_text('# Shorter book\n', encoding='utf-8')
+    assert build_tree(str(src), str(out), write_volumes, convert_args=(3,), workers=1) == (1, 0, 0, 0)
+    # Same options, but this build writes two volumes
+    build_tree(str(src), str(out), write_volumes, convert_args=(2,), workers=1)
+    assert sorted(os.listdir(out)) == ['.md2pdf-manifest.json', 'book-vol01.pdf', 'book-vol02.pdf']
+    assert Manifest(str(out), None).documents['book.md']['outputs'] == ['book-vol01.pdf', 'book-vol02.pdf']
+
+
+def test_earlier_pdf_does_not_count_as_built(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'doc.md').write_text('# Doc\n', encoding='utf-8')
+    out = tmp_path / 'out'
+    out.mkdir()
+    (out / 'doc.pdf').write_bytes(b'an earlier build')
+    extensions = ('.pdf', '.html')
+    assert build_tree(str(src), str(out), write_html_fallback, extensions=extensions, workers=1)[:2] == (0, 1)
+    # Failed builds keep their outputs for cleanup and are retried
+    assert (out / 'doc.pdf').exists()
+    assert build_tree(str(src), str(out), write_html_fallback, extensions=extensions, workers=1)[:2] == (0, 1)
+
+
+def test_html_fallback_is_rebuilt_and_cleaned_up(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'doc.md').write_text('# Doc\n', encoding='utf-8')
+    out = tmp_path / 'out'
+    extensions = ('.pdf', '.html')
+    assert build_tree(str(src), str(out), write_html_fallback, extensions=extensions, workers=1)[1] == 1
+    assert build_tree(str(src), str(out), write_html_fallback, extensions=extensions, workers=1)[1] == 1
+    (src / 'doc.md').unlink()
+    build_tree(str(src), str(out), write_html_fallback, extensions=extensions, workers=1)
+    assert not (out / 'doc.html').exists()
+
+
+def test_same_output_from_two_sources(tmp_path, caplog):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'a.md').write_text('# A\n', encoding='utf-8')
+    (src / 'a.markdown').write_text('# A\n', encoding='utf-8')
+    assert build_tree(str(src), str(tmp_path / 'out'), write_volumes, workers=1) == (1, 0, 0, 0)
+    assert 'a.markdown skipped' in caplog.text
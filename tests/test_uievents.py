@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import uievents
+from uievents import UiQueue, LogView
+
+
+class FakeRoot:
+    """Stands in for Tk: after() only records the callback, tick() runs it"""
+
+    def __init__(self):
+        self.pending = []
+
+    def after(self, ms, func):
+        self.pending.append(func)
+
+    def tick(self):
+        pending, self.pending = self.pending, []
+        for func in pending:
+            func()
+
+
+class FakeText:
+    """The part of a Tk Text widget LogView uses; Tk keeps a newline after the last line"""
+
+    def __init__(self):
+        self.content = ''
+
+    def insert(self, index, text):
+        assert index == 'end'
+        self.content += text
+
+    def index(self, index):
+        assert index == 'end-1c'
+        lines = self.content.split('\n')
+        return f'{len(lines)}.{len(lines[-1])}'
+
+    def delete(self, first, last):
+        assert first == '1.0'
+        if last == 'end':
+            self.content = ''
+        else:
+            line = int(last.split('.')[0])
+            self.content = '\n'.join(self.content.split('\n')[line - 1:])
+
+    def see(self, index):
+        pass
+
+    @property
+    def lines(self):
+        return self.content.splitlines()
+
+
+def make_queue():
+    root = FakeRoot()
+    events = UiQueue(root)
+    calls = []
+    events.on('status', lambda text: calls.append(('status', text)), coalesce=True)
+    events.on('progress', lambda done, total: calls.append(('progress', done, total)), coalesce=True)
+    events.on('log', lambda lines: calls.append(('log', lines)))
+    events.start()
+    return root, events, calls
+
+
+def test_coalesced_events_keep_the_latest_value():
+    root, events, calls = make_queue()
+    for i in range(100):
+        events.post('status', f'file {i}')
+        events.post('progress', i, 100)
+    root.tick()
+    assert sorted(calls) == [('progress', 99, 100), ('status', 'file 99')]
+
+
+def test_other_events_are_batched_per_frame():
+    root, events, calls = make_queue()
+    events.post('log', 'a')
+    events.post('log', 'b')
+    events.post('unhandled', 'x')
+    root.tick()
+    events.post('log', 'c')
+    root.tick()
+    assert calls == [('log', ['a', 'b']), ('log', ['c'])]
+
+
+def test_call_runs_after_the_events_posted_before_it():
+    root, events, calls = make_queue()
+    events.post('log', 'before')
+    events.post('status', 'converting')
+    events.call(lambda: calls.append(('call',)))
+    events.post('log', 'after')
+    root.tick()
+    assert calls == [('log', ['before']), ('status', 'converting'), ('call',), ('log', ['after'])]
+
+
+def test_events_from_many_threads():
+    root, events, calls = make_queue()
+    threads = [threading.Thread(target=lambda n=n: [events.post('log', (n, i)) for i in range(200)])
+               for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    while len([line for call in calls for line in call[1]]) < 800:
+        root.tick()
+    lines = [line for call in calls for line in call[1]]
+    # Each thread's lines arrive complete and in order
+    for n in range(4):
+        assert [i for m, i in lines if m == n] == list(range(200))
+
+
+def test_drain_stops_at_the_frame_budget(monkeypatch):
+    root, events, calls = make_queue()
+    events.post('log', 'a')
+    monkeypatch.setattr(uievents, 'FRAME_BUDGET', -1)
+    root.tick()
+    assert calls == [] and len(root.pending) == 1
+    monkeypatch.setattr(uievents, 'FRAME_BUDGET', 0.02)
+    root.tick()
+    assert calls == [('log', ['a'])]
+
+
+def test_stopped_queue_applies_nothing():
+    root, events, calls = make_queue()
+    events.post('log', 'a')
+    events.stop()
+    root.tick()
+    assert calls == [] and root.pending == []
+
+
+def test_log_view_keeps_the_last_lines():
+    text = FakeText()
+    view = LogView(text, max_lines=5)
+    view.append(['1', '2', '3'])
+    assert text.lines == ['1', '2', '3']
+    view.append(['4', '5', '6', '7'])
+    assert text.lines == ['3', '4', '5', '6', '7']
+    view.append([str(i) for i in range(100)])
+    assert text.lines == ['95', '96', '97', '98', '99']
+    view.append([])
+    assert len(text.lines) == 5
+    view.clear()
+    assert text.lines == []
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from volumes import (Split, LINK_SCHEME, parse_split, parse_pages, pack_volumes, link_sections,
+                     _resolve_preview_links, render_preview)
+
+
+@pytest.mark.parametrize('spec, expected', [
+    ('pages:500', Split('pages', 500)),
+    (' Pages:7 ', Split('pages', 7)),
+    ('headings', Split('headings', None)),
+    ('size:50MB', Split('size', 50 * 1024 ** 2)),
+    ('size:1.5g', Split('size', int(1.5 * 1024 ** 3))),
+    ('size:2048', Split('size', 2048)),
+    ('size:10kb', Split('size', 10240)),
+])
+def test_parse_split(spec, expected):
+    assert parse_split(spec) == expected
+
+
+def test_parse_split_passes_split_through():
+    split = Split('pages', 3)
+    assert parse_split(split) is split
+
+
+@pytest.mark.parametrize('spec', ['pages', 'pages:0', 'pages:-1', 'pages:x', 'size:0', 'size:5TB',
+                                  'headings:2', 'chapters', ''])
+def test_parse_split_rejects(spec):
+    with pytest.raises(ValueError):
+        parse_split(spec)
+
+
+@pytest.mark.parametrize('spec, expected', [('15', (15, 15)), ('10-20', (10, 20)), ('10-', (10, None))])
+def test_parse_pages(spec, expected):
+    assert parse_pages(spec) == expected
+
+
+def test_pack_by_pages_splits_long_sections_at_page_boundaries():
+    volumes = pack_volumes([3, 5, 2], [0, 0, 0], Split('pages', 4))
+    assert volumes == [
+        [(0, 0, 3), (1, 0, 1)],
+        [(1, 1, 5)],
+        [(2, 0, 2)],
+    ]
+    # Every page of every section lands in exactly one volume
+    for pages, index in ((3, 0), (5, 1), (2, 2)):
+        covered = [p for volume in volumes for i, a, b in volume if i == index for p in range(a, b)]
+        assert covered == list(range(pages))
+
+
+def test_pack_by_size_keeps_sections_whole():
+    volumes = pack_volumes([1, 1, 1, 1], [40, 40, 40, 10], Split('size', 100))
+    assert volumes == [[(0, 0, 1), (1, 0, 1)], [(2, 0, 1), (3, 0, 1)]]
+
+
+def test_pack_by_size_oversized_section_gets_own_volume():
+    volumes = pack_volumes([2, 9, 1], [10, 500, 10], Split('size', 100))
+    assert volumes == [[(0, 0, 2)], [(1, 0, 9)], [(2, 0, 1)]]
+
+
+def test_pack_by_headings_one_volume_per_section():
+    assert pack_volumes([2, 3], [1, 1], Split('headings', None)) == [[(0, 0, 2)], [(1, 0, 3)]]
+
+
+def test_link_sections_rewrites_links_to_other_sections():
+    sections = ['# A\n<a id="a1"></a>\n[to b](#b1) [to a](#a1)\n', '# B\n<a id="b1"></a>\n']
+    linked, owners = link_sections(sections)
+    assert owners == {'a1': 0, 'b1': 1}
+    assert f'[to b]({LINK_SCHEME}:1#b1)' in linked[0]
+    assert '[to a](#a1)' in linked[0]
+
+
+def test_preview_links_jump_inside_the_preview_or_are_dropped(tmp_path):
+    pypdf = pytest.importorskip('pypdf')
+    from pypdf.annotations import Link
+
+    writer = pypdf.PdfWriter()
+    writer.add_blank_page(200, 200)
+    writer.add_named_destination('inside', 0)
+    for target in ('inside', 'outside'):
+        link = Link(rect=(0, 0, 10, 10), url=f'{LINK_SCHEME}:1#{target}')
+        writer.add_annotation(0, link)
+    writer.add_annotation(0, Link(rect=(0, 0, 10, 10), url='https://example.com/'))
+    pdf_file = str(tmp_path / 'preview.pdf')
+    with open(pdf_file, 'wb') as f:
+        writer.write(f)
+
+    assert _resolve_preview_links(pdf_file) == 1
+    actions = [annotation.get_object()['/A'] for annotation in pypdf.PdfReader(pdf_file).pages[0]['/Annots']]
+    assert [action['/S'] for action in actions] == ['/GoTo', '/URI']
+    assert actions[0]['/D'] == 'inside'
+
+
+class FakeDocument:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def copy(self, pages):
+        return FakeDocument(pages)
+
+    def write_pdf(self, target):
+        import pypdf
+        writer = pypdf.PdfWriter()
+        for _ in self.pages:
+            writer.add_blank_page(200, 200)
+        with open(target, 'wb') as f:
+            writer.write(f)
+
+
+class FakeSession:
+    """One page per section; remembers what it laid out"""
+    style_key = 'style'
+
+    def __init__(self):
+        self.rendered = []
+
+    def render(self, md_text, base_url=None, charset=None):
+        self.rendered.append(md_text)
+        return FakeDocument([object()])
+
+
+def test_preview_page_index_follows_link_targets(tmp_path, monkeypatch):
+    pytest.importorskip('pypdf')
+    session = FakeSession()
+    fake = type(sys)('converter')
+    fake.RENDER_VERSION = '1'
+    fake.get_session = lambda *args, **kwargs: session
+    fake.get_renderer = lambda: SimpleNamespace(backend='backend')
+    fake.get_highlighter = lambda: SimpleNamespace(fingerprint=lambda: 'highlight')
+    monkeypatch.setitem(sys.modules, 'converter', fake)
+    monkeypatch.setenv('MD2PDF_CACHE_DIR', str(tmp_path / 'cache'))
+
+    a = '# A\n[to b](#b1)\n'
+    b = '# B\n<a id="b1"></a>\n'
+    render_preview(a + b, str(tmp_path / 'v1.pdf'), None, pages='1-2')
+    # A section inserted before B changes where A's link points, not A's source text
+    session.rendered.clear()
+    render_preview(a + '# X\n' + b, str(tmp_path / 'v2.pdf'), None, pages='3-3')
+    assert session.rendered[0] == f'# A\n[to b]({LINK_SCHEME}:2#b1)\n'
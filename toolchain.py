@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cached toolchain discovery
+Resolves the paths, versions and capabilities of pandoc and the LaTeX engines
+once and stores the result in the cache directory. The stored probe is reused
+as long as PATH and the size/mtime of every binary are unchanged, so normal
+startup never spawns `pandoc --version` or `xelatex --version`. When a tool
+cannot be started, or a conversion fails after a binary changed on disk, the
+toolchain is probed again (see run_tool).
+"""
+
+import os
+import json
+import shutil
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import default_cache_dir, make_key, tool_fingerprint
+from supervisor import get_supervisor
+
+logger = logging.getLogger(__name__)
+
+PDF_ENGINES = ('pdflatex', 'xelatex', 'lualatex')
+TOOLS = ('pandoc',) + PDF_ENGINES
+
+# Bump when the probe or the stored format changes
+PROBE_VERSION = '1'
+PROBE_TIMEOUT = 60
+CACHE_FILE = 'toolchain.json'
+
+_lock = threading.Lock()
+_current = None
+
+
+def discovery_key():
+    """Key of the current environment; computed from PATH and stat() only"""
+    return make_key(
+        PROBE_VERSION,
+        os.environ.get('PATH', ''),
+        *(tool_fingerprint(name) for name in TOOLS)
+    )
+
+
+class Toolchain:
+    """Result of one probe: tool paths, versions and pandoc capabilities"""
+
+    def __init__(self, key, tools, pandoc_options=()):
+        self.key = key
+        # name -> {'path': ..., 'version': ...}; missing tools are absent
+        self.tools = tools
+        self.pandoc_options = set(pandoc_options)
+
+    def __eq__(self, other):
+        return isinstance(other, Toolchain) and self.to_dict() == other.to_dict()
+
+    def has(self, name):
+        return name in self.tools
+
+    def path(self, name):
+        """Resolved path, or the bare name (so running a missing tool raises FileNotFoundError)"""
+        return self.tools.get(name, {}).get('path') or name
+
+    def version(self, name):
+        return self.tools.get(name, {}).get('version') or 'version information not available'
+
+    @property
+    def pdf_engines(self):
+        return [name for name in PDF_ENGINES if name in self.tools]
+
+    def pdf_engine(self, preferred='pdflatex'):
+        """The preferred LaTeX engine if installed, else any installed one (None if none)"""
+        if preferred in self.tools:
+            return preferred
+        engines = self.pdf_engines
+        return engines[0] if engines else None
+
+    def supports(self, option):
+        return option in self.pandoc_options
+
+    def highlight_option(self, style='default'):
+        """Syntax highlighting option for this pandoc version.
+
+        pandoc 3.8 replaced --highlight-style with --syntax-highlighting.
+        """
+        if self.supports('--syntax-highlighting') or not self.supports('--highlight-style'):
+            return f'--syntax-highlighting={style}'
+        return f"--highlight-style={'pygments' if style == 'default' else style}"
+
+    def to_dict(self):
+        return {'key': self.key, 'tools': self.tools, 'pandoc_options': sorted(self.pandoc_options)}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['key'], data['tools'], data.get('pandoc_options', ()))
+
+
+def _run(cmd):
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8',
+                            errors='replace', timeout=PROBE_TIMEOUT)
+    return result.stdout if result.returncode == 0 else None
+
+
+def _probe_tool(name):
+    path = shutil.which(name)
+    if path is None:
+        return name, None
+    try:
+        output = _run([path, '--version'])
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.debug(f"Probing {name} failed: {e}")
+        return name, None
+    if output is None:
+        return name, None
+    lines = output.strip().splitlines()
+    return name, {'path': path, 'version': lines[0].strip() if lines else ''}
+
+
+def _probe_pandoc_options(path):
+    try:
+        output = _run([path, '--help'])
+    except (OSError, subprocess.SubprocessError):
+        return set()
+    options = set()
+    for word in (output or '').split():
+        if word.startswith('--'):
+            options.add(word.split('=')[0].split('[')[0])
+    return options
+
+
+def probe():
+    """Spawn every tool once (concurrently) and return a fresh Toolchain"""
+    key = discovery_key()
+    with ThreadPoolExecutor(max_workers=len(TOOLS)) as executor:
+        results = dict(executor.map(_probe_tool, TOOLS))
+    tools = {name: info for name, info in results.items() if info is not None}
+    options = _probe_pandoc_options(tools['pandoc']['path']) if 'pandoc' in tools else set()
+    logger.debug(f"Probed toolchain: {', '.join(sorted(tools)) or 'nothing found'}")
+    return Toolchain(key, tools, options)
+
+
+def _cache_path():
+    return os.path.join(default_cache_dir(), CACHE_FILE)
+
+
+def _load_cached(key):
+    try:
+        with open(_cache_path(), 'r', encoding='utf-8') as f:
+            toolchain = Toolchain.from_dict(json.load(f))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return toolchain if toolchain.key == key else None
+
+
+def _save(toolchain):
+    path = _cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(toolchain.to_dict(), f, indent=1)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.debug(f"Could not store toolchain probe: {e}")
+
+
+def get_toolchain(refresh=False):
+    """The current Toolchain, probing only if nothing valid is cached"""
+    global _current
+    with _lock:
+        key = discovery_key()
+        if not refresh:
+            if _current is not None and _current.key == key:
+                return _current
+            cached = _load_cached(key)
+            if cached is not None:
+                _current = cached
+                return cached
+        _current = probe()
+        _save(_current)
+        return _current
+
+
+def revalidate():
+    """Probe again regardless of the cache (after a failed conversion)"""
+    return get_toolchain(refresh=True)
+
+
+def run_tool(build, **kwargs):
+    """Run the command built by build(toolchain) under the supervisor (check=True).
+
+    The supervisor applies timeouts, resource limits and cancellation, and
+    raises supervisor.JobKilled when it stops the command. The toolchain is
+    probed again only when the tool could not be started (OSError) or when it
+    exited with an error and PATH or a binary's size/mtime no longer match the
+    cached probe; an ordinary failure such as a LaTeX error is raised as is.
+    When the fresh probe differs from the cached one (a tool was upgraded,
+    moved or removed) the command is rebuilt and run once more.
+    """
+    toolchain = get_toolchain()
+    supervisor = get_supervisor()
+    try:
+        return supervisor.run(build(toolchain), check=True, **kwargs)
+    except (subprocess.CalledProcessError, OSError) as e:
+        if isinstance(e, subprocess.CalledProcessError) and discovery_key() == toolchain.key:
+            raise
+        fresh = revalidate()
+        if fresh == toolchain:
+            raise
+        logger.info("Toolchain changed since it was last probed, retrying")
+        return supervisor.run(build(fresh), check=True, **kwargs)
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental build of a documentation tree (md2pdf.py --build)
+Converts every Markdown file under a source directory into a mirrored output
+directory and keeps a manifest of what each output was built from: the
+Markdown file, the local files it references (images, stylesheets, included
+LaTeX) and the conversion options. On the next run only documents with a
+changed dependency are rebuilt, and outputs whose source is gone are deleted.
+
+Dependencies are compared by size and mtime first; only when those differ is
+the content hashed, so touching a file without changing it does not cause a
+rebuild, and an unchanged tree is checked with one stat() per file.
+"""
+
+import os
+import re
+import json
+import logging
+from urllib.parse import urlparse, unquote
+
+from batch import run_batch
+from cache import make_key, file_digest
+from watch import MARKDOWN_SUFFIXES
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = '.md2pdf-manifest.json'
+# Bump when the manifest layout or dependency extraction changes
+MANIFEST_VERSION = 1
+
+_REFERENCE_RES = [
+    re.compile(r'!\[[^\]]*\]\(\s*<?([^)\s>]+)'),                     # ![alt](path)
+    re.compile(r'^\s{0,3}\[[^\]]+\]:\s*<?([^\s>]+)', re.M),           # [ref]: path
+    re.compile(r'<(?:img|link)\b[^>]*?\b(?:src|href)\s*=\s*["\']([^"\']+)', re.I),
+    re.compile(r'\\(?:includegraphics|input|include)\s*(?:\[[^\]]*\])?\{([^}]+)\}'),
+]
+
+
+def find_references(md_file, text):
+    """Local files referenced by a Markdown document (absolute paths, may not exist)"""
+    base = os.path.dirname(md_file)
+    paths = set()
+    for pattern in _REFERENCE_RES:
+        for ref in pattern.findall(text):
+            parsed = urlparse(ref)
+            # Remote URLs, in-page anchors and mailto: are not files
+            if (parsed.scheme and len(parsed.scheme) > 1) or not parsed.path:
+                continue
+            path = unquote(parsed.path)
+            if os.path.splitext(path)[1].lower() in MARKDOWN_SUFFIXES:
+                # Links to other documents do not change this output
+                continue
+            paths.add(os.path.normpath(os.path.join(base, path)))
+    return sorted(paths)
+
+
+def file_references(md_file, block_size=1024 * 1024):
+    """find_references for a file, read in blocks of lines so large documents stay out of memory"""
+    paths = set()
+    with open(md_file, 'r', encoding='utf-8', errors='replace') as f:
+        while True:
+            lines = f.readlines(block_size)
+            if not lines:
+                break
+            paths.update(find_references(md_file, ''.join(lines)))
+    return sorted(paths)
+
+
+def references_key(md_file):
+    """Cache key part for the content of the local files a document references.
+
+    References are recorded as written, with the digest of the file they
+    resolve to, so editing an image or moving the document next to other
+    files changes the key.
+    """
+    base = os.path.dirname(os.path.abspath(md_file))
+    parts = []
+    for path in file_references(os.path.abspath(md_file)):
+        parts += [os.path.relpath(path, base), _digest(path) or 'missing']
+    return make_key('references', *parts)
+
+
+def _signature(path):
+    """(size, mtime_ns) of a file, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _digest(path):
+    try:
+        return file_digest(path)
+    except OSError:
+        return None
+
+
+def scan_sources(src_dir):
+    """{relative path: (size, mtime_ns)} of all Markdown files under src_dir"""
+    sources = {}
+    stack = [src_dir]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in MARKDOWN_SUFFIXES:
+                    st = entry.stat()
+                    sources[os.path.relpath(entry.path, src_dir)] = [st.st_size, st.st_mtime_ns]
+    return sources
+
+
+class Manifest:
+    """What every output was built from; stored as JSON in the output directory"""
+
+    def __init__(self, out_dir, options_key):
+        self.path = os.path.join(out_dir, MANIFEST_FILE)
+        self.options_key = options_key
+        self.documents = {}
+        # Set when entries changed without a rebuild (touched files, removed sources)
+        self.dirty = False
+        # Files shared by many documents (stylesheets, logos) are stat()ed once per run
+        self._signatures = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == MANIFEST_VERSION:
+            self.documents = data.get('documents', {})
+            if data.get('options') != options_key:
+                # Different engine or options: every document is stale, but
+                # the outputs are still known so deleted sources get cleaned up
+                for entry in self.documents.values():
+                    entry['deps'] = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'options': self.options_key,
+                       'documents': self.documents}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def signature(self, path):
+        if path not in self._signatures:
+            self._signatures[path] = _signature(path)
+        return self._signatures[path]
+
+    def is_current(self, rel, source_signature, source_path):
+        """True if none of the recorded dependencies changed.
+
+        A dependency whose size/mtime changed but whose content did not is
+        updated in place (the manifest is then marked dirty).
+        """
+        entry = self.documents.get(rel)
+        if not entry or not entry.get('deps') or not entry['outputs']:
+            return False
+        deps = entry['deps']
+        checks = [(source_path, source_signature)] + [(path, self.signature(path)) for path in deps if path != source_path]
+        for path, signature in checks:
+            recorded = deps.get(path)
+            if recorded is None:
+                return False
+            if recorded['stat'] == signature:
+                continue
+            if signature is None or recorded['sha256'] is None or _digest(path) != recorded['sha256']:
+                return False
+            # Touched but unchanged
+            recorded['stat'] = signature
+            self.dirty = True
+        return all(os.path.exists(os.path.join(os.path.dirname(self.path), output)) for output in entry['outputs'])
+
+
+def _unique_outputs(sources):
+    """Drop sources whose output another source already builds (a.md and a.markdown)
+
+    The .md file wins; the others are reported and left out of the build.
+    """
+    by_stem = {}
+    for rel in sorted(sources):
+        by_stem.setdefault(os.path.splitext(rel)[0], []).append(rel)
+    for stem, rels in by_stem.items():
+        if len(rels) > 1:
+            keep = min(rels, key=lambda rel: (os.path.splitext(rel)[1].lower() != '.md', rel))
+            for rel in rels:
+                if rel != keep:
+                    logger.warning(f"⚠ {rel} skipped: {keep} builds the same output ({stem})")
+                    del sources[rel]
+    return sources
+
+
+def _built_outputs(out_dir, stem, extensions):
+    """Outputs of a document that exist after its build, relative to out_dir
+
+    Volumes written with --split (stem-vol01.pdf, ...) are outputs too.
+    """
+    directory, name = os.path.split(os.path.join(out_dir, stem))
+    pattern = re.compile(re.escape(name) + r'(?:-vol\d+)?(?:' + '|'.join(map(re.escape, extensions)) + ')')
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted(os.path.relpath(os.path.join(directory, entry), out_dir)
+                  for entry in names if pattern.fullmatch(entry))
+
+
+def _set_aside(out_dir, outputs):
+    """Move a document's existing outputs out of the way before it is rebuilt
+
+    Whatever exists after the build was then written by it, so an earlier
+    doc.pdf or surplus volumes cannot pass for the result. Returns
+    {output: hidden path} for _restore and _discard.
+    """
+    moved = {}
+    for output in outputs:
+        path = os.path.join(out_dir, output)
+        hidden = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.md2pdf-previous")
+        try:
+            os.replace(path, hidden)
+        except OSError as e:
+            logger.debug(f"Could not move {output} aside: {e}")
+            continue
+        moved[output] = hidden
+    return moved
+
+
+def _restore(out_dir, moved, outputs):
+    """Put back the earlier outputs the failed build did not write again; returns their names"""
+    restored = []
+    for output, hidden in moved.items():
+        if output in outputs:
+            _discard({output: hidden})
+            continue
+        try:
+            os.replace(hidden, os.path.join(out_dir, output))
+            restored.append(output)
+        except OSError as e:
+            logger.warning(f"⚠ Could not restore {output}: {e}")
+    return restored
+
+
+def _discard(moved):
+    for output, hidden in moved.items():
+        try:
+            os.remove(hidden)
+        except OSError:
+            pass
+
+
+def _dependencies(source_path, shared_deps):
+    """{path: {'stat', 'sha256'}} of a document and everything it references"""
+    deps = {}
+    for path in [source_path] + file_references(source_path) + list(shared_deps):
+        deps[path] = {'stat': _signature(path), 'sha256': _digest(path)}
+    return deps
+
+
+def build_tree(src_dir, out_dir, convert, convert_args=(), extensions=('.pdf',), shared_deps=(),
+               workers=None, on_result=None, cancel=None):
+    """Bring out_dir up to date with the Markdown files under src_dir.
+
+    convert(input_file, output_file, *convert_args) builds one document (a
+    module-level function, as for run_batch) and is passed the .pdf path;
+    `extensions` are the outputs it may write there, the first one being
+    the format a successful build must produce. Whatever of them the build
+    writes (including --split volumes) is recorded and deleted again when
+    the source goes away. Earlier outputs a successful build did not write
+    again are deleted; a failed build puts them back. `shared_deps` are files every document
+    depends on, such as stylesheets.
+    Returns (built, failed, removed, up_to_date) counts.
+    """
+    src_dir = os.path.abspath(src_dir)
+    out_dir = os.path.abspath(out_dir)
+    shared_deps = [os.path.abspath(path) for path in shared_deps]
+    manifest = Manifest(out_dir, make_key(str(MANIFEST_VERSION), convert.__module__, convert.__qualname__,
+                                          repr(tuple(convert_args)), *extensions, *shared_deps))
+    sources = _unique_outputs(scan_sources(src_dir))
+
+    # Sources that disappeared: delete what was built from them
+    removed = 0
+    for rel in sorted(set(manifest.documents) - set(sources)):
+        for output in manifest.documents.pop(rel)['outputs']:
+            path = os.path.join(out_dir, output)
+            try:
+                os.remove(path)
+                removed += 1
+                logger.info(f"Removed {output} (source deleted)")
+            except FileNotFoundError:
+                pass
+            # Drop directories left empty, up to the output directory
+            directory = os.path.dirname(path)
+            while directory != out_dir:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+        manifest.dirty = True
+
+    stale = [rel for rel in sorted(sources)
+             if not manifest.is_current(rel, sources[rel], os.path.join(src_dir, rel))]
+    up_to_date = len(sources) - len(stale)
+    if not stale:
+        if manifest.dirty:
+            manifest.save()
+        logger.info(f"✓ {up_to_date} document(s) up to date")
+        return 0, 0, removed, up_to_date
+
+    # Dependencies are recorded before building, so edits made during the build trigger the next one
+    jobs, pending, previous = [], {}, {}
+    for rel in stale:
+        source_path = os.path.join(src_dir, rel)
+        stem = os.path.splitext(rel)[0]
+        output_file = os.path.join(out_dir, stem + '.pdf')
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        pending[rel] = _dependencies(source_path, shared_deps)
+        previous[rel] = _set_aside(out_dir, _built_outputs(out_dir, stem, extensions))
+        jobs.append((source_path, output_file))
+
+    logger.info(f"Building {len(jobs)} of {len(sources)} document(s) ({up_to_date} up to date)")
+    try:
+        results = run_batch(jobs, convert, args=convert_args, workers=workers, on_result=on_result,
+                            cancel=cancel)
+    except BaseException:
+        for rel in stale:
+            _restore(out_dir, previous[rel], _built_outputs(out_dir, os.path.splitext(rel)[0], extensions))
+        raise
+
+    built = failed = 0
+    for rel, result in zip(stale, results):
+        # Written by this build: the earlier outputs were moved aside
+        outputs = _built_outputs(out_dir, os.path.splitext(rel)[0], extensions)
+        # A PDF that failed over to HTML reports success but is missing its main output
+        if result.success and any(output.endswith(extensions[0]) for output in outputs):
+            _discard(previous[rel])
+            manifest.documents[rel] = {'outputs': outputs, 'deps': pending[rel]}
+            built += 1
+        else:
+            # Keep the earlier outputs, and record them for cleanup, but force a rebuild next time
+            outputs = sorted(set(outputs) | set(_restore(out_dir, previous[rel], outputs)))
+            manifest.documents[rel] = {'outputs': outputs, 'deps': {}}
+            failed += 1
+    manifest.save()
+    logger.info(f"Build finished: {built} built, {failed} failed, {removed} removed, {up_to_date} up to date")
+    return built, failed, removed, up_to_date
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Thread-safe GUI updates for main.py and md2pdf_gui.py
+Tk widgets may only be touched from the thread running mainloop(). Worker
+threads therefore post events to a UiQueue, which the Tk loop drains on a
+timer: all events of one frame are applied together, status and progress
+events only keep their latest value, and log lines are inserted in one go.
+
+    events = UiQueue(root)
+    events.on('status', status_var.set, coalesce=True)
+    events.on('log', log_view.append)          # called with a list of lines
+    events.start()
+    ...
+    events.post('status', 'Converting...')     # from any thread
+    events.call(messagebox.showinfo, 'Done', 'Converted 3 files')
+"""
+
+import time
+import queue
+
+# Delay between two drains of the queue
+FRAME_MS = 50
+# Time a drain may spend before the rest waits for the next frame
+FRAME_BUDGET = 0.02
+
+DEFAULT_LOG_LINES = 2000
+
+
+class UiQueue:
+    """Events from worker threads, applied on the Tk thread once per frame"""
+
+    def __init__(self, root, interval_ms=FRAME_MS):
+        self.root = root
+        self.interval_ms = interval_ms
+        self._events = queue.SimpleQueue()
+        self._handlers = {}
+        self._coalesce = set()
+        self._running = False
+
+    def on(self, kind, handler, coalesce=False):
+        """Handle events of a kind; coalesced kinds only get the last event of a frame,
+        the others get the list of all their events (one argument tuple each, or the
+        single argument when events carry one)"""
+        self._handlers[kind] = handler
+        if coalesce:
+            self._coalesce.add(kind)
+
+    def post(self, kind, *args):
+        """Queue an event; safe from any thread"""
+        self._events.put((kind, args))
+
+    def call(self, func, *args):
+        """Run func(*args) on the Tk thread after the events posted before it"""
+        self._events.put((None, (func, args)))
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self.root.after(self.interval_ms, self._drain)
+
+    def stop(self):
+        self._running = False
+
+    def _drain(self):
+        if not self._running:
+            return
+        try:
+            deadline = time.perf_counter() + FRAME_BUDGET
+            latest, batches = {}, {}
+            while time.perf_counter() < deadline:
+                try:
+                    kind, args = self._events.get_nowait()
+                except queue.Empty:
+                    break
+                if kind is None:
+                    # A call sees the widgets after everything posted before it
+                    self._apply(latest, batches)
+                    latest, batches = {}, {}
+                    func, func_args = args
+                    func(*func_args)
+                elif kind in self._coalesce:
+                    latest[kind] = args
+                else:
+                    batches.setdefault(kind, []).append(args[0] if len(args) == 1 else args)
+            self._apply(latest, batches)
+        finally:
+            self.root.after(self.interval_ms, self._drain)
+
+    def _apply(self, latest, batches):
+        for kind, items in batches.items():
+            handler = self._handlers.get(kind)
+            if handler is not None:
+                handler(items)
+        for kind, args in latest.items():
+            handler = self._handlers.get(kind)
+            if handler is not None:
+                handler(*args)
+
+
+class LogView:
+    """Append-only view on a Text widget that keeps only the last max_lines lines"""
+
+    def __init__(self, text, max_lines=DEFAULT_LOG_LINES):
+        self.text = text
+        self.max_lines = max_lines
+
+    def append(self, lines):
+        lines = [str(line) for line in lines][-self.max_lines:]
+        if not lines:
+            return
+        self.text.insert('end', '\n'.join(lines) + '\n')
+        # The Text widget always ends in an empty line after the last newline
+        count = int(self.text.index('end-1c').split('.')[0]) - 1
+        if count > self.max_lines:
+            self.text.delete('1.0', f'{count - self.max_lines + 1}.0')
+        self.text.see('end')
+
+    def clear(self):
+        self.text.delete('1.0', 'end')
+
+
+class StageProgress:
+    """Progress of one conversion from the profiling stages it has finished
+
+    `plan` maps the stages the conversion is expected to go through to their
+    share of the total time. Register `hook` with profiling.add_hook while
+    tracing; it calls report(fraction, stage) from the converting thread.
+    """
+
+    def __init__(self, plan, report):
+        self.plan = plan
+        self.total = sum(plan.values()) or 1
+        self.report = report
+        self.done = 0
+        self._finished = set()
+
+    def hook(self, record):
+        name = record['name']
+        if name not in self.plan or name in self._finished:
+            return
+        self._finished.add(name)
+        self.done += self.plan[name]
+        self.report(min(1.0, self.done / self.total), name)
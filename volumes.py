@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+超大文档分卷输出和局部预览
+
+分卷：在顶级标题处把Markdown拆成若干节，每节在工作进程中单独排版（单次排版的
+内存只与最大的一节有关），再按页数、文件大小或标题把各节依次装入若干卷：
+
+    manual.pdf  →  manual-vol01.pdf, manual-vol02.pdf, ...
+
+页数超过上限的节在页边界处拆开。跨节的页内链接（`#锚点`，锚点来自Markdown中
+HTML元素的 id/name 属性）在排版前改写为占位链接，写出各卷时再改成PDF动作：
+目标在同一卷时跳转到卷内的命名目标，在其他卷时跳转到那一卷的文件（GoToR），
+所以各卷放在同一目录下时链接仍然有效。
+
+预览：只排版请求的页码范围或某一节。各节的页数记录在缓存目录的页码索引中，
+范围之前、页数已知的节不再排版；范围之后的节从不排版。跨节链接同样先改写为
+占位链接，目标在预览内时改为跳转，否则去掉链接。
+"""
+
+import os
+import re
+import json
+import logging
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import profiling
+from batch import default_workers
+from cache import default_cache_dir, make_key
+from chunked import split_sections, render_chunks, ANCHOR_RE, LOCAL_LINK_RE
+
+logger = logging.getLogger(__name__)
+
+# 分卷方式：pages（每卷最多页数）、size（每卷最大字节数）、headings（每个顶级标题一卷）
+SPLIT_MODES = ('pages', 'size', 'headings')
+Split = namedtuple('Split', ['mode', 'limit'])
+
+# 跨节链接在排版时的占位地址：md2pdf-section:<节序号>#<锚点>
+LINK_SCHEME = 'md2pdf-section'
+
+PAGE_INDEX_FILE = 'page-index.json'
+# 页码索引最多保存的节数，超出时丢弃最早的记录
+PAGE_INDEX_MAX_ENTRIES = 20000
+
+_SIZE_UNITS = {'': 1, 'k': 1024, 'kb': 1024, 'm': 1024 ** 2, 'mb': 1024 ** 2, 'g': 1024 ** 3, 'gb': 1024 ** 3}
+_TITLE_RE = re.compile(r'^#{1,6}[ \t]+(.*?)[ \t#]*$', re.M)
+
+
+def parse_split(spec):
+    """'pages:500'、'size:50MB'、'headings' → Split；格式不对时抛出 ValueError"""
+    if isinstance(spec, Split):
+        return spec
+    mode, _, value = str(spec).strip().lower().partition(':')
+    if mode == 'headings' and not value:
+        return Split('headings', None)
+    if mode == 'pages' and value.isdigit() and int(value) > 0:
+        return Split('pages', int(value))
+    if mode == 'size':
+        match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([kmg]?b?)', value)
+        if match and float(match.group(1)) > 0:
+            return Split('size', int(float(match.group(1)) * _SIZE_UNITS[match.group(2)]))
+    raise ValueError(f"无效的分卷方式 {spec!r}，应为 pages:N、size:N[KB|MB|GB] 或 headings")
+
+
+def parse_pages(spec):
+    """'10-20'、'15'、'10-' → (首页, 末页或None)，页码从1开始；格式不对时抛出 ValueError"""
+    if isinstance(spec, (tuple, list)):
+        first, last = spec
+    else:
+        match = re.fullmatch(r'\s*(\d+)\s*(?:(-)\s*(\d*)\s*)?', str(spec))
+        if not match:
+            raise ValueError(f"无效的页码范围 {spec!r}，应为 N、N-M 或 N-")
+        first = int(match.group(1))
+        last = int(match.group(3)) if match.group(3) else (None if match.group(2) else first)
+    if first < 1 or (last is not None and last < first):
+        raise ValueError(f"无效的页码范围 {spec!r}")
+    return first, last
+
+
+def volume_names(pdf_file, count):
+    """各卷的文件路径：name-vol01.pdf, name-vol02.pdf, ..."""
+    stem, ext = os.path.splitext(pdf_file)
+    width = max(2, len(str(count)))
+    return [f"{stem}-vol{i + 1:0{width}d}{ext or '.pdf'}" for i in range(count)]
+
+
+def link_sections(sections):
+    """把指向其他节锚点的链接改写为占位地址，返回 (改写后的各节, {锚点: 节序号})"""
+    owners = {}
+    for index, section in enumerate(sections):
+        for anchor in ANCHOR_RE.findall(section):
+            owners.setdefault(anchor, index)
+
+    def rewrite(index, section):
+        def replace(match):
+            owner = owners.get(match.group(2))
+            if owner is None or owner == index:
+                return match.group(0)
+            return f"{match.group(1)}{LINK_SCHEME}:{owner}#{match.group(2)}"
+        return LOCAL_LINK_RE.sub(replace, section)
+
+    return [rewrite(index, section) for index, section in enumerate(sections)], owners
+
+
+def section_title(section):
+    match = _TITLE_RE.search(section)
+    return match.group(1).strip() if match else ''
+
+
+class PageIndex:
+    """各节排版后的页数，按 (排版的节文本, 样式, 渲染版本) 缓存，供预览跳过已知页数的节"""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(default_cache_dir(), PAGE_INDEX_FILE)
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def get(self, key):
+        with self._lock:
+            return self._load().get(key)
+
+    def update(self, counts):
+        """counts: {键: 页数}"""
+        with self._lock:
+            entries = self._load()
+            for key, pages in counts.items():
+                entries.pop(key, None)
+                entries[key] = pages
+            while len(entries) > PAGE_INDEX_MAX_ENTRIES:
+                entries.pop(next(iter(entries)))
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(entries, f)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logger.debug(f"无法保存页码索引: {e}")
+
+
+def _section_keys(session, sections):
+    """各节在页码索引中的键；sections是实际排版的文本（link_sections改写后），
+    指向其他节的链接目标变化时页数要重新计算"""
+    from converter import RENDER_VERSION, get_renderer, get_highlighter
+    backend = get_renderer().backend
+    highlighting = get_highlighter().fingerprint()
+    return [make_key('pages', RENDER_VERSION, backend, highlighting, session.style_key, section)
+            for section in sections]
+
+
+def pack_volumes(page_counts, sizes, split):
+    """按顺序把各节装入各卷，返回每卷的片段列表 [(节序号, 起始页, 结束页), ...]
+
+    结束页不含在内。pages方式下超过上限的节在页边界处拆开；size方式下按各节PDF的
+    大小估算（合并时共用的字体只保留一份，实际各卷会更小）。
+    """
+    volumes = []
+    current, used = [], 0
+    for index, (pages, size) in enumerate(zip(page_counts, sizes)):
+        if split.mode == 'headings':
+            volumes.append([(index, 0, pages)])
+            continue
+        if split.mode == 'pages':
+            start = 0
+            while start < pages:
+                if used >= split.limit:
+                    volumes.append(current)
+                    current, used = [], 0
+                take = min(pages - start, split.limit - used)
+                current.append((index, start, start + take))
+                used += take
+                start += take
+        else:
+            if current and used + size > split.limit:
+                volumes.append(current)
+                current, used = [], 0
+            if size > split.limit:
+                logger.warning(f"⚠ 第 {index + 1} 节单独就有 {size / 1048576:.1f} MB，超过分卷大小上限")
+            current.append((index, 0, pages))
+            used += size
+    if current:
+        volumes.append(current)
+    return volumes
+
+
+def _anchor_pages(section_files):
+    """{锚点: (节序号, 节内页码)}，来自各节PDF的命名目标"""
+    from pypdf import PdfReader
+
+    anchors = {}
+    for index, pdf_file in enumerate(section_files):
+        reader = PdfReader(pdf_file)
+        for name, destination in reader.named_destinations.items():
+            page = reader.get_destination_page_number(destination)
+            if page is not None and page >= 0:
+                anchors.setdefault(name.lstrip('/'), (index, page))
+    return anchors
+
+
+def _resolve_links(writer, volume, locate, names):
+    """把占位链接改为卷内跳转（GoTo）或跳到另一卷文件（GoToR）"""
+    from pypdf.generic import BooleanObject, DictionaryObject, NameObject, TextStringObject
+
+    for page in writer.pages:
+        for annotation in page.get('/Annots') or []:
+            annotation = annotation.get_object()
+            action = annotation.get('/A')
+            if action is None:
+                continue
+            action = action.get_object()
+            uri = action.get('/URI')
+            if action.get('/S') != '/URI' or not str(uri or '').startswith(LINK_SCHEME + ':'):
+                continue
+            target, _, anchor = str(uri)[len(LINK_SCHEME) + 1:].partition('#')
+            target_volume = locate(anchor, int(target))
+            if target_volume == volume:
+                replacement = {NameObject('/S'): NameObject('/GoTo'), NameObject('/D'): TextStringObject(anchor)}
+            else:
+                replacement = {
+                    NameObject('/S'): NameObject('/GoToR'),
+                    NameObject('/F'): TextStringObject(os.path.basename(names[target_volume])),
+                    NameObject('/D'): TextStringObject(anchor),
+                    NameObject('/NewWindow'): BooleanObject(False),
+                }
+            annotation[NameObject('/A')] = DictionaryObject(replacement)
+
+
+def _resolve_preview_links(pdf_file):
+    """把预览中的占位链接改为预览内跳转（GoTo），目标不在预览中的链接去掉；返回去掉的链接数"""
+    from pypdf import PdfReader, PdfWriter
+    from pypdf.generic import ArrayObject, DictionaryObject, NameObject, TextStringObject
+
+    reader = PdfReader(pdf_file)
+    anchors = {name.lstrip('/') for name in reader.named_destinations}
+    writer = PdfWriter(clone_from=reader)
+    changed = dropped = 0
+    for page in writer.pages:
+        annotations = page.get('/Annots')
+        if not annotations:
+            continue
+        kept = ArrayObject()
+        for reference in annotations:
+            annotation = reference.get_object()
+            action = annotation.get('/A')
+            uri = str(action.get_object().get('/URI') or '') if action is not None else ''
+            if not uri.startswith(LINK_SCHEME + ':'):
+                kept.append(reference)
+                continue
+            changed += 1
+            anchor = uri.partition('#')[2]
+            if anchor in anchors:
+                annotation[NameObject('/A')] = DictionaryObject(
+                    {NameObject('/S'): NameObject('/GoTo'), NameObject('/D'): TextStringObject(anchor)})
+                kept.append(reference)
+            else:
+                dropped += 1
+        page[NameObject('/Annots')] = kept
+    if changed:
+        tmp = f'{pdf_file}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            writer.write(f)
+        os.replace(tmp, pdf_file)
+    writer.close()
+    return dropped
+
+
+def convert_volumes(md_text, pdf_file, app_path, split, workers=None, base_url=None, stylesheets=(),
+                    optimize_images=True):
+    """把md_text分卷渲染，返回各卷的文件路径"""
+    try:
+        from pypdf import PdfWriter
+    except ImportError:
+        raise RuntimeError("分卷输出需要安装pypdf（pip install pypdf）")
+    from converter import get_session
+
+    split = parse_split(split)
+    if workers is None:
+        workers = default_workers()
+
+    sections = split_sections(md_text)
+    linked, _ = link_sections(sections)
+    logger.info(f"分卷渲染: {len(sections)} 节, 按 {split.mode} 分卷, {workers} 个进程")
+
+    # 按整篇文档的字符生成一次字体子集，所有节共用，合并时重复的字体只保留一份
+    session = get_session(app_path, stylesheets, optimize_images)
+    charset = ''.join(set(md_text))
+    shared_fonts = session.font_subset(charset) is not None
+
+    with tempfile.TemporaryDirectory(prefix='md2pdf-volumes-') as tmp:
+        section_files = [os.path.join(tmp, f'section-{i:04d}.pdf') for i in range(len(sections))]
+        with profiling.stage('render_sections', sections=len(sections)):
+            # 每个进程一次只排版一节，排版内存与最大的一节成正比
+            with ProcessPoolExecutor(max_workers=max(1, min(workers, len(sections)))) as executor:
+                page_counts = render_chunks(
+                    executor,
+                    linked,
+                    section_files,
+                    [app_path] * len(sections),
+                    [base_url] * len(sections),
+                    [stylesheets] * len(sections),
+                    [charset] * len(sections),
+                    [shared_fonts] * len(sections),
+                    [optimize_images] * len(sections),
+                )
+        PageIndex().update(dict(zip(_section_keys(session, linked), page_counts)))
+
+        sizes = [os.path.getsize(path) for path in section_files]
+        volumes = pack_volumes(page_counts, sizes, split)
+        names = volume_names(pdf_file, len(volumes))
+        anchors = _anchor_pages(section_files)
+
+        # 每个 (节, 页) 属于哪一卷
+        volume_of = {}
+        for number, pieces in enumerate(volumes):
+            for index, start, stop in pieces:
+                for page in range(start, stop):
+                    volume_of[index, page] = number
+
+        def locate(anchor, section):
+            index, page = anchors.get(anchor, (section, 0))
+            return volume_of.get((index, page), volume_of.get((section, 0), 0))
+
+        with profiling.stage('write_volumes', volumes=len(volumes)):
+            for number, (pieces, name) in enumerate(zip(volumes, names)):
+                writer = PdfWriter()
+                for index, start, stop in pieces:
+                    writer.append(section_files[index], pages=(start, stop), import_outline=True)
+                _resolve_links(writer, number, locate, names)
+                if shared_fonts and hasattr(writer, 'compress_identical_objects'):
+                    writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+                with open(name, 'wb') as f:
+                    writer.write(f)
+                writer.close()
+                pages = sum(stop - start for _, start, stop in pieces)
+                logger.info(f"✓ 第 {number + 1} 卷: {name}（{pages} 页, {os.path.getsize(name) / 1048576:.1f} MB）")
+
+    return names
+
+
+def render_preview(md_text, pdf_file, app_path, pages=None, section=None, base_url=None, stylesheets=(),
+                   optimize_images=True):
+    """只排版一个页码范围或标题包含 section 的节，写入pdf_file，返回页数
+
+    pages: (首页, 末页或None) 或 '10-20' 形式的字符串，页码按整篇文档计算。
+    """
+    try:
+        import pypdf  # noqa: F401
+    except ImportError:
+        raise RuntimeError("预览需要安装pypdf（pip install pypdf）")
+    from converter import get_session
+
+    session = get_session(app_path, stylesheets, optimize_images)
+    sections = split_sections(md_text)
+    # 与分卷相同的排版输入，页码索引中的页数对两者都适用
+    linked, _ = link_sections(sections)
+
+    if section is not None:
+        wanted = section.strip().lower()
+        matches = [i for i, s in enumerate(sections) if wanted in section_title(s).lower()]
+        if not matches:
+            titles = ', '.join(filter(None, (section_title(s) for s in sections)))
+            raise ValueError(f"没有标题包含 {section!r} 的节（顶级标题: {titles}）")
+        with profiling.stage('preview_section'):
+            document = session.render(linked[matches[0]], base_url, md_text)
+            with profiling.stage('write_pdf'):
+                document.write_pdf(pdf_file)
+                dropped = _resolve_preview_links(pdf_file)
+        logger.info(f"✓ 预览 “{section_title(sections[matches[0]])}”: {len(document.pages)} 页"
+                    + (f"，{dropped} 个指向其他节的链接已去掉" if dropped else ''))
+        return len(document.pages)
+
+    first, last = parse_pages(pages)
+    index = PageIndex()
+    keys = _section_keys(session, linked)
+    selected = []   # 范围内的页（WeasyPrint Page对象）
+    template = None
+    counts = {}
+    offset = 0      # 当前节之前的总页数
+    laid_out = 0
+    with profiling.stage('preview_pages'):
+        for section_text, key in zip(linked, keys):
+            if last is not None and offset >= last:
+                break
+            known = index.get(key)
+            if known is not None and offset + known < first:
+                # 整节都在范围之前，页数已知，不用排版
+                offset += known
+                continue
+            document = session.render(section_text, base_url, md_text)
+            laid_out += 1
+            count = len(document.pages)
+            counts[key] = count
+            for number, page in enumerate(document.pages, offset + 1):
+                if number >= first and (last is None or number <= last):
+                    selected.append(page)
+                    template = template or document
+            offset += count
+        if counts:
+            index.update(counts)
+        if not selected:
+            raise ValueError(f"文档只有 {offset} 页，请求的范围是第 {first} 页起")
+        with profiling.stage('write_pdf'):
+            template.copy(selected).write_pdf(pdf_file)
+            dropped = _resolve_preview_links(pdf_file)
+
+    logger.info(f"✓ 预览第 {first}-{first + len(selected) - 1} 页（排版了 {laid_out}/{len(sections)} 节）"
+                + (f"，{dropped} 个指向范围之外的链接已去掉" if dropped else ''))
+    return len(selected)
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Watch mode (md2pdf.py --watch)
+Rebuilds documents whose inputs changed. Uses inotify on Linux and falls back
+to polling elsewhere. Rapid saves are debounced. When a newer edit touches the
+document that is being converted, the build is cancelled and only the
+documents it had not finished are queued again.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Wait this long after the last change before building
+DEBOUNCE_SECONDS = 0.3
+# Interval of the polling fallback
+POLL_INTERVAL = 0.5
+
+MARKDOWN_SUFFIXES = {'.md', '.markdown'}
+# Non-Markdown files that documents commonly depend on
+ASSET_SUFFIXES = {'.png', '.jpg', '.jpeg', '.gif', '.svg', '.css', '.bib', '.tex'}
+
+# inotify constants (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ISDIR = 0x40000000
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def is_relevant(path):
+    """Only Markdown sources and their assets trigger builds (not our own outputs)"""
+    suffix = os.path.splitext(path)[1].lower()
+    return suffix in MARKDOWN_SUFFIXES or suffix in ASSET_SUFFIXES
+
+
+def document_assets(md_file):
+    """Local files md_file references (absolute paths, may not exist)"""
+    from treebuild import file_references
+    try:
+        return file_references(md_file)
+    except OSError:
+        return []
+
+
+def find_documents(target):
+    """All Markdown files under target (or target itself)"""
+    if os.path.isfile(target):
+        return [os.path.abspath(target)]
+    documents = []
+    for root, dirs, files in os.walk(target):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in files:
+            if os.path.splitext(name)[1].lower() in MARKDOWN_SUFFIXES:
+                documents.append(os.path.abspath(os.path.join(root, name)))
+    return sorted(documents)
+
+
+class InotifyWatcher:
+    """Directory watcher built on Linux inotify via ctypes"""
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, target):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs = {}
+        # Watch directories rather than files: editors often save by renaming
+        root = target if os.path.isdir(target) else os.path.dirname(os.path.abspath(target))
+        self._recursive = os.path.isdir(target)
+        self._add_tree(root)
+        # A single document: also watch the directories of the files it references
+        self._document = None if self._recursive else os.path.abspath(target)
+        self._watch_assets()
+
+    def _watch_assets(self):
+        if self._document is None:
+            return
+        watched = set(self._dirs.values())
+        for path in document_assets(self._document):
+            directory = os.path.dirname(path)
+            if directory not in watched and os.path.isdir(directory):
+                self._add_dir(directory)
+                watched.add(directory)
+
+    def _add_dir(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            logger.warning(f"⚠ Cannot watch {path}: {os.strerror(ctypes.get_errno())}")
+            return
+        self._dirs[wd] = path
+
+    def _add_tree(self, root):
+        self._add_dir(root)
+        if self._recursive:
+            for parent, dirs, _ in os.walk(root):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                for d in dirs:
+                    self._add_dir(os.path.join(parent, d))
+
+    def wait(self, timeout=None):
+        """Block until something changes (or timeout); return the changed paths"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                parent = self._dirs.get(wd)
+                if parent is None or not name:
+                    continue
+                path = os.path.join(parent, name)
+                if mask & IN_ISDIR:
+                    if mask & IN_CREATE and self._recursive and not name.startswith('.'):
+                        self._add_tree(path)
+                elif is_relevant(path):
+                    changed.add(path)
+        if self._document in changed:
+            self._watch_assets()
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Portable fallback that compares mtimes and sizes"""
+
+    def __init__(self, target, interval=POLL_INTERVAL):
+        self.target = target
+        self.interval = interval
+        # A single document is watched together with the files it references
+        self._document = os.path.abspath(target) if os.path.isfile(target) else None
+        self._assets = document_assets(self._document) if self._document else []
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        if self._document is not None:
+            paths = [self._document] + self._assets
+        else:
+            paths = []
+            for root, dirs, files in os.walk(self.target):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                paths.extend(os.path.join(root, name) for name in files)
+        for path in paths:
+            if not is_relevant(path):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def wait(self, timeout=None):
+        """Poll until something changes (or timeout); return the changed paths"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, max(0.0, deadline - time.monotonic()))
+            time.sleep(delay)
+            snapshot = self._scan()
+            changed = {p for p in snapshot.keys() | self._snapshot.keys()
+                       if snapshot.get(p) != self._snapshot.get(p)}
+            self._snapshot = snapshot
+            if self._document in changed:
+                self._assets = document_assets(self._document)
+                self._snapshot = self._scan()
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+
+def make_watcher(target):
+    """inotify where available, polling otherwise"""
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(target)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"⚠ inotify unavailable ({e}), falling back to polling")
+    return PollingWatcher(target)
+
+
+def _build(jobs, convert, convert_args, progress):
+    """Child process: convert the given documents and print timings
+
+    progress is the write end of a pipe; the input file is sent before and
+    after each conversion so the parent knows what is in flight and done.
+    """
+    if hasattr(os, 'setsid'):
+        # Own process group, so cancelling also stops pandoc/LaTeX children
+        os.setsid()
+    start = time.perf_counter()
+    failed = 0
+    for input_file, output_file in jobs:
+        doc_start = time.perf_counter()
+        progress.send(('start', input_file))
+        success = convert(input_file, output_file, *convert_args)
+        progress.send(('done', input_file))
+        status = '✓' if success else '✗'
+        failed += 0 if success else 1
+        logger.info(f"{status} Rebuilt {os.path.basename(input_file)} in {time.perf_counter() - doc_start:.2f}s")
+    logger.info(f"Rebuild of {len(jobs)} document(s) finished in {time.perf_counter() - start:.2f}s")
+    sys.exit(1 if failed else 0)
+
+
+def _cancel(process):
+    """Stop an in-flight build together with its subprocesses"""
+    if hasattr(os, 'killpg'):
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except OSError:
+            process.terminate()
+    else:
+        process.terminate()
+    process.join()
+
+
+def watch(target, convert, convert_args=(), output_dir=None, debounce=DEBOUNCE_SECONDS):
+    """Watch target (a file or directory) and rebuild changed documents until interrupted"""
+    target = os.path.abspath(target)
+
+    def output_for(input_file):
+        stem = Path(input_file).stem
+        if output_dir:
+            return os.path.join(output_dir, stem + '.pdf')
+        return str(Path(input_file).with_suffix('.pdf'))
+
+    # Resolved references of each document, refreshed when the document changes
+    references = {}
+
+    def referenced(doc):
+        if doc not in references:
+            references[doc] = set(document_assets(doc))
+        return references[doc]
+
+    def affected(changed):
+        """Map changed paths to the documents that must be rebuilt"""
+        documents = set(find_documents(target))
+        for doc in list(references):
+            if doc in changed or doc not in documents:
+                del references[doc]
+        result = set()
+        for path in changed:
+            if path in documents:
+                result.add(path)
+            elif os.path.splitext(path)[1].lower() not in MARKDOWN_SUFFIXES:
+                # An asset changed: rebuild the documents that reference it
+                # (\input{chapter} may omit the extension)
+                candidates = {path, os.path.splitext(path)[0]}
+                result.update(doc for doc in documents if referenced(doc) & candidates)
+        return result
+
+    watcher = make_watcher(target)
+    logger.info(f"Watching {target} ({type(watcher).__name__}); press Ctrl+C to stop")
+
+    pending = set(find_documents(target))
+    last_change = 0.0
+    build = None
+    progress = None
+    building = set()
+    finished = set()
+    current = None
+
+    def drain():
+        nonlocal current
+        while progress is not None and progress.poll():
+            try:
+                event, doc = progress.recv()
+            except EOFError:
+                break
+            if event == 'start':
+                current = doc
+            else:
+                finished.add(doc)
+                current = None
+
+    try:
+        while True:
+            timeout = 0.1 if (pending or build is not None) else None
+            changed = watcher.wait(timeout)
+            drain()
+            if changed:
+                docs = affected(changed)
+                if docs:
+                    # Documents of the running build that have not started yet
+                    # will read the new content anyway
+                    pending |= docs - (building - finished - {current})
+                    last_change = time.monotonic()
+                    if build is not None and build.is_alive() and current in docs:
+                        logger.info(f"{os.path.basename(current)} changed while converting, cancelling the build")
+                        _cancel(build)
+                        drain()
+                        pending |= building - finished
+                        build = None
+
+            if build is not None and not build.is_alive():
+                build.join()
+                drain()
+                # A build that died early leaves its unfinished documents queued
+                pending |= building - finished - {current}
+                build = None
+
+            if build is None and progress is not None:
+                progress.close()
+                progress = None
+                building = set()
+                finished = set()
+                current = None
+
+            if pending and build is None and time.monotonic() - last_change >= debounce:
+                building = pending
+                pending = set()
+                jobs = [(doc, output_for(doc)) for doc in sorted(building)]
+                progress, child_end = multiprocessing.Pipe(duplex=False)
+                build = multiprocessing.Process(target=_build, args=(jobs, convert, convert_args, child_end))
+                build.start()
+                child_end.close()
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+    finally:
+        if build is not None and build.is_alive():
+            _cancel(build)
+        watcher.close()